@@ -1,11 +1,139 @@
 import unittest
 import random
+import numpy as np
 from pygraph.classes.graph import graph
 
+class ProbeList(object):
+    '''
+    Members in a random order, handed out round-robin and reshuffled after
+    each full pass, so every member is visited once per len(self) calls of
+    next.  Members added mid-pass go to a random slot among those not yet
+    visited this pass; removed members are skipped and purged at the next
+    reshuffle.
+    '''
+
+    def __init__(self, members, rnd=random):
+        self.rnd = rnd
+        self.members = list(members)
+        self.rnd.shuffle(self.members)
+        self.pos = 0
+        self.listed = set(self.members)
+        self.removed = set()
+
+    def __len__(self):
+        return len(self.members) - len(self.removed)
+
+    def __contains__(self, member):
+        return member in self.listed and member not in self.removed
+
+    def add(self, member):
+        if member in self.listed:
+            self.removed.discard(member)
+            return
+        self.listed.add(member)
+        # Append, then swap with a random unvisited slot
+        members = self.members
+        members.append(member)
+        j = self.rnd.randint(self.pos, len(members) - 1)
+        (members[j], members[-1]) = (members[-1], members[j])
+
+    def remove(self, member):
+        self.removed.add(member)
+
+    def next(self):
+        '''
+        Next member in round-robin order, None if the list is empty
+        '''
+        if len(self) == 0:
+            return None
+        while True:
+            if self.pos == len(self.members):
+                self._reshuffle()
+            member = self.members[self.pos]
+            self.pos += 1
+            if member not in self.removed:
+                return member
+
+    def sample(self, k, exclude=None):
+        '''
+        Up to k distinct random members other than exclude.  The round-robin
+        position is left alone, so sampling never skips a probe target
+        '''
+        want = min(k, len(self) - (exclude in self))
+        members = self.members
+        result = []
+        # Draw random slots; fall back to the live members if removed ones
+        # keep getting in the way
+        for attempt in xrange(4 * len(members)):
+            if len(result) == want:
+                return result
+            member = members[self.rnd.randrange(len(members))]
+            if member != exclude and member not in self.removed and member not in result:
+                result.append(member)
+        if len(result) < want:
+            rest = [m for m in members if m != exclude and m not in self.removed
+                    and m not in result]
+            result.extend(self.rnd.sample(rest, want - len(result)))
+        return result
+
+    def _reshuffle(self):
+        if self.removed:
+            self.members = [m for m in self.members if m not in self.removed]
+            self.listed -= self.removed
+            self.removed.clear()
+        self.rnd.shuffle(self.members)
+        self.pos = 0
+
+class PingTopology(object):
+    '''
+    Alive flags and edges prepared once for SWIM.ping_many, so that sweeps
+    over k and loss do not redo the setup for every call.  edges is either
+    a dense bool matrix, tested by indexing, or an (indptr, indices) pair
+    of neighbor lists, tested by searching their sorted a * n + b keys.
+    Neighbor lists are kept sorted; those of a dense matrix are only built
+    once helpers are sampled.  With labels, ping_many takes node labels instead of indexes
+    '''
+
+    def __init__(self, alive, edges, labels=None):
+        self.alive = np.asarray(alive)
+        self.labels = labels
+        if isinstance(edges, tuple):
+            self.dense = None
+            (indptr, indices) = edges
+            self.n = len(indptr) - 1
+            # Edge (a, b) exists iff a * n + b is in keys.  Rows stay in
+            # order, so sorting the keys also sorts each neighbor list
+            rows = np.repeat(np.arange(self.n, dtype=np.int64), np.diff(indptr))
+            self.keys = np.sort(rows * self.n + indices)
+            self._neighbors = (indptr, self.keys - rows * self.n)
+        else:
+            self.dense = np.asarray(edges, dtype=bool)
+            self._neighbors = None
+            self.n = len(self.dense)
+            self.keys = None
+
+    def has_edges(self, src, dst):
+        if self.dense is not None:
+            return self.dense[src, dst]
+        return SWIM._has_keys(self.keys, src * self.n + dst)
+
+    def neighbors(self):
+        '''
+        (indptr, indices) neighbor lists
+        '''
+        if self._neighbors is None:
+            (rows, indices) = np.nonzero(self.dense)
+            indptr = np.zeros(self.n + 1, dtype=np.int64)
+            indptr[1:] = np.cumsum(np.bincount(rows, minlength=self.n))
+            self._neighbors = (indptr, indices)
+        return self._neighbors
+
 class SWIM(object):
 
     def __init__(self, graph):
         self.graph = graph
+        # Probe lists of the nodes which have probed, built on first use
+        self._probe_lists = {}
 
     def edge_alive(self, nodeA, nodeB, alive):
         '''
@@ -16,6 +144,12 @@ class SWIM(object):
             self.graph.add_edge(edge)
         else:
             self.graph.del_edge(edge)
+        for (node, other) in [(nodeA, nodeB), (nodeB, nodeA)]:
+            if node in self._probe_lists:
+                if alive:
+                    self._probe_lists[node].add(other)
+                else:
+                    self._probe_lists[node].remove(other)
 
     def node_alive(self, node, alive):
         '''
@@ -37,19 +171,143 @@ class SWIM(object):
         if g.has_edge((nodeStart, nodeEnd)) and \
            "dead" not in g.node_attributes(nodeEnd):
             return True
-        # Pick k random neighbors and let them ping end node
-        for neighbor in self._random_neighbors(nodeStart, k):
+        # Pick k neighbors and let them ping end node
+        for neighbor in self._probe_list(nodeStart).sample(k, nodeEnd):
             if self.ping(neighbor, nodeEnd, 0):
                 return True
         # All pings have failed
         return False
 
-    def _random_neighbors(self, node, b):
-        neighbors = self.graph.neighbors(node)
-        if len(neighbors) <= b:
-            return neighbors
+    def probe(self, node, k):
+        '''
+        One protocol period of node: ping the next neighbor of its probe
+        list.  Every neighbor is probed once per pass over the list, which
+        bounds the time to detect a failure.  Return (target, success)
+        '''
+        target = self._probe_list(node).next()
+        if target is None:
+            return (None, False)
+        return (target, self.ping(node, target, k))
+
+    def _probe_list(self, node):
+        if node not in self._probe_lists:
+            self._probe_lists[node] = ProbeList(self.graph.neighbors(node))
+        return self._probe_lists[node]
+
+    def ping_many(self, starts, ends, k, alive=None, edges=None, loss=0.0, rng=None):
+        '''
+        Vectorized ping for arrays of start and end nodes.  Node i is the
+        i-th of sorted(graph.nodes()) unless alive and edges are given:
+        alive is a bool array over the nodes and edges either a dense bool
+        matrix or an (indptr, indices) pair of neighbor lists.  edges may
+        also be a PingTopology (see topology()), alive then being ignored;
+        prepare one when calling ping_many many times.  Every ping message
+        is lost with probability loss, so an indirect ping needs both the
+        ping-req and the helper's ping through.  Return a bool array telling
+        which pings reached their end node
+        '''
+        rng = rng if rng is not None else np.random.RandomState()
+        starts = np.asarray(starts)
+        ends = np.asarray(ends)
+        if edges is None:
+            topology = self.topology()
+        elif isinstance(edges, PingTopology):
+            topology = edges
         else:
-            return random.sample(neighbors, b)
+            topology = PingTopology(alive, edges)
+        if topology.labels is not None:
+            starts = np.searchsorted(topology.labels, starts)
+            ends = np.searchsorted(topology.labels, ends)
+        alive = topology.alive
+        def delivered(src, dst):
+            return topology.has_edges(src, dst) & alive[dst] & \
+                   (rng.random_sample(len(src)) >= loss)
+        # Check if direct ping works
+        ok = delivered(starts, ends)
+        if k == 0:
+            return ok
+        # Pick k random neighbors and let them ping end node
+        retry = np.flatnonzero(~ok)
+        (indptr, indices) = topology.neighbors()
+        (probe, helper) = self._sample_neighbors(indptr, indices, starts[retry], k, rng,
+                                                 exclude=ends[retry])
+        reached = delivered(helper, ends[retry][probe]) & (rng.random_sample(len(probe)) >= loss)
+        ok[retry[probe[reached]]] = True
+        return ok
+
+    def topology(self):
+        '''
+        PingTopology of the graph as it is now, taking node labels
+        '''
+        (labels, alive, indptr, indices) = self._arrays()
+        return PingTopology(alive, (indptr, indices), labels)
+
+    def _arrays(self):
+        # Sorted node labels, alive flags and neighbor lists of the graph
+        g = self.graph
+        labels = np.array(sorted(g.nodes()))
+        alive = np.array(["dead" not in g.node_attributes(node) for node in labels])
+        neighbors = [np.searchsorted(labels, sorted(g.neighbors(node))) for node in labels]
+        indptr = np.zeros(len(labels) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(nbs) for nbs in neighbors])
+        indices = np.concatenate(neighbors + [[]]).astype(np.int64)
+        return (labels, alive, indptr, indices)
+
+    @staticmethod
+    def _has_keys(keys, wanted):
+        pos = np.minimum(np.searchsorted(keys, wanted), max(len(keys) - 1, 0))
+        if len(keys) == 0:
+            return np.zeros(len(wanted), dtype=bool)
+        return keys[pos] == wanted
+
+    @staticmethod
+    def _sample_neighbors(indptr, indices, nodes, k, rng, exclude=None):
+        '''
+        min(k, degree) distinct random neighbors of every node, by Floyd's
+        algorithm run over all nodes at once.  exclude, if given, is a node
+        per row which is never drawn, as ping never asks the target to
+        help.  Return parallel (row, node) arrays, row indexing into nodes
+        '''
+        start = indptr[nodes]
+        deg = indptr[nodes + 1] - start
+        skip = None
+        if exclude is not None:
+            # Draw from the other deg - 1 slots, then step over the excluded one
+            skip = SWIM._neighbor_positions(indptr, indices, nodes, exclude)
+            deg = deg - (skip >= 0)
+        take = np.minimum(deg, k)
+        picks = np.empty((len(nodes), k), dtype=np.int64)
+        for i in xrange(k):
+            # Step j = deg - k + i, only for rows drawing more than i
+            j = deg - take + i
+            t = (rng.random_sample(len(nodes)) * (j + 1)).astype(np.int64)
+            seen = (picks[:, :i] == t[:, None]).any(axis=1)
+            picks[:, i] = np.where(seen, j, t)
+        valid = np.arange(k)[None, :] < take[:, None]
+        (row, col) = np.nonzero(valid)
+        picks = picks[row, col]
+        if skip is not None:
+            picks += (skip[row] >= 0) & (picks >= skip[row])
+        return (row, indices[start[row] + picks])
+
+    @staticmethod
+    def _neighbor_positions(indptr, indices, nodes, targets):
+        # Position of each target in the sorted neighbor list of its node,
+        # -1 if absent, by a binary search over all rows at once
+        lo = indptr[nodes].copy()
+        end = indptr[nodes + 1]
+        hi = end.copy()
+        last = max(len(indices) - 1, 0)
+        while True:
+            active = lo < hi
+            if not active.any():
+                break
+            mid = (lo + hi) // 2
+            less = active & (indices[np.minimum(mid, last)] < targets)
+            lo = np.where(less, mid + 1, lo)
+            hi = np.where(active & ~less, mid, hi)
+        found = (lo < end) & (indices[np.minimum(lo, last)] == targets)
+        return np.where(found, lo - indptr[nodes], -1)
 
 class SWIMTest(unittest.TestCase):
 
@@ -77,6 +335,142 @@ class SWIMTest(unittest.TestCase):
         self.assertFalse(swim.ping(0, 2, 0))
         self.assertFalse(swim.ping(0, 2, 3))
 
+    def test_probe_round_robin(self):
+        swim = self.swim
+        swim.node_alive(4, False)
+        # Each pass probes every neighbor once
+        for i in xrange(3):
+            results = dict(swim.probe(0, 0) for j in xrange(9))
+            self.assertEquals(range(1, 10), sorted(results))
+            self.assertEquals([4], [n for n in results if not results[n]])
+        # Indirect pings through helpers do not use up probe targets
+        for i in xrange(3):
+            targets = [swim.probe(0, 3)[0] for j in xrange(9)]
+            self.assertEquals(range(1, 10), sorted(targets))
+        swim.edge_alive(0, 5, False)
+        swim.edge_alive(0, 3, False)
+        swim.edge_alive(0, 3, True)
+        targets = [swim.probe(0, 0)[0] for j in xrange(16)]
+        self.assertEquals(2, targets.count(3))
+        self.assertFalse(5 in targets)
+
+    def test_probe_list(self):
+        probes = ProbeList(range(5), random.Random(1))
+        first = [probes.next() for i in xrange(2)]
+        # New members land in the unvisited part of the pass
+        probes.add(5)
+        probes.add(6)
+        probes.remove(first[0])
+        probes.remove(3)
+        self.assertTrue(set([5, 6]) <= set(probes.members[probes.pos:]))
+        unvisited = [m for m in probes.members[probes.pos:] if m not in probes.removed]
+        rest = [probes.next() for m in unvisited]
+        self.assertEquals(sorted(set(range(7)) - (set([3]) - set(first))), sorted(first + rest))
+        self.assertEquals(5, len(probes))
+        self.assertEquals(sorted(probes.members), sorted(set(probes.members)))
+        self.assertEquals(5, len(set(probes.next() for i in xrange(5))))
+        self.assertFalse(3 in probes)
+        self.assertEquals(4, len(probes.sample(10, exclude=5)))
+        self.assertFalse(5 in probes.sample(4, exclude=5))
+        pos = probes.pos
+        probes.sample(3)
+        self.assertEquals(pos, probes.pos)
+        # Mostly removed members still give a full sample
+        probes = ProbeList(range(100), random.Random(2))
+        for m in xrange(97):
+            probes.remove(m)
+        self.assertEquals([97, 98, 99], sorted(probes.sample(5)))
+
+    def test_ping_many(self):
+        swim = self.swim
+        swim.edge_alive(0, 1, False)
+        swim.node_alive(2, False)
+        rng = np.random.RandomState(1)
+        self.assertEquals([True, False, False, False],
+                          swim.ping_many([1, 0, 0, 4], [3, 1, 2, 2], 0, rng=rng).tolist())
+        self.assertEquals([True, True, False],
+                          swim.ping_many([1, 0, 0], [3, 1, 2], 3, rng=rng).tolist())
+        self.assertEquals([False] * 50, swim.ping_many([0] * 50, [1] * 50, 3, loss=1.0).tolist())
+
+    def test_ping_many_matches_ping(self):
+        # Sparse random graph with a few dead nodes and edges
+        rng = np.random.RandomState(2)
+        random.seed(2)
+        g = graph()
+        g.add_nodes(xrange(40))
+        for (a, b) in rng.randint(0, 40, size=(100, 2)):
+            if a != b and not g.has_edge((a, b)):
+                g.add_edge((a, b))
+        swim = SWIM(g)
+        for node in [3, 11, 27]:
+            swim.node_alive(node, False)
+        starts = rng.randint(0, 40, 4000)
+        ends = rng.randint(0, 40, 4000)
+        expected = np.mean([swim.ping(s, e, 2) for (s, e) in zip(starts, ends)])
+        result = swim.ping_many(starts, ends, 2, rng=rng)
+        self.assertTrue(abs(expected - result.mean()) < 0.03)
+        # Same draws over a dense matrix and over neighbor lists
+        (labels, alive, indptr, indices) = swim._arrays()
+        dense = np.zeros((40, 40), dtype=bool)
+        dense[np.repeat(np.arange(40), np.diff(indptr)), indices] = True
+        a = swim.ping_many(starts, ends, 2, alive, dense, rng=np.random.RandomState(3))
+        b = swim.ping_many(starts, ends, 2, alive, (indptr, indices), rng=np.random.RandomState(3))
+        self.assertEquals(a.tolist(), b.tolist())
+        # A prepared topology gives the same draws, and is reused across calls
+        topology = swim.topology()
+        for prepared in [topology, PingTopology(alive, dense)]:
+            c = swim.ping_many(starts, ends, 2, edges=prepared, rng=np.random.RandomState(3))
+            self.assertEquals(a.tolist(), c.tolist())
+        keys = topology.keys
+        swim.ping_many(starts, ends, 1, edges=topology, loss=0.1)
+        self.assertTrue(keys is topology.keys)
+
+    def test_sample_neighbors(self):
+        indptr = np.array([0, 2, 12])
+        indices = np.arange(12)
+        rng = np.random.RandomState(4)
+        counts = np.zeros(12)
+        for i in xrange(2000):
+            (row, node) = SWIM._sample_neighbors(indptr, indices, np.array([0, 1]), 3, rng)
+            self.assertEquals([0, 0, 1, 1, 1], row.tolist())
+            self.assertEquals([0, 1], sorted(node[:2].tolist()))
+            self.assertEquals(3, len(set(node[2:].tolist())))
+            counts[node] += 1
+        # Every neighbor of node 1 is picked with probability 3/10
+        self.assertTrue((abs(counts[2:] / 2000.0 - 0.3) < 0.04).all())
+        # Excluded nodes are never drawn, the others stay uniform
+        counts = np.zeros(12)
+        for i in xrange(2000):
+            (row, node) = SWIM._sample_neighbors(indptr, indices, np.array([0, 1, 1]), 3,
+                                                 rng, exclude=np.array([1, 5, 20]))
+            self.assertEquals([0, 1, 1, 1, 2, 2, 2], row.tolist())
+            self.assertEquals([0], node[:1].tolist())
+            self.assertFalse(5 in node[1:4])
+            counts[node[1:4]] += 1
+        self.assertEquals(0, counts[5])
+        self.assertTrue((abs(np.delete(counts[2:], 3) / 2000.0 - 1 / 3.0) < 0.04).all())
+
+    def test_ping_many_excludes_target(self):
+        # 0 reaches 1 directly or through 2.  With lossy links ping_many,
+        # like ping, must not spend its one helper on the target itself
+        g = graph()
+        g.add_nodes(xrange(3))
+        g.add_edge((0, 1))
+        g.add_edge((0, 2))
+        g.add_edge((1, 2))
+        swim = SWIM(g)
+        self.assertEquals([2], swim._probe_list(0).sample(1, 1))
+        self.assertEquals(swim.ping(0, 1, 1), swim.ping_many([0], [1], 1)[0])
+        (indptr, indices) = swim.topology().neighbors()
+        (row, helper) = SWIM._sample_neighbors(indptr, indices, np.zeros(100, dtype=int), 1,
+                                               np.random.RandomState(6),
+                                               exclude=np.ones(100, dtype=int))
+        self.assertEquals([2] * 100, helper.tolist())
+        # Direct ping gets through half the time, else the helper path a quarter
+        ok = swim.ping_many([0] * 20000, [1] * 20000, 1, loss=0.5,
+                            rng=np.random.RandomState(5))
+        self.assertTrue(abs(ok.mean() - 0.625) < 0.015)
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -1,36 +1,745 @@
+import hashlib
+import math
+import os
+import shutil
+import struct
+import tempfile
+import numpy as np
+import unittest
+
+MASK64 = (1 << 64) - 1
+GOLDEN64 = 0x9e3779b97f4a7c15
+# Keys hashed as integers, numpy scalars included so they match their arrays
+INTEGER_TYPES = (int, long, np.integer)
+POPCOUNT8 = np.array([bin(i).count('1') for i in xrange(256)], dtype=np.uint8)
+
+def mix64(z):
+    '''
+    splitmix64 finalizer over a numpy uint64 array
+    '''
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return z ^ (z >> np.uint64(31))
+
 class BloomFilter(object):
+    '''
+    Bloom filter over a packed bit array.  Bits are stored 64 to a word in a
+    numpy uint64 array, so an m-bit filter takes m/8 bytes.
+    1) insert/contains work on a single key
+    2) insert_many/contains_many hash a whole batch of keys and set/test
+       all of their bits with vectorized numpy operations
+    hashes is either a list of hash functions, or the number of hashes k.
+    In the latter case all k indexes are derived from two 64-bit hashes of
+    the key, h1 + i*h2 (Kirsch-Mitzenmacher), and keys may be ints, str or
+    unicode.
+    Filters using the built-in hashes can be saved to a file and reopened
+    through mmap, so several processes share one copy of the bits.
+    '''
+
+    MAGIC = 'BLOOMF02'
+    # magic, m, k, seed, kind
+    HEADER = struct.Struct('<8sQQQQ')
+    KIND = 0
+
+    def __init__(self, mbits, hashes, seed=0):
+        self._configure(mbits, hashes, seed)
+        self._allocate()
+
+    def _configure(self, mbits, hashes, seed):
+        self.mbits = mbits
+        self.seed = seed & MASK64
+        if isinstance(hashes, (int, long)):
+            self.hashes = None
+            self.k = hashes
+        else:
+            self.hashes = hashes
+            self.k = len(hashes)
+
+    @classmethod
+    def forCapacity(cls, capacity, fpRate, seed=0):
+        '''
+        Create filter sized for capacity keys at false positive rate fpRate
+        '''
+        (mbits, k) = cls.optimalSize(capacity, fpRate)
+        return cls(mbits, k, seed)
 
-    def __init__(self, mbits, hashes):
-        self.bits = [0] * mbits
-        self.hashes = hashes
+    @staticmethod
+    def optimalSize(capacity, fpRate):
+        # m = -n ln(p) / ln(2)^2, k = m/n ln(2)
+        mbits = int(math.ceil(-capacity * math.log(fpRate) / math.log(2) ** 2))
+        k = max(1, int(round(float(mbits) / capacity * math.log(2))))
+        return (mbits, k)
 
     def insert(self, n):
         bitsChanged = []
-        for hash in self.hashes:
-            i = hash(n) % len(self.bits)
-            if self.bits[i] != 1:
+        for i in self._indexes(n):
+            if not self._testBit(i):
                 bitsChanged.append(i)
-                self.bits[i] = 1
+                self._setBit(i)
         return bitsChanged
 
     def contains(self, n):
-        for hash in self.hashes:
-            if self.bits[hash(n) % len(self.bits)] == 0:
+        for i in self._indexes(n):
+            if not self._testBit(i):
                 return False
         return True
 
+    def insert_many(self, keys):
+        '''
+        Insert every key in keys.  Return boolean array, True where the key
+        was not in the filter before the batch
+        '''
+        idx = self._indexes_many(keys)
+        if idx.shape[0] == 0:
+            return np.zeros(0, dtype=bool)
+        new = ~self._test(idx).all(axis=1)
+        self._set(idx.ravel())
+        return new
+
+    def contains_many(self, keys):
+        '''
+        Return boolean array, True where the key may be in the filter
+        '''
+        idx = self._indexes_many(keys)
+        if idx.shape[0] == 0:
+            return np.zeros(0, dtype=bool)
+        return self._test(idx).all(axis=1)
+
+    def save(self, path):
+        '''
+        Write header (m, k, seed, kind) followed by the bit words to path
+        '''
+        if self.hashes is not None:
+            raise ValueError("Only filters using the built-in hashes can be saved")
+        with open(path, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.mbits, self.k, self.seed, self.KIND))
+            f.write(self._storage().tobytes())
+
+    @classmethod
+    def open(cls, path, mode='r'):
+        '''
+        Map a filter written by save.  Bits are not copied: mode 'r' gives a
+        read-only filter backed by the page cache, 'r+' writes through to the
+        file.  The filter is of the class it was saved from
+        '''
+        with open(path, 'rb') as f:
+            (magic, mbits, k, seed, kind) = cls.HEADER.unpack(f.read(cls.HEADER.size))
+        if magic != cls.MAGIC:
+            raise ValueError("%s is not a saved BloomFilter" % path)
+        kinds = dict((c.KIND, c) for c in [BloomFilter] + BloomFilter.__subclasses__())
+        if kind not in kinds or not issubclass(kinds[kind], cls):
+            raise ValueError("%s does not hold a %s" % (path, cls.__name__))
+        # Never allocate the bits in memory, only map them
+        bf = kinds[kind].__new__(kinds[kind])
+        bf._configure(mbits, k, seed)
+        bf._map(path, mode, cls.HEADER.size)
+        return bf
+
+    def union(self, other):
+        '''
+        Filter containing every key of self and other
+        '''
+        self._checkCompatible(other)
+        bf = type(self)(self.mbits, self.hashes or self.k, self.seed)
+        np.bitwise_or(self.words, other.words, out=bf.words)
+        return bf
+
+    def intersect(self, other):
+        '''
+        Filter containing the keys common to self and other (with a false
+        positive rate at least that of either filter)
+        '''
+        self._checkCompatible(other)
+        bf = type(self)(self.mbits, self.hashes or self.k, self.seed)
+        np.bitwise_and(self.words, other.words, out=bf.words)
+        return bf
+
+    def bitCount(self):
+        return int(POPCOUNT8[self.words.view(np.uint8)].sum(dtype=np.int64))
+
+    def estimateCount(self):
+        '''
+        Estimated number of distinct keys inserted, -(m/k) ln(1 - X/m) where
+        X is the number of bits set
+        '''
+        x = self.bitCount()
+        if x >= self.mbits:
+            return float('inf')
+        return -float(self.mbits) / self.k * math.log(1 - float(x) / self.mbits)
+
     def getBitsSet(self):
-        return filter(lambda i: self.bits[i] == 1, range(len(self.bits)))
+        # Only expand bytes which have at least one bit set.  unpackbits puts
+        # the high bit first, so each row is reversed to little-endian order
+        octets = self.words.view(np.uint8)
+        nz = np.flatnonzero(octets)
+        bits = np.unpackbits(octets[nz][:, None], axis=1)[:, ::-1]
+        rows, cols = np.nonzero(bits)
+        return (nz[rows] * 8 + cols).tolist()
 
-if __name__ == '__main__':
+    def _checkCompatible(self, other):
+        if type(self) is not type(other):
+            raise ValueError("Cannot combine a %s with a %s" %
+                             (type(self).__name__, type(other).__name__))
+        if (self.mbits, self.k, self.seed) != (other.mbits, other.k, other.seed) or \
+           self.hashes != other.hashes:
+            raise ValueError("Bloom filters differ in size or hash functions")
+
+    def _allocate(self):
+        self.words = np.zeros((self.mbits + 63) // 64, dtype='<u8')
+
+    def _storage(self):
+        return self.words
+
+    def _map(self, path, mode, offset):
+        self.words = np.memmap(path, dtype='<u8', mode=mode, offset=offset,
+                               shape=((self.mbits + 63) // 64,))
+
+    def _indexes(self, n):
+        if self.hashes is None:
+            return self._indexes_many([n])[0].tolist()
+        return [hash(n) % self.mbits for hash in self.hashes]
+
+    def _indexes_many(self, keys):
+        # (len(keys), k) array of bit indexes
+        if self.hashes is None:
+            (h1, h2) = self._hashPair(keys)
+            i = np.arange(self.k, dtype=np.uint64)
+            return ((h1[:, None] + h2[:, None] * i) % np.uint64(self.mbits)).astype(np.intp)
+        idx = np.empty((len(keys), self.k), dtype=np.intp)
+        for j, hash in enumerate(self.hashes):
+            idx[:, j] = [hash(key) % self.mbits for key in keys]
+        return idx
+
+    def _hashPair(self, keys):
+        '''
+        Two independent 64-bit hashes per key.  Integer keys are mixed with
+        numpy directly, str/unicode keys go through md5
+        '''
+        if isinstance(keys, np.ndarray) and keys.dtype.kind in 'iu':
+            a = keys.astype(np.uint64)
+            b = a + np.uint64(GOLDEN64)
+        else:
+            keys = list(keys)
+            a = np.empty(len(keys), dtype=np.uint64)
+            b = np.empty(len(keys), dtype=np.uint64)
+            ints = [i for (i, key) in enumerate(keys) if isinstance(key, INTEGER_TYPES)]
+            strs = [i for (i, key) in enumerate(keys) if not isinstance(key, INTEGER_TYPES)]
+            if ints:
+                a[ints] = [int(keys[i]) & MASK64 for i in ints]
+                b[ints] = a[ints] + np.uint64(GOLDEN64)
+            if strs:
+                digests = ''.join(hashlib.md5(self._keyBytes(keys[i])).digest() for i in strs)
+                d = np.frombuffer(digests, dtype='<u8').reshape(-1, 2)
+                a[strs] = d[:, 0]
+                b[strs] = d[:, 1]
+        s = mix64(np.array([self.seed, (self.seed + GOLDEN64) & MASK64], dtype=np.uint64))
+        return (mix64(a ^ s[0]), mix64(b ^ s[1]) | np.uint64(1))
+
+    @staticmethod
+    def _keyBytes(key):
+        if isinstance(key, unicode):
+            return key.encode('utf-8')
+        return bytes(key)
+
+    def _testBit(self, i):
+        return (int(self.words[i >> 6]) >> (i & 63)) & 1 == 1
+
+    def _setBit(self, i):
+        self.words[i >> 6] |= np.uint64(1 << (i & 63))
+
+    def _test(self, idx):
+        # Words are little endian, so bit i lives in byte i >> 3
+        octets = self.words.view(np.uint8)
+        return (octets[idx >> 3] >> (idx & 7).astype(np.uint8)) & 1 == 1
+
+    def _set(self, idx):
+        # One pass per bit position: all writes within a pass store the same
+        # value for a given byte, so duplicate indexes are harmless
+        octets = self.words.view(np.uint8)
+        pos = idx >> 3
+        bit = (idx & 7).astype(np.uint8)
+        for b in xrange(8):
+            octets[pos[bit == b]] |= np.uint8(1 << b)
+
+class CountingBloomFilter(BloomFilter):
+    '''
+    Bloom filter with 4-bit counters instead of bits, packed two to a byte,
+    so keys can be removed.  Counters saturate at 15 and a saturated counter
+    is never decremented again.  union adds counters (saturating) and
+    intersect takes their minimum; bitCount counts non-zero counters.
+    '''
+
+    MAX_COUNT = 15
+    KIND = 1
+
+    def insert(self, n):
+        bitsChanged = []
+        for i in self._indexes(n):
+            if not self._testBit(i):
+                bitsChanged.append(i)
+            self._setBit(i)
+        return bitsChanged
+
+    def remove(self, n):
+        '''
+        Remove n.  Return False, leaving counters untouched, if n is not in
+        the filter
+        '''
+        if not self.contains(n):
+            return False
+        for i in self._indexes(n):
+            c = self._counter(i)
+            if c < self.MAX_COUNT:
+                self._store(i, c - 1)
+        return True
+
+    def remove_many(self, keys):
+        '''
+        Remove every key in keys.  Return boolean array, True where the key
+        was in the filter and has been removed.  A key repeated in the batch
+        is removed once per occurrence while it is still in the filter, as
+        with repeated calls to remove
+        '''
+        idx = self._indexes_many(keys)
+        if idx.shape[0] == 0:
+            return np.zeros(0, dtype=bool)
+        # Rank each key among the earlier occurrences of the same key, and
+        # remove the first occurrences, then the second ones, ...
+        inverse = np.unique(idx, axis=0, return_inverse=True)[1].ravel()
+        order = np.argsort(inverse, kind='mergesort')
+        starts = np.flatnonzero(np.r_[True, np.diff(inverse[order]) != 0])
+        rank = np.empty(len(idx), dtype=np.intp)
+        rank[order] = np.arange(len(idx)) - np.repeat(starts, np.diff(np.r_[starts, len(idx)]))
+        found = np.zeros(len(idx), dtype=bool)
+        for r in xrange(rank.max() + 1):
+            sel = np.flatnonzero(rank == r)
+            ok = self._test(idx[sel]).all(axis=1)
+            found[sel] = ok
+            self._add(idx[sel[ok]].ravel(), -1)
+        return found
+
+    def union(self, other):
+        # Saturating add of the low and of the high nibbles of each byte
+        self._checkCompatible(other)
+        (a, b) = (self.counts, other.counts)
+        low = np.minimum((a & np.uint8(15)) + (b & np.uint8(15)), np.uint8(15))
+        high = np.minimum((a >> np.uint8(4)) + (b >> np.uint8(4)), np.uint8(15))
+        return self._combine(low | (high << np.uint8(4)))
+
+    def intersect(self, other):
+        # Minimum of the low and of the high nibbles of each byte
+        self._checkCompatible(other)
+        (a, b) = (self.counts, other.counts)
+        return self._combine(np.minimum(a & np.uint8(15), b & np.uint8(15)) |
+                             np.minimum(a & np.uint8(0xf0), b & np.uint8(0xf0)))
+
+    def bitCount(self):
+        return int(np.count_nonzero(self.counts & np.uint8(15)) +
+                   np.count_nonzero(self.counts >> np.uint8(4)))
+
+    def getBitsSet(self):
+        # Only split bytes which have a non-zero counter
+        nz = np.flatnonzero(self.counts)
+        counts = self.counts[nz]
+        nonzero = np.column_stack([counts & np.uint8(15), counts >> np.uint8(4)]) != 0
+        return (2 * nz[:, None] + np.arange(2))[nonzero].tolist()
+
+    def _allocate(self):
+        self.counts = np.zeros((self.mbits + 1) // 2, dtype=np.uint8)
+
+    def _storage(self):
+        return self.counts
+
+    def _map(self, path, mode, offset):
+        self.counts = np.memmap(path, dtype=np.uint8, mode=mode, offset=offset,
+                                shape=((self.mbits + 1) // 2,))
+
+    def _combine(self, counts):
+        # New filter over packed counter bytes
+        bf = type(self)(self.mbits, self.hashes or self.k, self.seed)
+        bf.counts[:] = counts
+        return bf
 
-    def createHashFunc(i):
-        def hash(x):
-            return (x*i)%64
-        return hash
+    def _counter(self, i):
+        return (int(self.counts[i >> 1]) >> ((i & 1) << 2)) & 15
 
-    hashes = [createHashFunc(i) for i in xrange(1, 3)]
-    bf = BloomFilter(64, hashes)
+    def _store(self, i, c):
+        shift = (i & 1) << 2
+        self.counts[i >> 1] = (int(self.counts[i >> 1]) & ~(15 << shift) & 0xff) | (c << shift)
+
+    def _testBit(self, i):
+        return self._counter(i) > 0
+
+    def _setBit(self, i):
+        c = self._counter(i)
+        if c < self.MAX_COUNT:
+            self._store(i, c + 1)
+
+    def _counters(self, idx):
+        return (self.counts[idx >> 1] >> ((idx & 1) << 2).astype(np.uint8)) & 15
+
+    def _test(self, idx):
+        return self._counters(idx) > 0
+
+    def _set(self, idx):
+        self._add(idx, 1)
+
+    def _add(self, idx, sign):
+        # Collapse duplicate indexes into one update each, then write even
+        # and odd counters separately so no two writes hit the same byte
+        (idx, n) = np.unique(idx, return_counts=True)
+        old = self._counters(idx).astype(np.int64)
+        new = np.where(old == self.MAX_COUNT, old,
+                       np.clip(old + sign * n, 0, self.MAX_COUNT))
+        for odd in (0, 1):
+            sel = (idx & 1) == odd
+            pos = idx[sel] >> 1
+            shift = 4 * odd
+            keep = self.counts[pos] & np.uint8(0xff ^ (15 << shift))
+            self.counts[pos] = keep | (new[sel].astype(np.uint8) << shift)
+
+class ScalableBloomFilter(object):
+    '''
+    Chain of Bloom filters that grows once the newest filter reaches its
+    design capacity.  Filter i holds capacity * growth^i keys at false
+    positive rate fpRate * (1 - tightening) * tightening^i, so the compound
+    false positive rate stays below fpRate however many filters are added.
+    '''
+
+    def __init__(self, capacity, fpRate, growth=2, tightening=0.5, seed=0):
+        self.capacity = capacity
+        self.fpRate = fpRate
+        self.growth = growth
+        self.tightening = tightening
+        self.seed = seed
+        self.filters = []
+        self.capacities = []
+        self.counts = []
+        self._grow()
+
+    def __len__(self):
+        return sum(self.counts)
+
+    def insert(self, n):
+        if self.contains(n):
+            return []
+        if self.counts[-1] >= self.capacities[-1]:
+            self._grow()
+        self.counts[-1] += 1
+        return self.filters[-1].insert(n)
+
+    def contains(self, n):
+        return any(bf.contains(n) for bf in self.filters)
+
+    def insert_many(self, keys):
+        '''
+        Insert every key in keys.  Return boolean array, True where the key
+        was neither in the filter before the batch nor earlier in the batch,
+        so repeated keys are counted once
+        '''
+        if not isinstance(keys, np.ndarray):
+            keys = list(keys)
+        pending = np.flatnonzero(~self.contains_many(keys))
+        if isinstance(keys, np.ndarray):
+            pending = np.sort(pending[np.unique(keys[pending], return_index=True)[1]])
+        else:
+            seen = set()
+            first = []
+            for i in pending:
+                if keys[i] not in seen:
+                    seen.add(keys[i])
+                    first.append(i)
+            pending = np.array(first, dtype=np.intp)
+        new = np.zeros(len(keys), dtype=bool)
+        new[pending] = True
+        while pending.size > 0:
+            if self.counts[-1] >= self.capacities[-1]:
+                self._grow()
+            room = self.capacities[-1] - self.counts[-1]
+            chunk = pending[:room]
+            added = self.filters[-1].insert_many(self._take(keys, chunk))
+            self.counts[-1] += int(added.sum())
+            pending = pending[room:]
+        return new
+
+    def contains_many(self, keys):
+        found = np.zeros(len(keys), dtype=bool)
+        for bf in self.filters:
+            found |= bf.contains_many(keys)
+        return found
+
+    def _grow(self):
+        i = len(self.filters)
+        capacity = int(self.capacity * self.growth ** i)
+        fpRate = self.fpRate * (1 - self.tightening) * self.tightening ** i
+        self.filters.append(BloomFilter.forCapacity(capacity, fpRate, self.seed + i))
+        self.capacities.append(capacity)
+        self.counts.append(0)
+
+    @staticmethod
+    def _take(keys, positions):
+        if isinstance(keys, np.ndarray):
+            return keys[positions]
+        return [keys[i] for i in positions]
+
+class BloomFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        def createHashFunc(i):
+            def hash(x):
+                return (x*i)%64
+            return hash
+        self.hashes = [createHashFunc(i) for i in xrange(1, 3)]
+        self.bf = BloomFilter(64, self.hashes)
+
+    def test_insert_contains(self):
+        bf = self.bf
+        self.assertFalse(bf.contains(5))
+        self.assertEquals([5, 10], bf.insert(5))
+        self.assertEquals([], bf.insert(5))
+        self.assertTrue(bf.contains(5))
+        self.assertEquals([5, 10], bf.getBitsSet())
+
+    def test_packed_storage(self):
+        bf = BloomFilter(10 ** 6, self.hashes)
+        self.assertEquals(bf.words.nbytes * 8, (10 ** 6 + 63) // 64 * 64)
+
+    def test_batch_matches_single(self):
+        keys = [3, 7, 40, 63]
+        bf = self.bf
+        for key in keys:
+            bf.insert(key)
+        batch = BloomFilter(64, self.hashes)
+        self.assertEquals([True] * 4, batch.insert_many(keys).tolist())
+        self.assertEquals([False] * 4, batch.insert_many(keys).tolist())
+        self.assertEquals(bf.getBitsSet(), batch.getBitsSet())
+        probe = range(64)
+        self.assertEquals([bf.contains(n) for n in probe],
+                          batch.contains_many(probe).tolist())
+
+    def test_optimal_size(self):
+        self.assertEquals((9586, 7), BloomFilter.optimalSize(1000, 0.01))
+        bf = BloomFilter.forCapacity(1000, 0.01)
+        self.assertEquals(9586, bf.mbits)
+        self.assertEquals(7, bf.k)
+
+    def test_double_hashing_keys(self):
+        bf = BloomFilter.forCapacity(100, 0.01, seed=7)
+        bf.insert(42)
+        bf.insert("apple")
+        bf.insert(u"pomme\u00e9")
+        self.assertTrue(bf.contains(42))
+        self.assertTrue(bf.contains("apple"))
+        self.assertTrue(bf.contains(u"pomme\u00e9"))
+        self.assertEquals([True, True, False],
+                          bf.contains_many([42, "apple", "pear"]).tolist())
+        # Integer arrays hash the same as lists of ints
+        keys = [1, 2, 3, -5, 2 ** 40]
+        self.assertEquals(bf._indexes_many(keys).tolist(),
+                          bf._indexes_many(np.array(keys)).tolist())
+
+    def test_numpy_scalar_keys(self):
+        # Scalars taken out of an inserted array hash like the array
+        bf = BloomFilter.forCapacity(100, 0.01)
+        for arr in [np.array([5, 6, 7], dtype=np.int32),
+                    np.array([2 ** 63 + 5, 2 ** 64 - 1], dtype=np.uint64)]:
+            bf.insert_many(arr)
+            self.assertTrue(bf.contains(arr[0]))
+            self.assertTrue(bf.contains_many(list(arr)).all())
+            self.assertTrue(bf.contains(int(arr[-1])))
+
+    def test_false_positive_rate(self):
+        n = 20000
+        bf = BloomFilter.forCapacity(n, 0.01)
+        bf.insert_many(np.arange(n))
+        self.assertTrue(bf.contains_many(np.arange(n)).all())
+        fpRate = bf.contains_many(np.arange(n, 3 * n)).mean()
+        self.assertTrue(fpRate < 0.02)
+
+    def test_union_intersect(self):
+        a = BloomFilter.forCapacity(1000, 0.01)
+        b = BloomFilter.forCapacity(1000, 0.01)
+        a.insert_many(np.arange(0, 600))
+        b.insert_many(np.arange(400, 1000))
+        u = a.union(b)
+        self.assertTrue(u.contains_many(np.arange(1000)).all())
+        i = a.intersect(b)
+        self.assertTrue(i.contains_many(np.arange(400, 600)).all())
+        self.assertTrue(i.contains_many(np.arange(1000, 3000)).mean() < 0.01)
+
+    def test_packed_union_intersect(self):
+        # Nibble-wise results match counter by counter, odd mbits included
+        rnd = np.random.RandomState(3)
+        a = CountingBloomFilter(101, 3)
+        b = CountingBloomFilter(101, 3)
+        a.counts[:] = rnd.randint(0, 256, len(a.counts))
+        b.counts[:] = rnd.randint(0, 256, len(b.counts))
+        a.counts[-1] &= 15
+        b.counts[-1] &= 15
+        everything = np.arange(101)
+        (ca, cb) = (a._counters(everything), b._counters(everything))
+        self.assertEquals(np.minimum(ca.astype(int) + cb, 15).tolist(),
+                          a.union(b)._counters(everything).tolist())
+        self.assertEquals(np.minimum(ca, cb).tolist(),
+                          a.intersect(b)._counters(everything).tolist())
+        self.assertEquals(np.flatnonzero(ca).tolist(), a.getBitsSet())
+        self.assertRaises(ValueError, a.union, BloomFilter.forCapacity(1000, 0.01, seed=1))
+        counting = CountingBloomFilter.forCapacity(1000, 0.01)
+        self.assertRaises(ValueError, a.union, counting)
+        self.assertRaises(ValueError, counting.intersect, a)
+
+    def test_estimate_count(self):
+        bf = BloomFilter.forCapacity(10000, 0.01)
+        self.assertEquals(0, bf.estimateCount())
+        bf.insert_many(np.arange(5000))
+        self.assertTrue(abs(bf.estimateCount() - 5000) < 250)
+
+    def test_save_open(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "bf.bin")
+            bf = BloomFilter.forCapacity(1000, 0.01, seed=-3)
+            bf.insert_many(["a", "b", 17])
+            bf.save(path)
+            mapped = BloomFilter.open(path)
+            self.assertEquals((bf.mbits, bf.k, bf.seed),
+                              (mapped.mbits, mapped.k, mapped.seed))
+            self.assertTrue(isinstance(mapped.words, np.memmap))
+            self.assertEquals([True, True, True, False],
+                              mapped.contains_many(["a", "b", 17, "c"]).tolist())
+            self.assertRaises(ValueError, mapped.insert_many, ["c"])
+            writable = BloomFilter.open(path, 'r+')
+            writable.insert("c")
+            writable.words.flush()
+            self.assertTrue(BloomFilter.open(path).contains("c"))
+            self.assertRaises(ValueError, self.bf.save, path)
+            # Opening maps the file without allocating the bits first
+            allocate = BloomFilter._allocate
+            try:
+                def fail(self):
+                    raise AssertionError("bits allocated")
+                BloomFilter._allocate = fail
+                self.assertTrue(BloomFilter.open(path).contains("c"))
+            finally:
+                BloomFilter._allocate = allocate
+        finally:
+            shutil.rmtree(tmpdir)
+
+class CountingBloomFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.bf = CountingBloomFilter.forCapacity(1000, 0.01)
+
+    def test_insert_remove(self):
+        bf = self.bf
+        self.assertFalse(bf.remove("a"))
+        bf.insert("a")
+        bf.insert("b")
+        bf.insert("a")
+        self.assertTrue(bf.remove("a"))
+        self.assertTrue(bf.contains("a"))
+        self.assertTrue(bf.remove("a"))
+        self.assertFalse(bf.contains("a"))
+        self.assertTrue(bf.contains("b"))
+        self.assertEquals(sorted(set(bf._indexes("b"))), bf.getBitsSet())
+
+    def test_saturation(self):
+        bf = CountingBloomFilter(8, [lambda x: 3])
+        for i in xrange(20):
+            bf.insert(1)
+        self.assertEquals(15, bf._counter(3))
+        bf.remove(1)
+        self.assertEquals(15, bf._counter(3))
+        self.assertEquals(0, bf._counter(2))
+
+    def test_batch(self):
+        bf = self.bf
+        keys = np.arange(500)
+        self.assertTrue(bf.insert_many(keys).all())
+        self.assertTrue(bf.contains_many(keys).all())
+        self.assertTrue(bf.remove_many(keys[:250]).all())
+        self.assertTrue(bf.contains_many(keys[250:]).all())
+        self.assertTrue(bf.contains_many(keys[:250]).mean() < 0.05)
+
+    def test_remove_repeated(self):
+        for seed in xrange(50):
+            bf = CountingBloomFilter.forCapacity(1000, 0.01, seed=seed)
+            bf.insert_many(["a", "b", "c"])
+            bf.insert("c")
+            self.assertEquals([True, False, True, True, False],
+                              bf.remove_many(["a", "a", "c", "c", "c"]).tolist())
+            self.assertTrue(bf.contains("b"))
+            self.assertEquals([False, True, False], bf.contains_many(["a", "b", "c"]).tolist())
+
+    def test_count_union_intersect(self):
+        a = self.bf
+        b = CountingBloomFilter.forCapacity(1000, 0.01)
+        a.insert_many(np.arange(0, 600))
+        b.insert_many(np.arange(400, 1000))
+        self.assertEquals(len(a.getBitsSet()), a.bitCount())
+        self.assertTrue(abs(a.estimateCount() - 600) < 30)
+        u = a.union(b)
+        self.assertTrue(isinstance(u, CountingBloomFilter))
+        self.assertTrue(u.contains_many(np.arange(1000)).all())
+        # Keys in both filters survive one removal from the union
+        self.assertTrue(u.remove_many(np.arange(400, 600)).all())
+        self.assertTrue(u.contains_many(np.arange(400, 600)).all())
+        i = a.intersect(b)
+        self.assertTrue(i.contains_many(np.arange(400, 600)).all())
+        self.assertTrue(i.contains_many(np.arange(1000, 3000)).mean() < 0.01)
+
+    def test_save_open(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "cbf.bin")
+            self.bf.insert_many(["a", "b", "a"])
+            self.bf.save(path)
+            mapped = BloomFilter.open(path, 'r+')
+            self.assertTrue(isinstance(mapped, CountingBloomFilter))
+            self.assertTrue(isinstance(mapped.counts, np.memmap))
+            self.assertTrue(mapped.remove("a"))
+            self.assertTrue(mapped.remove("a"))
+            mapped.counts.flush()
+            reopened = CountingBloomFilter.open(path)
+            self.assertEquals([False, True], reopened.contains_many(["a", "b"]).tolist())
+            BloomFilter.forCapacity(10, 0.01).save(path)
+            self.assertRaises(ValueError, CountingBloomFilter.open, path)
+        finally:
+            shutil.rmtree(tmpdir)
+
+class ScalableBloomFilterTest(unittest.TestCase):
+
+    def test_grows(self):
+        sbf = ScalableBloomFilter(1000, 0.01)
+        keys = np.arange(10000)
+        self.assertTrue(sbf.insert_many(keys).mean() > 0.99)
+        self.assertTrue(len(sbf.filters) > 3)
+        self.assertTrue(all(c <= cap for (c, cap) in zip(sbf.counts, sbf.capacities)))
+        self.assertTrue(sbf.contains_many(keys).all())
+        self.assertTrue(sbf.contains_many(np.arange(10000, 30000)).mean() < 0.01)
+
+    def test_single_inserts(self):
+        sbf = ScalableBloomFilter(2, 0.01)
+        for key in ["a", "b", "c", "d", "e"]:
+            sbf.insert(key)
+        self.assertEquals([], sbf.insert("a"))
+        self.assertEquals(2, len(sbf.filters))
+        self.assertEquals(5, len(sbf))
+        self.assertEquals([True], sbf.insert_many(["f"]).tolist())
+        self.assertEquals([False, True], sbf.insert_many(["f", "g"]).tolist())
+
+    def test_batch_duplicates(self):
+        sbf = ScalableBloomFilter(5, 0.01)
+        self.assertEquals([True] + [False] * 9, sbf.insert_many(["a"] * 10).tolist())
+        self.assertEquals(1, len(sbf))
+        self.assertEquals([True, True, False, True, False],
+                          sbf.insert_many(np.array([7, 8, 7, 9, 8])).tolist())
+        self.assertEquals(4, len(sbf))
+        self.assertEquals(1, len(sbf.filters))
+
+if __name__ == '__main__':
+
+    bf = BloomFilter(64, 2)
 
     while True:
         input = raw_input("[r]eset, [g]et bits set, [i]nsert, [c]ontains:")
@@ -38,22 +747,17 @@ if __name__ == '__main__':
             continue
         cmd = input[0]
         if cmd == 'r':
-            bf = BloomFilter(32, hashes)
+            bf = BloomFilter(64, 2)
             print "Cleared"
         elif cmd == 'g':
             print "Bits set", bf.getBitsSet()
         else:
             try:
-                n = int((input.split())[1])
+                key = (input.split())[1]
+                n = int(key) if key.lstrip('-').isdigit() else key
                 if cmd == 'i':
                     print "Inserting", n, ":", bf.insert(n)
                 elif cmd == 'c':
                     print "Contains", n, ":", bf.contains(n)
             except:
-                print "Bad number argument... ignoring"
-                
-            
-        
-    
-
-    
+                print "Bad key argument... ignoring"
@@ -1,4 +1,5 @@
 from vectorclock import VectorClock
+from markstore import MarkStore, putMark
 import unittest
 
 class ChandyLamport(object):
@@ -6,15 +7,16 @@ class ChandyLamport(object):
     Classic Chandy Lamport global state snapshot algorithm
     '''
 
-    def __init__(self, vclock):
+    def __init__(self, vclock, sendFrom=None):
         self.vclock = vclock
+        self.sendFrom = sendFrom if sendFrom is not None else MarkStore()
         self.clear()
 
     def clear(self):
         self.state = {}
         self.recording = {}
         self.channels = {}
-        self.sendFrom = {}
+        self.sendFrom.clear()
 
     def getGlobalState(self):
         return (self.state, self.channels)
@@ -53,13 +55,13 @@ class ChandyLamport(object):
             for p in self._allProcsExcept(i):
                 self._sendMarker(i, p)
 
-    def halfSend(self, fromProc, mark):
-        self.vclock.halfSend(fromProc, mark)
-        self.sendFrom[mark] = fromProc
+    def halfSend(self, fromProc, mark, receivers=None):
+        self.vclock.halfSend(fromProc, mark, receivers)
+        putMark(self.sendFrom, mark, fromProc, receivers)
 
     def halfRecv(self, toProc, mark):
         self.vclock.halfRecv(toProc, mark)
-        fromProc = self.sendFrom[mark]
+        fromProc = self.sendFrom.consume(mark)
         channel = (fromProc, toProc)
         if channel in self.recording:
             self.recording[channel].append(mark)
@@ -1,83 +1,444 @@
 import unittest
 import bisect
+import random
+import numpy as np
+from collections import OrderedDict
+
+MASK64 = (1 << 64) - 1
+GOLDEN64 = 0x9e3779b97f4a7c15
+
+def _mix64(z):
+    # splitmix64 finalizer on a python int
+    z = ((z ^ (z >> 30)) * 0xbf58476d1ce4e5b9) & MASK64
+    z = ((z ^ (z >> 27)) * 0x94d049bb133111eb) & MASK64
+    return z ^ (z >> 31)
 
 class Chord(object):
+    '''
+    Chord ring over m-bit ids.  Peers may join and leave after construction.
+    By default every affected finger entry is updated on join/leave.  With
+    stabilization=True only successor pointers are kept exact; the other
+    fingers go stale and are repaired a column per fix_fingers() call, as
+    the periodic fix_fingers of the real protocol does.
+    Each address is placed on the ring as vnodes virtual peers.
+    If route_cache > 0, the last route_cache search paths are kept in an
+    LRU cache keyed by (start node, owner), cleared whenever the ring or a
+    finger table changes.
+    Ids of up to 64 bits are kept in integer arrays; for larger m, such as
+    the 160-bit ids of real Chord, the arrays hold Python ints (object
+    dtype), which works the same but slower.
+    '''
 
-    def __init__(self, hash_func, m, addresses):
+    def __init__(self, hash_func, m, addresses, stabilization=False, vnodes=1,
+                 route_cache=0):
         self.m = m
         self.hash_func = hash_func
-        # Calculate peer ring
-        self._peers = [self._compute_peer_id(addr) for addr in addresses]
+        self.stabilization = stabilization
+        self.vnodes = vnodes
+        self.route_cache = route_cache
+        self._routes = OrderedDict()
+        # Bumped on every join/leave; _ring() is cached per version
+        self.version = 0
+        self._ring_cache = (None, None)
+        # Calculate peer ring, remembering the address behind each peer
+        self._owner = {}
+        for addr in addresses:
+            for peer in self._compute_peer_ids(addr):
+                self._owner[peer] = addr
+        self._peers = [peer for addr in addresses for peer in self._compute_peer_ids(addr)]
         self._peers.sort()
-        # Calculate finger table for each peer
-        finger_tbl = {}
-        for peer in self._peers:
-            tbl = self._compute_finger_table(peer)
-            finger_tbl[peer] = tbl
-        self._finger_tbl = finger_tbl
+        # Calculate finger table for each peer.  Finger tables are rows of
+        # the finger array; _rows[i] is the row of the i-th peer on the ring
+        self._fingers = self._compute_finger_tables(self._ring())
+        self._rows = range(len(self._peers))
+        self._free_rows = []
+        self._used_rows = len(self._peers)
+        self._next_finger = 1
 
     def _compute_peer_id(self, address):
         # Perform consistent hash on node's peer address (IP + port)
         return self.hash_func(address) % (2 ** self.m)
-        
-    def _compute_finger_table(self, peer):
+
+    def _compute_peer_ids(self, address):
+        # Virtual node j > 0 is placed by mixing the address's peer id with j
+        peer = self._compute_peer_id(address)
+        return [peer] + [self._vnode_id(peer, j) for j in xrange(1, self.vnodes)]
+
+    def _vnode_id(self, peer, j):
+        # One mixed 64-bit word per 64 bits of id, each word chained into
+        # the next, so ids wider than 64 bits are spread over the whole ring
+        value = 0
+        word = 0
+        for w in xrange((self.m + 63) // 64):
+            word = _mix64(((peer >> (64 * w)) + j * GOLDEN64 + word) & MASK64)
+            value = (value << 64) | word
+        return value % (2 ** self.m)
+
+    def address_of(self, peer):
+        return self._owner[peer]
+
+    def _id_dtype(self):
+        # Smallest dtype holding every id (signed, so tolist gives plain ints)
+        if self.m <= 31:
+            return np.int32
+        if self.m <= 63:
+            return np.int64
+        return np.uint64 if self.m <= 64 else object
+
+    def _ring_dtype(self):
+        # Unsigned, so ring arithmetic wraps modulo 2^64
+        return np.uint64 if self.m <= 64 else object
+
+    def _id(self, value):
+        # Scalar to combine with ring arrays
+        return np.uint64(value) if self.m <= 64 else value
+
+    def _ids(self, values):
+        return np.array(values, dtype=self._ring_dtype())
+
+    def _ring(self):
+        (version, ring) = self._ring_cache
+        if version != self.version:
+            ring = self._ids(self._peers)
+            ring.flags.writeable = False
+            self._ring_cache = (self.version, ring)
+        return ring
+
+    def _compute_finger_tables(self, ring):
         # i-th entry at peer with id n is first peer with
-        # id >= (n + 2^i) % 2^m
-        m = 2 ** (self.m)
-        return [self.find_next_larger((peer + 2 ** i) % m) for i in xrange(self.m)]
+        # id >= (n + 2^i) % 2^m.  Computed one finger column at a time for
+        # all peers with a single searchsorted over the sorted ring
+        fingers = np.empty((len(ring), self.m), dtype=self._id_dtype())
+        for i in xrange(self.m):
+            fingers[:, i] = self._finger_column(ring, i)
+        return fingers
+
+    def _finger_column(self, ring, i):
+        mask = self._id(2 ** self.m - 1)
+        pos = np.searchsorted(ring, (ring + self._id(2 ** i)) & mask)
+        pos[pos == len(ring)] = 0
+        return ring[pos]
+
+    def join(self, address):
+        '''
+        Add the peers of address (one per virtual node) to the ring.  Return
+        the peer id of its first virtual node.  Each peer costs O(m log n)
+        lookups for its own finger table and the fingers it takes over,
+        plus an O(n) insert into the sorted peer and row lists (a memmove,
+        about a millisecond at 10^6 peers)
+        '''
+        ids = self._compute_peer_ids(address)
+        for peer in ids:
+            if self._is_peer(peer):
+                raise ValueError("Peer %d already on ring" % peer)
+        for peer in ids:
+            self._join_peer(peer)
+            self._owner[peer] = address
+        self._routes.clear()
+        self.version += 1
+        return ids[0]
+
+    def _join_peer(self, peer):
+        peers = self._peers
+        pos = bisect.bisect_left(peers, peer)
+        pred = peers[pos - 1] if peers else None
+        peers.insert(pos, peer)
+        row = self._alloc_row()
+        self._rows.insert(pos, row)
+        if pred is not None:
+            if self.stabilization:
+                # New peer notifies its predecessor
+                self._fingers[self._row_of(pred), 0] = peer
+            else:
+                # Fingers whose target fell in (pred, peer] now point at peer
+                self._set_fingers_between(pred, peer, peer)
+        # Joining peer builds its own finger table by lookups
+        m = 2 ** self.m
+        self._fingers[row] = [self.find_next_larger((peer + 2 ** i) % m)
+                              for i in xrange(self.m)]
+
+    def leave(self, peer):
+        '''
+        Remove peer from the ring.  Costs O(m log n) to repoint the fingers
+        which named it, plus an O(n) delete from the sorted peer and row
+        lists
+        '''
+        peers = self._peers
+        pos = bisect.bisect_left(peers, peer)
+        if pos == len(peers) or peers[pos] != peer:
+            raise KeyError(peer)
+        pred = peers[pos - 1]
+        succ = peers[(pos + 1) % len(peers)]
+        del peers[pos]
+        self._free_rows.append(self._rows.pop(pos))
+        self._owner.pop(peer, None)
+        self._routes.clear()
+        self.version += 1
+        if not peers:
+            return
+        if self.stabilization:
+            # Leaving peer hands its successor to its predecessor
+            self._fingers[self._row_of(pred), 0] = succ
+        else:
+            # Fingers which pointed at peer now point at its successor
+            self._set_fingers_between(pred, peer, succ)
+
+    def leave_address(self, address):
+        '''
+        Remove every virtual peer of address from the ring
+        '''
+        for peer in self._compute_peer_ids(address):
+            if self._is_peer(peer):
+                self.leave(peer)
+
+    def load_report(self, keys=None, hashed=False):
+        '''
+        Key ownership per address, computed in one pass over the sorted
+        ring.  share is the fraction of the id space each address owns; if
+        keys are given, keys counts the keys each address owns.  mean, max,
+        variance and max_mean_ratio describe keys if given, share otherwise
+        '''
+        ring = self._ring()
+        addresses = []
+        index = {}
+        owner = np.empty(len(ring), dtype=np.intp)
+        for (i, peer) in enumerate(self._peers):
+            addr = self._owner[peer]
+            if addr not in index:
+                index[addr] = len(addresses)
+                addresses.append(addr)
+            owner[i] = index[addr]
+        # Peer i owns the ids between its predecessor and itself
+        arc = ((ring - np.roll(ring, 1)) & self._id(2 ** self.m - 1)).astype(np.float64)
+        if len(ring) == 1:
+            arc[:] = 2.0 ** self.m
+        report = {'addresses': addresses,
+                  'share': np.bincount(owner, weights=arc, minlength=len(addresses)) / 2.0 ** self.m}
+        load = report['share']
+        if keys is not None:
+            ids = self._ids(keys if hashed else [self.hash_func(key) for key in keys])
+            pos = np.searchsorted(ring, ids, 'right')
+            pos[pos == len(ring)] = 0
+            load = report['keys'] = np.bincount(owner[pos], minlength=len(addresses))
+        mean = load.mean()
+        report['mean'] = mean
+        report['max'] = load.max()
+        report['variance'] = load.var()
+        report['max_mean_ratio'] = load.max() / mean if mean > 0 else float('inf')
+        return report
+
+    def fix_fingers(self):
+        '''
+        Refresh the next finger entry, round-robin, at every peer.  Return
+        the finger index refreshed
+        '''
+        i = self._next_finger
+        self._next_finger = i % (self.m - 1) + 1 if self.m > 1 else 1
+        if i < self.m and self._peers:
+            rows = np.array(self._rows)
+            self._fingers[rows, i] = self._finger_column(self._ring(), i)
+            self._routes.clear()
+        return i
+
+    def _set_fingers_between(self, pred, peer, value):
+        # Finger i of q targets q + 2^i, which lies in (pred, peer] exactly
+        # when q is in (pred - 2^i, peer - 2^i]
+        m = 2 ** self.m
+        for i in xrange(self.m):
+            pos = self._positions_between((pred - 2 ** i) % m, (peer - 2 ** i) % m)
+            if pos:
+                self._fingers[[self._rows[p] for p in pos], i] = value
+
+    def _positions_between(self, lo, hi):
+        # Ring positions of peers with id in (lo, hi], wrapping past 2^m
+        peers = self._peers
+        start = bisect.bisect_right(peers, lo)
+        end = bisect.bisect_right(peers, hi)
+        if lo < hi:
+            return range(start, end)
+        return range(start, len(peers)) + range(end)
+
+    def _alloc_row(self):
+        if self._free_rows:
+            return self._free_rows.pop()
+        if self._used_rows == len(self._fingers):
+            grown = np.empty((max(16, 2 * len(self._fingers)), self.m), dtype=self._fingers.dtype)
+            grown[:self._used_rows] = self._fingers
+            self._fingers = grown
+        self._used_rows += 1
+        return self._used_rows - 1
+
+    def _row_of(self, peer):
+        pos = bisect.bisect_left(self._peers, peer)
+        if pos == len(self._peers) or self._peers[pos] != peer:
+            raise KeyError(peer)
+        return self._rows[pos]
+
+    def _is_peer(self, peer):
+        pos = bisect.bisect_left(self._peers, peer)
+        return pos < len(self._peers) and self._peers[pos] == peer
+
+    def _live_fingers(self, node):
+        fingers = self.finger_table(node)
+        if self.stabilization:
+            # Stale fingers may name peers which have left
+            fingers = [f for f in fingers if self._is_peer(f)] or [self.successor(node)]
+        return fingers
+
+    def finger_table(self, peer):
+        return self._finger_row(peer).tolist()
+
+    def _finger_row(self, peer):
+        return self._fingers[self._row_of(peer)]
 
     def find_next_larger(self, peer):
-        for p in self._peers:
-            if p >= peer:
-                return p
+        pos = bisect.bisect_left(self._peers, peer)
+        if pos < len(self._peers):
+            return self._peers[pos]
         return self._peers[0]
 
     def query(self, node, key, node_list = None):
         # Hash the key
         key = self.hash_func(key)
         # Find node which has the key
-        pos = bisect.bisect(self._peers, key)
-        if pos < len(self._peers):
-            key_at_node = self._peers[pos]
-        else:
-            key_at_node = self._peers[0]
+        key_at_node = self._key_owner(key)
         # See if path to find node is needed.  If so, compute it
         if node_list != None:
             self._compute_search_path(node, key_at_node, node_list)
         return key_at_node
 
+    def query_many(self, start_nodes, keys, hashed=False, stats=False, chunk=65536):
+        '''
+        Owner peer of every key.  With hashed=True keys are already ring
+        ids; otherwise hash_func is called once per key, so pass ids to
+        keep large batches in numpy.  Owners are found by one searchsorted
+        over the ring and do not depend on where a query starts, so
+        start_nodes (a peer or an array of peers, one per key) is only used
+        with stats=True: all queries are then routed together one hop at a
+        time, and a dict of per-key hops (messages sent), path_lengths
+        (nodes on the path, as in query's node_list) and their histograms
+        is returned too.  A start which is not a peer raises KeyError
+        '''
+        ids = self._ids(keys if hashed else map(self.hash_func, keys))
+        ring = self._ring()
+        pos = np.searchsorted(ring, ids, 'right')
+        pos[pos == len(ring)] = 0
+        owners = ring[pos].astype(self._fingers.dtype)
+        if not stats:
+            return owners
+        starts = np.empty(len(owners), dtype=owners.dtype)
+        starts[:] = start_nodes
+        at = np.minimum(np.searchsorted(ring, starts.astype(ring.dtype)), len(ring) - 1)
+        stray = np.flatnonzero(ring[at] != starts.astype(ring.dtype))
+        if stray.size > 0:
+            raise KeyError(int(starts[stray[0]]))
+        hops = np.empty(len(owners), dtype=np.int64)
+        for lo in xrange(0, len(owners), chunk):
+            hops[lo:lo + chunk] = self._count_hops(ring, starts[lo:lo + chunk],
+                                                   owners[lo:lo + chunk])
+        lengths = hops + 1
+        return owners, {'hops': hops,
+                        'path_lengths': lengths,
+                        'hop_histogram': np.bincount(hops),
+                        'path_length_histogram': np.bincount(lengths)}
+
+    def _count_hops(self, ring, cur, final):
+        # Same next-hop rule as _compute_search_path, applied to every
+        # unfinished query at once
+        rows = np.array(self._rows)
+        mask = self._id(2 ** self.m - 1)
+        dtype = self._ring_dtype()
+        cur = cur.copy()
+        hops = np.zeros(len(cur), dtype=np.int64)
+        active = np.flatnonzero(cur != final)
+        for step in xrange(len(ring) + 1):
+            if active.size == 0:
+                return hops
+            here = cur[active].astype(dtype)
+            fingers = self._fingers[rows[np.searchsorted(ring, here)]]
+            ids = fingers.astype(dtype)
+            # Clockwise distance of each finger and of the owner
+            dist = (ids - here[:, None]) & mask
+            ok = dist <= ((final[active].astype(dtype) - here) & mask)[:, None]
+            if self.stabilization:
+                ok &= ring[np.minimum(np.searchsorted(ring, ids), len(ring) - 1)] == ids
+            best = np.argmax(np.where(ok, dist, 0), axis=1)
+            nxt = fingers[np.arange(len(active)), best]
+            cur[active] = nxt
+            hops[active] += 1
+            active = active[nxt != final[active]]
+        raise RuntimeError("Routing did not reach the owner peer")
+
+    def _key_owner(self, key):
+        pos = bisect.bisect(self._peers, key)
+        if pos < len(self._peers):
+            return self._peers[pos]
+        return self._peers[0]
+
     def _compute_search_path(self, start_node, final_node, node_list):
-        # If start node is final node, done
-        if final_node == start_node:
-            node_list.append(start_node)
-            return
-        finger_tbl = self._finger_tbl[start_node]
-        fingers = filter(lambda i: i <= final_node, finger_tbl)
-        if len(fingers) > 0:
-            new_start_node = max(fingers)
+        if self.route_cache > 0:
+            route = (start_node, final_node)
+            path = self._routes.pop(route, None)
+            if path is None:
+                path = self._search_path(start_node, final_node)
+                if len(self._routes) >= self.route_cache:
+                    self._routes.popitem(last=False)
+            self._routes[route] = path
+            node_list.extend(path)
         else:
-            new_start_node = finger_tbl[-1]
-        node_list.append(start_node)
-        self._compute_search_path(new_start_node, final_node, node_list)
+            node_list.extend(self._search_path(start_node, final_node))
+
+    def _search_path(self, start_node, final_node):
+        path = [start_node]
+        node = start_node
+        # A lookup visits each peer at most once
+        for hop in xrange(len(self._peers)):
+            if node == final_node:
+                return path
+            node = self._next_hop(node, final_node)
+            path.append(node)
+        if node == final_node:
+            return path
+        raise RuntimeError("Routing did not reach the owner peer")
+
+    def _next_hop(self, node, final_node):
+        '''
+        Finger of node furthest around the ring which does not pass
+        final_node
+        '''
+        m = 2 ** self.m
+        if self.stabilization:
+            # Stale finger tables need not be in ring order, so scan them
+            dist = lambda f: (f - node) % m
+            fingers = [f for f in self._live_fingers(node) if dist(f) <= dist(final_node)]
+            return max(fingers, key=dist) if fingers else self.successor(node)
+        # Fingers are in ring order starting after node: ids above node
+        # ascending, then ids at or below node (wrapped) ascending
+        row = self._finger_row(node).tolist()
+        lo, hi = 0, len(row)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if row[mid] > node:
+                lo = mid + 1
+            else:
+                hi = mid
+        wrap = lo
+        if final_node > node:
+            return row[bisect.bisect_right(row, final_node, 0, wrap) - 1]
+        j = bisect.bisect_right(row, final_node, wrap, len(row)) - 1
+        return row[j] if j >= wrap else row[wrap - 1]
 
     def _query_helper(self, node, key, node_list):
         '''
-        At node n, query for key.
-        Find largest successor/finger entry <= k.  If none exists, send query to successor(n)
+        At node n, query for key.  Forward to the finger furthest around the
+        ring which does not pass the key's owner until the owner is reached
         '''
         # Done if node has key
         if self.contains(node, key):
             return node
-        # Find largest finger entry <= key
-        fingers = [f for f in self._finger_tbl[node] if f <= key]
-        # If none exists, send query to successor
-        if len(fingers) == 0:
-            next_node = self.successor(node)
-        # otherwise, send query to largest finger entry <= key
-        else:
-            next_node = max(fingers)
-        node_list.append(next_node)
-        return self._query_helper(next_node, key, node_list)
+        path = self._search_path(node, self._key_owner(key))
+        node_list.extend(path[1:])
+        return path[-1]
 
     def contains(self, node, key):
         if key == node:
@@ -94,11 +455,11 @@ class Chord(object):
 
     def successor(self, node):
         peers = self._peers
-        for i in xrange(len(peers) - 1):
-            if peers[i] == node:
-                return peers[i+1]
+        pos = bisect.bisect_left(peers, node)
+        if pos < len(peers) - 1 and peers[pos] == node:
+            return peers[pos + 1]
         return peers[0]
-        
+
 
 class ChordTest(unittest.TestCase):
 
@@ -109,8 +470,21 @@ class ChordTest(unittest.TestCase):
         self.assertEquals([16, 32, 45, 80, 96, 112], self.chord._peers)
 
     def test_finger_tbl(self):
-        tbl = self.chord._finger_tbl[80]
+        tbl = self.chord.finger_table(80)
         self.assertEquals(tbl, [96, 96, 96, 96, 96, 112, 16])
+        self.assertRaises(KeyError, self.chord.finger_table, 81)
+
+    def test_finger_tbl_matches_scan(self):
+        m = 16
+        addresses = random.sample(xrange(2 ** m), 300)
+        ch = Chord(lambda x: x, m, addresses)
+        peers = ch._peers
+        def next_larger(n):
+            return ([p for p in peers if p >= n] or peers[:1])[0]
+        for peer in peers[::7]:
+            expected = [next_larger((peer + 2 ** i) % 2 ** m) for i in xrange(m)]
+            self.assertEquals(expected, ch.finger_table(peer))
+        self.assertEquals(peers[0], ch.find_next_larger(peers[-1] + 1))
 
     def test_successor(self):
         ch = self.chord
@@ -118,6 +492,189 @@ class ChordTest(unittest.TestCase):
         self.assertEquals(80, ch.successor(45))
         self.assertEquals(96, ch.successor(80))
         self.assertEquals(16, ch.successor(112))
+        self.assertEquals(16, ch.successor(33))
+
+    def assertSameFingers(self, ch, addresses):
+        fresh = Chord(lambda x: x, ch.m, addresses)
+        self.assertEquals(fresh._peers, ch._peers)
+        for peer in fresh._peers:
+            self.assertEquals(fresh.finger_table(peer), ch.finger_table(peer))
+
+    def test_join_leave(self):
+        ch = self.chord
+        addresses = [32, 45, 80, 96, 112, 16]
+        self.assertEquals(100, ch.join(100))
+        self.assertSameFingers(ch, addresses + [100])
+        self.assertRaises(ValueError, ch.join, 100)
+        ch.leave(45)
+        self.assertSameFingers(ch, [32, 80, 96, 100, 112, 16])
+        ch.leave(16)
+        ch.join(0)
+        self.assertSameFingers(ch, [0, 32, 80, 96, 100, 112])
+        self.assertRaises(KeyError, ch.leave, 45)
+
+    def test_churn(self):
+        m = 12
+        addresses = random.sample(xrange(2 ** m), 200)
+        ch = Chord(lambda x: x, m, addresses[:100])
+        live = set(addresses[:100])
+        for addr in addresses[100:]:
+            ch.join(addr)
+            live.add(addr)
+            gone = random.choice(sorted(live))
+            ch.leave(gone)
+            live.remove(gone)
+        self.assertSameFingers(ch, list(live))
+
+    def test_stabilization(self):
+        ch = Chord(lambda x: x, 7, [32, 45, 80, 96, 112, 128 + 16], stabilization=True)
+        ch.join(100)
+        ch.leave(112)
+        self.assertEquals(100, ch.successor(96))
+        self.assertEquals(100, ch.finger_table(96)[0])
+        # Stale fingers are skipped while routing
+        self.assertEquals(112, ch.finger_table(80)[5])
+        node_list = []
+        self.assertEquals(16, ch.query(80, 12, node_list))
+        self.assertEquals(16, node_list[-1])
+        for i in xrange(ch.m - 1):
+            ch.fix_fingers()
+        self.assertSameFingers(ch, [16, 32, 45, 80, 96, 100])
+
+    def test_query_many(self):
+        m = 14
+        ch = Chord(lambda x: x, m, random.sample(xrange(2 ** m), 500))
+        keys = [random.randrange(2 ** m) for i in xrange(300)]
+        starts = [random.choice(ch._peers) for key in keys]
+        owners, stats = ch.query_many(starts, keys, stats=True)
+        for (start, key, owner, hops) in zip(starts, keys, owners, stats['hops']):
+            node_list = []
+            self.assertEquals(ch.query(start, key, node_list), owner)
+            self.assertEquals(len(node_list) - 1, hops)
+        self.assertEquals(owners.tolist(), ch.query_many(starts[0], np.array(keys), hashed=True).tolist())
+        self.assertEquals(len(keys), stats['hop_histogram'].sum())
+        self.assertEquals(stats['hops'].tolist(), (stats['path_lengths'] - 1).tolist())
+        # Starts must be peers; without stats they are not looked at
+        stray = [p + 1 for p in ch._peers if not ch._is_peer(p + 1)][0]
+        self.assertRaises(KeyError, ch.query_many, [stray] + starts[1:], keys, stats=True)
+        self.assertEquals(owners.tolist(), ch.query_many(stray, keys).tolist())
+
+    def test_query_many_stale(self):
+        ch = Chord(lambda x: x, 7, [32, 45, 80, 96, 112, 128 + 16], stabilization=True)
+        ch.join(100)
+        ch.leave(112)
+        ch.leave(45)
+        keys = range(128)
+        owners, stats = ch.query_many(80, keys, stats=True)
+        for (key, owner, hops) in zip(keys, owners, stats['hops']):
+            node_list = []
+            self.assertEquals(ch.query(80, key, node_list), owner)
+            self.assertEquals(len(node_list) - 1, hops)
+
+    def test_vnodes(self):
+        ch = Chord(lambda x: x, 16, [100, 2000, 30000], vnodes=4)
+        self.assertEquals(12, len(ch._peers))
+        self.assertIn(100, ch._peers)
+        self.assertEquals(2000, ch.address_of(2000))
+        self.assertEquals(4, len([p for p in ch._peers if ch.address_of(p) == 30000]))
+        ch.join(5000)
+        self.assertEquals(16, len(ch._peers))
+        self.assertRaises(ValueError, ch.join, 5000)
+        ch.leave_address(2000)
+        self.assertEquals(12, len(ch._peers))
+        fresh = Chord(lambda x: x, 16, [100, 30000, 5000], vnodes=4)
+        self.assertEquals(fresh._peers, ch._peers)
+        for peer in fresh._peers:
+            self.assertEquals(fresh.finger_table(peer), ch.finger_table(peer))
+
+    def test_load_report(self):
+        report = self.chord.load_report()
+        self.assertEquals([144, 32, 45, 80, 96, 112], report['addresses'])
+        self.assertAlmostEquals(1.0, report['share'].sum())
+        self.assertAlmostEquals(32.0 / 128, report['share'][0])
+        report = self.chord.load_report(keys=range(128))
+        self.assertEquals(128, report['keys'].sum())
+        # Keys equal to a peer id belong to the next peer, as in query
+        self.assertEquals([32, 16, 13, 35, 16, 16], report['keys'].tolist())
+        self.assertAlmostEquals(35.0 / (128.0 / 6), report['max_mean_ratio'])
+        # More virtual nodes even out ownership
+        rnd = random.Random(5)
+        addresses = rnd.sample(xrange(2 ** 32), 200)
+        skew = [Chord(lambda x: x, 32, addresses, vnodes=v).load_report()['max_mean_ratio']
+                for v in (1, 64)]
+        self.assertTrue(skew[1] < skew[0])
+        self.assertTrue(skew[1] < 1.5)
+        # Also with ids wider than the 64-bit mixer
+        addresses = [rnd.getrandbits(160) for i in xrange(50)]
+        wide = [Chord(lambda x: x, 160, addresses, vnodes=v) for v in (1, 16)]
+        self.assertTrue(all(p >= 2 ** 64 for p in wide[1]._peers))
+        skew = [ch.load_report()['max_mean_ratio'] for ch in wide]
+        self.assertTrue(skew[1] < skew[0] / 2)
+
+    def test_iterative_path(self):
+        m = 20
+        ch = Chord(lambda x: x, m, random.sample(xrange(2 ** m), 2000))
+        expected = Chord(lambda x: x, m, ch._peers, stabilization=True)
+        for i in xrange(200):
+            start = random.choice(ch._peers)
+            key = random.randrange(2 ** m)
+            path, stale_path = [], []
+            self.assertEquals(ch.query(start, key, path),
+                              expected.query(start, key, stale_path))
+            self.assertEquals(stale_path, path)
+        node_list = []
+        self.assertEquals(45, self.chord._query_helper(80, 42, node_list))
+        self.assertEquals([16, 32, 45], node_list)
+
+    def test_route_cache(self):
+        ch = Chord(lambda x: x, 7, [32, 45, 80, 96, 112, 128 + 16], route_cache=2)
+        node_list = []
+        ch.query(80, 42, node_list)
+        self.assertEquals([(80, 45)], ch._routes.keys())
+        ch.query(80, 90)
+        ch.query(96, 42, [])
+        ch.query(16, 42, [])
+        self.assertEquals([(96, 45), (16, 45)], ch._routes.keys())
+        node_list = []
+        ch.query(96, 42, node_list)
+        self.assertEquals([(16, 45), (96, 45)], ch._routes.keys())
+        self.assertEquals([96, 32, 45], node_list)
+        # Ring changes drop cached routes
+        ch.join(40)
+        self.assertEquals([], ch._routes.keys())
+        node_list = []
+        self.assertEquals(40, ch.query(96, 39, node_list))
+        self.assertEquals([96, 32, 40], node_list)
+
+    def test_wide_ids(self):
+        # Ids wider than 64 bits, as with SHA-1 ids
+        for m in (80, 160):
+            rnd = random.Random(m)
+            addresses = [rnd.getrandbits(m) for i in xrange(300)]
+            ch = Chord(lambda x: x, m, addresses)
+            peers = ch._peers
+            def next_larger(n):
+                return ([p for p in peers if p >= n] or peers[:1])[0]
+            for peer in peers[::31]:
+                expected = [next_larger((peer + 2 ** i) % 2 ** m) for i in xrange(m)]
+                self.assertEquals(expected, ch.finger_table(peer))
+            keys = [rnd.getrandbits(m) for i in xrange(100)]
+            starts = [rnd.choice(peers) for key in keys]
+            owners, stats = ch.query_many(starts, keys, stats=True)
+            for (start, key, owner, hops) in zip(starts, keys, owners, stats['hops']):
+                node_list = []
+                self.assertEquals(ch.query(start, key, node_list), owner)
+                self.assertEquals(len(node_list) - 1, hops)
+            new = rnd.getrandbits(m)
+            ch.join(new)
+            ch.leave(peers[5])
+            self.assertEquals(new, ch.find_next_larger(new))
+            self.assertAlmostEquals(1.0, ch.load_report(keys=keys)['share'].sum())
+
+    def test_large_ring(self):
+        ch = Chord(lambda x: x, 32, random.sample(xrange(2 ** 32), 50000))
+        self.assertEquals((50000, 32), ch._fingers.shape)
+        self.assertEquals(ch.successor(ch._peers[0]), ch.finger_table(ch._peers[0])[0])
         
     def test_query(self):
         ch = self.chord
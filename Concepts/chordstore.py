@@ -0,0 +1,451 @@
+from chord import Chord
+import unittest
+import bisect
+import numpy as np
+
+class NodeStore(object):
+    '''
+    Keys held by one peer, as a sorted array of key ids (uint64, or Python
+    ints for rings wider than 64 bits) with the values and the sequence
+    number of the write that stored each value in parallel arrays
+    '''
+
+    def __init__(self, dtype=np.uint64):
+        self.keys = np.zeros(0, dtype=dtype)
+        self.values = np.zeros(0, dtype=object)
+        self.seqs = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def merge(self, keys, values, seqs):
+        # The highest sequence number wins, both within the batch and over
+        # stored entries; on a tie the later batch entry wins.  Only the
+        # batch is sorted; it is then inserted in one pass
+        order = np.argsort(seqs, kind='mergesort')
+        order = order[np.argsort(keys[order], kind='mergesort')]
+        keys = keys[order]
+        last = np.ones(len(keys), dtype=bool)
+        last[:-1] = keys[1:] != keys[:-1]
+        (keys, values, seqs) = (keys[last], values[order][last], seqs[order][last])
+        pos = np.searchsorted(self.keys, keys)
+        stored = np.zeros(len(keys), dtype=bool)
+        inside = pos < len(self.keys)
+        stored[inside] = self.keys[pos[inside]] == keys[inside]
+        newer = stored.copy()
+        newer[stored] = seqs[stored] >= self.seqs[pos[stored]]
+        self.values[pos[newer]] = values[newer]
+        self.seqs[pos[newer]] = seqs[newer]
+        self.keys = np.insert(self.keys, pos[~stored], keys[~stored])
+        self.values = np.insert(self.values, pos[~stored], values[~stored])
+        self.seqs = np.insert(self.seqs, pos[~stored], seqs[~stored])
+
+    def lookup(self, keys):
+        '''
+        Return (found, values) for an array of key ids
+        '''
+        pos = np.minimum(np.searchsorted(self.keys, keys), max(len(self.keys) - 1, 0))
+        found = np.zeros(len(keys), dtype=bool)
+        if len(self.keys) > 0:
+            found = self.keys[pos] == keys
+        values = np.empty(len(keys), dtype=object)
+        values[found] = self.values[pos[found]]
+        return (found, values)
+
+class ChordStore(object):
+    '''
+    Replicated key/value layer over a Chord ring.  Each key is stored on
+    its owner and the next r successors belonging to other addresses.
+    Every write carries a store-wide sequence number and a replica only
+    ever replaces a value by a newer one.
+    Peers can fail and recover without touching the ring: writes to a
+    failed replica are kept as hints and handed to it when it recovers, and
+    reads go to the nearest live replica, falling back to the other live
+    replicas in order of distance when it misses.  When chord.version
+    changes on a join or leave, the newest copy of every key held by a live
+    peer is copied to the key's new replica set and the stores of peers
+    that left are dropped, as is their failure, so a peer which leaves
+    while failed comes back live if it joins again after that ring change
+    has been seen; this costs O(keys * r) per ring change.  Keys are
+    identified by chord.hash_func(key) modulo 2^m.  The ring and the address
+    of each peer are cached until chord.version changes.
+    '''
+
+    def __init__(self, chord, r=2):
+        self.chord = chord
+        self.r = r
+        self.stores = {}
+        # Writes missed by failed replicas, as a NodeStore per peer
+        self.hints = {}
+        self.failed = set()
+        self._seq = 0
+        self._synced = chord.version
+        self._ring_index = (None, None, None, 0)
+
+    def fail(self, peer):
+        self._sync()
+        self.failed.add(peer)
+
+    def recover(self, peer):
+        '''
+        Mark peer live again and hand it the writes it missed
+        '''
+        self._sync()
+        self.failed.discard(peer)
+        hint = self.hints.pop(peer, None)
+        if hint is not None:
+            self._store(self.stores, peer).merge(hint.keys, hint.values, hint.seqs)
+
+    def replicas(self, key):
+        '''
+        Owner of key followed by its successors on distinct addresses
+        '''
+        peers = self.chord._peers
+        pos = bisect.bisect(peers, self.chord.hash_func(key) % (2 ** self.chord.m))
+        result = []
+        addresses = set()
+        for i in xrange(len(peers)):
+            peer = peers[(pos + i) % len(peers)]
+            address = self.chord.address_of(peer)
+            if address not in addresses:
+                addresses.add(address)
+                result.append(peer)
+                if len(result) == self.r + 1:
+                    break
+        return result
+
+    def put(self, key, value):
+        '''
+        Return False if every replica of key has failed and the write was
+        dropped
+        '''
+        return not self.put_many([key], [value])
+
+    def get(self, key, start_node=None):
+        return self.get_many([key], start_node)[0]
+
+    def put_many(self, keys, values):
+        '''
+        Store values under keys and return the keys which were not stored
+        because every one of their replicas has failed
+        '''
+        self._sync()
+        keys = list(keys)
+        ids = self._ids(keys)
+        values = self._objects(values)
+        seqs = np.arange(self._seq, self._seq + len(ids), dtype=np.int64)
+        self._seq += len(ids)
+        (ring, replicas) = self._replicas(ids)
+        peers = ring[replicas]
+        stored = self._live(peers).any(axis=1)
+        self._place(ids[stored], values[stored], seqs[stored], peers[stored])
+        return [key for (key, ok) in zip(keys, stored) if not ok]
+
+    def get_many(self, keys, start_nodes=None):
+        '''
+        Values for keys (None where missing or every replica has failed).
+        Each read goes to the first live replica clockwise from its start
+        node, so reads issued from a replica are served locally; without
+        start nodes the first live replica after the owner serves it.  Keys
+        it misses are asked of the next live replica, and so on
+        '''
+        self._sync()
+        chord = self.chord
+        ids = self._ids(keys)
+        (ring, replicas) = self._replicas(ids)
+        peers = ring[replicas]
+        live = self._live(peers)
+        if start_nodes is None:
+            dist = np.arange(peers.shape[1])[None, :].repeat(len(ids), axis=0)
+        else:
+            starts = chord._ids(np.zeros(len(ids), dtype=np.int64))
+            starts[:] = start_nodes
+            dist = (peers - starts[:, None]) & chord._id(2 ** chord.m - 1)
+        # Replicas of each key nearest first, failed ones last
+        rows = np.arange(len(ids))[:, None]
+        order = np.argsort(dist, axis=1, kind='mergesort')
+        order = order[rows, np.argsort(~live[rows, order], axis=1, kind='mergesort')]
+        (peers, live) = (peers[rows, order], live[rows, order])
+        values = np.empty(len(ids), dtype=object)
+        missing = np.ones(len(ids), dtype=bool)
+        for j in xrange(peers.shape[1]):
+            ask = np.flatnonzero(missing & live[:, j])
+            if ask.size == 0:
+                break
+            for (peer, sel) in self._groups(peers[ask, j]):
+                if peer not in self.stores:
+                    continue
+                sel = ask[sel]
+                (found, found_values) = self.stores[peer].lookup(ids[sel])
+                values[sel[found]] = found_values[found]
+                missing[sel[found]] = False
+        return values.tolist()
+
+    def _live(self, peers):
+        failed = np.array(sorted(self.failed), dtype=peers.dtype)
+        return ~np.in1d(peers, failed).reshape(peers.shape)
+
+    def _store(self, stores, peer):
+        if peer not in stores:
+            stores[peer] = NodeStore(self.chord._ring_dtype())
+        return stores[peer]
+
+    def _place(self, ids, values, seqs, peers):
+        # Merge each key into its live replicas and hint its failed ones
+        for j in xrange(peers.shape[1]):
+            for (peer, sel) in self._groups(peers[:, j]):
+                stores = self.hints if peer in self.failed else self.stores
+                self._store(stores, peer).merge(ids[sel], values[sel], seqs[sel])
+
+    def _sync(self):
+        if self._synced != self.chord.version:
+            self._rebalance()
+
+    def _rebalance(self):
+        '''
+        Copy the newest copy of every key held by a live peer to the key's
+        replica set on the current ring.  Live peers keep only the keys
+        they replicate, failed peers keep their store and are hinted, and
+        the stores and hints of peers that left are dropped
+        '''
+        chord = self.chord
+        self._synced = chord.version
+        self.failed = set(peer for peer in self.failed if chord._is_peer(peer))
+        sources = [store for (peer, store) in self.stores.iteritems()
+                   if peer not in self.failed]
+        newest = NodeStore(chord._ring_dtype())
+        if sources:
+            newest.merge(np.concatenate([s.keys for s in sources]).astype(newest.keys.dtype),
+                         np.concatenate([s.values for s in sources]),
+                         np.concatenate([s.seqs for s in sources]))
+        self.stores = dict((peer, store) for (peer, store) in self.stores.iteritems()
+                           if peer in self.failed and chord._is_peer(peer))
+        self.hints = dict((peer, hint) for (peer, hint) in self.hints.iteritems()
+                          if chord._is_peer(peer))
+        if len(newest) > 0:
+            (ring, replicas) = self._replicas(newest.keys)
+            self._place(newest.keys, newest.values, newest.seqs, ring[replicas])
+
+    @staticmethod
+    def _groups(peers):
+        # (peer, indexes) for each distinct peer, indexes in original order
+        order = np.argsort(peers, kind='mergesort')
+        bounds = np.flatnonzero(np.diff(peers[order])) + 1
+        for sel in np.split(order, bounds):
+            if sel.size > 0:
+                yield (int(peers[sel[0]]), sel)
+
+    def _ids(self, keys):
+        m = 2 ** self.chord.m
+        return self.chord._ids([self.chord.hash_func(key) % m for key in keys])
+
+    @staticmethod
+    def _objects(values):
+        array = np.empty(len(values), dtype=object)
+        array[:] = list(values)
+        return array
+
+    def _replicas(self, ids):
+        '''
+        Sorted ring and, for each key id, the ring positions of its owner and
+        next successors on distinct addresses
+        '''
+        (ring, address, addresses) = self._ring_addresses()
+        want = min(self.r + 1, addresses)
+        pos = np.searchsorted(ring, ids, 'right') % len(ring)
+        replicas = np.zeros((len(ids), want), dtype=np.intp)
+        count = np.zeros(len(ids), dtype=np.intp)
+        for offset in xrange(len(ring)):
+            need = np.flatnonzero(count < want)
+            if need.size == 0:
+                break
+            cand = (pos[need] + offset) % len(ring)
+            taken = (address[replicas[need]] == address[cand][:, None]) & \
+                    (np.arange(want)[None, :] < count[need][:, None])
+            ok = ~taken.any(axis=1)
+            rows = need[ok]
+            replicas[rows, count[rows]] = cand[ok]
+            count[rows] += 1
+        return (ring, replicas)
+
+    def _ring_addresses(self):
+        # (ring, address index of each ring position, number of addresses)
+        chord = self.chord
+        (version, ring, address, addresses) = self._ring_index
+        if version != chord.version:
+            ring = chord._ring()
+            index = {}
+            address = np.array([index.setdefault(chord.address_of(p), len(index))
+                                for p in chord._peers], dtype=np.intp)
+            addresses = len(index)
+            self._ring_index = (chord.version, ring, address, addresses)
+        return (ring, address, addresses)
+
+class ChordStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.chord = Chord(lambda x: x, 7, [32, 45, 80, 96, 112, 128 + 16])
+        self.store = ChordStore(self.chord, r=2)
+
+    def test_replicas(self):
+        store = self.store
+        self.assertEquals([45, 80, 96], store.replicas(42))
+        self.assertEquals([16, 32, 45], store.replicas(120))
+        (ring, replicas) = store._replicas(np.array([42, 120], dtype=np.uint64))
+        self.assertEquals([[45, 80, 96], [16, 32, 45]], ring[replicas].tolist())
+
+    def test_merge(self):
+        node = NodeStore()
+        node.merge(np.array([5, 1, 9], dtype=np.uint64), ChordStore._objects("abc"),
+                   np.array([0, 1, 2]))
+        node.merge(np.array([7, 5, 5, 0], dtype=np.uint64), ChordStore._objects("defg"),
+                   np.array([3, 4, 5, 6]))
+        self.assertEquals([0, 1, 5, 7, 9], node.keys.tolist())
+        self.assertEquals(["g", "b", "f", "d", "c"], node.values.tolist())
+        # An older copy never replaces a newer one
+        node.merge(np.array([5, 1], dtype=np.uint64), ChordStore._objects("hi"),
+                   np.array([2, 7]))
+        self.assertEquals(["g", "i", "f", "d", "c"], node.values.tolist())
+        self.assertEquals([6, 7, 5, 3, 2], node.seqs.tolist())
+
+    def test_put_get(self):
+        store = self.store
+        store.put(42, "a")
+        store.put_many([42, 100, 100], ["b", "c", "d"])
+        self.assertEquals("b", store.get(42))
+        self.assertEquals(["b", "d", None], store.get_many([42, 100, 7]))
+        for peer in [45, 80, 96]:
+            self.assertEquals([42], store.stores[peer].keys.tolist())
+        self.assertEquals([100], store.stores[16].keys.tolist())
+
+    def test_failures(self):
+        store = self.store
+        store.put_many(range(128), ["v%d" % i for i in xrange(128)])
+        store.fail(45)
+        store.fail(80)
+        self.assertEquals("v42", store.get(42))
+        store.fail(96)
+        self.assertEquals(None, store.get(42))
+        store.recover(80)
+        self.assertEquals(["v42", "v0"], store.get_many([42, 0]))
+
+    def test_lost_write(self):
+        store = self.store
+        for peer in [45, 80, 96]:
+            store.fail(peer)
+        self.assertFalse(store.put(42, "a"))
+        self.assertEquals([42], store.put_many([42, 100], ["a", "b"]))
+        self.assertTrue(store.put(100, "c"))
+        store.recover(45)
+        self.assertEquals([None, "c"], store.get_many([42, 100]))
+
+    def test_stale_read(self):
+        store = self.store
+        store.put(42, "a")
+        store.fail(45)
+        store.put(42, "b")
+        self.assertEquals([42], store.hints[45].keys.tolist())
+        store.recover(45)
+        self.assertEquals({}, store.hints)
+        self.assertEquals("b", store.get(42))
+        self.assertEquals(["b", "b"], store.get_many([42, 42], [45, 80]))
+
+    def test_leave(self):
+        store = self.store
+        store.put_many([42, 100], ["a", "b"])
+        store.fail(112)
+        for peer in [45, 80, 96]:
+            self.chord.leave(peer)
+        self.assertEquals(["a", "b"], store.get_many([42, 100]))
+        self.assertEquals([112, 16, 32], store.replicas(42))
+        self.assertEquals([16, 32, 112], sorted(store.stores))
+        self.assertEquals([112], sorted(store.hints))
+        store.put(42, "c")
+        store.recover(112)
+        self.assertEquals(["c", "c"], store.get_many([42, 42], [112, 16]))
+        # Leaving with a pending hint drops it along with the peer's store
+        store.fail(32)
+        store.put(42, "d")
+        self.chord.leave(32)
+        self.assertEquals("d", store.get(42))
+        self.assertFalse(32 in store.stores or 32 in store.hints)
+
+    def test_rejoin(self):
+        store = self.store
+        store.put(42, "a")
+        store.fail(45)
+        self.chord.leave(45)
+        self.assertEquals("a", store.get(42))
+        self.assertEquals(set(), store.failed)
+        # The same peer id joins again: it is live and gets its replicas
+        self.chord.join(45)
+        self.assertEquals("a", store.get(42, start_node=45))
+        self.assertEquals([42], store.stores[45].keys.tolist())
+        store.put(42, "b")
+        self.assertEquals(["b", "b"], store.get_many([42, 42], [45, 80]))
+
+    def test_nearest_replica(self):
+        store = self.store
+        store.put(42, "a")
+        # Remove the owner's copy: the owner misses, the next replica serves
+        store.stores[45] = NodeStore()
+        self.assertEquals("a", store.get(42))
+        self.assertEquals("a", store.get(42, start_node=80))
+        self.assertEquals(["a", "a", "a"], store.get_many([42, 42, 42], [96, 50, 16]))
+        for peer in [80, 96]:
+            store.stores[peer] = NodeStore()
+        self.assertEquals(None, store.get(42))
+
+    def test_churn(self):
+        store = self.store
+        store.put(42, "a")
+        # The new owner is handed the key, the dropped replica loses it
+        self.chord.join(43)
+        self.assertEquals([43, 45, 80], store.replicas(42))
+        self.assertEquals("a", store.get(42))
+        self.assertEquals([42], store.stores[43].keys.tolist())
+        self.assertFalse(96 in store.stores)
+        store.fail(45)
+        store.put(100, "b")
+        store.recover(45)
+        self.assertEquals(["a", "b"], store.get_many([42, 100]))
+
+    def test_wide_ring(self):
+        m = 80
+        chord = Chord(lambda x: x, m, [2 ** 70 * i + 12345 for i in xrange(1, 500, 37)])
+        store = ChordStore(chord, r=2)
+        keys = [2 ** 79 + 7, 2 ** 81 + 3, 99]
+        store.put_many(keys, ["x", "y", "z"])
+        self.assertEquals(["x", "y", "z"], store.get_many(keys))
+        # Keys are ids modulo 2^m
+        self.assertEquals(store.replicas(2 ** 81 + 3), store.replicas(3))
+        self.assertEquals("y", store.get(2 ** 81 + 3, start_node=chord._peers[3]))
+
+    def test_vnodes(self):
+        chord = Chord(lambda x: x, 16, [100, 2000, 30000, 45000], vnodes=8)
+        store = ChordStore(chord, r=2)
+        for key in xrange(0, 2 ** 16, 997):
+            peers = store.replicas(key)
+            self.assertEquals(3, len(set(chord.address_of(p) for p in peers)))
+        (ring, replicas) = store._replicas(np.arange(0, 2 ** 16, 997, dtype=np.uint64))
+        self.assertEquals([store.replicas(key) for key in xrange(0, 2 ** 16, 997)],
+                          ring[replicas].tolist())
+
+    def test_ring_cache(self):
+        store = self.store
+        store.put(42, "a")
+        cached = store._ring_index
+        self.assertEquals("a", store.get(42))
+        self.assertTrue(cached[1] is store._ring_index[1])
+        # A join between the owner's predecessor and the key moves ownership
+        self.chord.join(40)
+        self.assertEquals([45, 80, 96], store.replicas(42))
+        self.chord.join(43)
+        store.put(42, "b")
+        self.assertFalse(cached[1] is store._ring_index[1])
+        self.assertEquals([42], store.stores[43].keys.tolist())
+        self.chord.leave(43)
+        self.assertEquals("b", store.get(42))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,6 @@
 from vectorclock import VectorClock
 import unittest
+import numpy as np
 
 class EventTrackVectorClock(VectorClock):
     '''
@@ -9,14 +10,16 @@ class EventTrackVectorClock(VectorClock):
     FROM = ".From"
     TO = ".To"
 
-    def __init__(self, numProc):
-        VectorClock.__init__(self, numProc)
+    def __init__(self, numProc, marks=None):
+        VectorClock.__init__(self, numProc, marks)
         self.clear()
 
     def clear(self):
         VectorClock.clear(self)
         self.events = 0
         self.eventTS = {}
+        self.eventProc = {}
+        self._index = None
 
     def addStep(self, proc, evtName=None):
         VectorClock.addStep(self, proc)
@@ -30,8 +33,8 @@ class EventTrackVectorClock(VectorClock):
             self._recordEvt(evtName + EventTrackVectorClock.TO, toProc)
         self.events += 2
 
-    def halfSend(self, fromProc, mark):
-        VectorClock.halfSend(self, fromProc, mark)
+    def halfSend(self, fromProc, mark, receivers=None):
+        VectorClock.halfSend(self, fromProc, mark, receivers)
         self._recordEvt(mark + EventTrackVectorClock.FROM, fromProc)
         self.events += 1
 
@@ -46,9 +49,148 @@ class EventTrackVectorClock(VectorClock):
     def getEventCount(self):
         return self.events
 
+    def getIndex(self):
+        '''
+        ConcurrencyIndex over the events recorded so far.  It is built on
+        first use and then extended as events are recorded; only
+        recording an event name a second time rebuilds it
+        '''
+        if self._index is None:
+            self._index = ConcurrencyIndex(self.eventTS, self.eventProc, self.getNumProcs())
+        return self._index
+
     def _recordEvt(self, evtName, proc):
         if evtName != None:
-            self.eventTS[evtName] = list(self.getTS(proc))
+            if evtName in self.eventTS:
+                self._index = None
+            ts = list(self.getTS(proc))
+            self.eventTS[evtName] = ts
+            self.eventProc[evtName] = proc
+            if self._index is not None:
+                self._index.add(evtName, ts, proc)
+
+class ConcurrencyIndex(object):
+    '''
+    Recorded events grouped into one chain per process, each chain sorted
+    by the process's own entry.  An event e of process q happened before or
+    equals X iff e[q] <= X[q], and X of process p happened before or
+    equals e iff X[p] <= e[p], and every entry only grows along a chain.
+    So the events of a chain before X form a prefix, those after X form a
+    suffix and the concurrent ones sit in between, each found by binary
+    search: a query costs O(N log M) instead of a scan of all M events.
+    A process's own entry grows with each of its events, so add appends a
+    new event to the end of its chain in amortized O(N)
+    '''
+
+    def __init__(self, eventTS, eventProc, numProc):
+        self.numProc = numProc
+        self.names = [[] for q in xrange(numProc)]
+        self.ts = []
+        for e in eventTS:
+            self.names[eventProc[e]].append(e)
+        for (q, names) in enumerate(self.names):
+            names.sort(key=lambda e: eventTS[e][q])
+            self.ts.append(np.array([eventTS[e] for e in names], dtype=np.int64).reshape(-1, numProc))
+        # Chains grow in place; ts[q] is a view of the filled rows
+        self._buffers = list(self.ts)
+        self._where = {}
+        for q in xrange(numProc):
+            for (i, e) in enumerate(self.names[q]):
+                self._where[e] = (q, i)
+
+    def add(self, evtName, ts, proc):
+        '''
+        Add a new event of proc, later than every event of proc indexed so far
+        '''
+        n = len(self.names[proc])
+        buf = self._buffers[proc]
+        if n == len(buf):
+            buf = np.empty((max(16, 2 * n), self.numProc), dtype=np.int64)
+            buf[:n] = self.ts[proc]
+            self._buffers[proc] = buf
+        buf[n] = ts
+        self.ts[proc] = buf[:n + 1]
+        self.names[proc].append(evtName)
+        self._where[evtName] = (proc, n)
+
+    def __len__(self):
+        return len(self._where)
+
+    def before(self, evtName):
+        '''
+        Events which happened before evtName
+        '''
+        return self._collect(evtName, 0)
+
+    def after(self, evtName):
+        '''
+        Events which happened after evtName
+        '''
+        return self._collect(evtName, 2)
+
+    def concurrent(self, evtName):
+        '''
+        Events concurrent with evtName
+        '''
+        return self._collect(evtName, 1)
+
+    def concurrencyCounts(self):
+        '''
+        (names, counts): the number of events concurrent with each event,
+        from one vectorized binary search per pair of processes
+        '''
+        names = [e for chain in self.names for e in chain]
+        ts = np.concatenate(self.ts)
+        procs = np.repeat(np.arange(self.numProc), [len(chain) for chain in self.names])
+        counts = np.zeros(len(names), dtype=np.int64)
+        for q in xrange(self.numProc):
+            chain = self.ts[q]
+            # Events of q which happened before or equal each event
+            before = np.searchsorted(chain[:, q], ts[:, q], 'right')
+            for p in xrange(self.numProc):
+                sel = procs == p
+                # Events of q which happened after or equal events of p
+                after = len(chain) - np.searchsorted(chain[:, p], ts[sel, p], 'left')
+                counts[sel] += len(chain) - before[sel] - after
+            # An event of q counts itself as both before and after
+            counts[procs == q] += 1
+        return (names, counts)
+
+    def concurrentPairs(self):
+        '''
+        Generate every pair of concurrent events once
+        '''
+        for p in xrange(self.numProc):
+            for (i, e) in enumerate(self.names[p]):
+                # Chains of later processes only, as pairs within a chain
+                # are never concurrent
+                for q in xrange(p + 1, self.numProc):
+                    (lo, hi) = self._bounds(self.ts[p][i], p, q)
+                    for other in self.names[q][lo:hi]:
+                        yield (e, other)
+
+    def _bounds(self, x, p, q):
+        # Slice of chain q between the events before and after x of process p
+        chain = self.ts[q]
+        lo = np.searchsorted(chain[:, q], x[q], 'right')
+        hi = np.searchsorted(chain[:, p], x[p], 'left')
+        return (lo, max(lo, hi))
+
+    def _collect(self, evtName, part):
+        # Events of part 0 (before), 1 (concurrent) or 2 (after) of every
+        # chain
+        (p, i) = self._where[evtName]
+        x = self.ts[p][i]
+        result = []
+        for q in xrange(self.numProc):
+            if q == p:
+                # Own chain is totally ordered around x itself
+                (lo, hi) = (i, i) if part == 1 else (i, i + 1)
+            else:
+                (lo, hi) = self._bounds(x, p, q)
+            bounds = [0, lo, hi, len(self.names[q])]
+            result.extend(self.names[q][bounds[part]:bounds[part + 1]])
+        return result
 
 class EventTrackVectorClockTest(unittest.TestCase):
 
@@ -78,5 +220,85 @@ class EventTrackVectorClockTest(unittest.TestCase):
         self.assertEquals([0,2,2], eventTS["m2.From"])
         self.assertEquals([2,2,2], eventTS["m2.To"])
 
+class ConcurrencyIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        rnd = np.random.RandomState(5)
+        vc = EventTrackVectorClock(5)
+        pending = []
+        for i in xrange(300):
+            (a, b) = rnd.randint(0, 5, 2)
+            op = rnd.randint(4)
+            if op == 0:
+                vc.addStep(a, "s%d" % i)
+            elif op == 1 and a != b:
+                vc.sendMesg(a, b, "m%d" % i)
+            elif op == 2:
+                vc.halfSend(a, "h%d" % i)
+                pending.append("h%d" % i)
+            elif pending:
+                vc.halfRecv(b, pending.pop(rnd.randint(len(pending))))
+        self.vc = vc
+
+    def testQueries(self):
+        vc = self.vc
+        index = vc.getIndex()
+        self.assertEquals(len(vc.eventTS), len(index))
+        for x in vc.eventTS.keys()[::9]:
+            ts = vc.eventTS[x]
+            self.assertEquals(sorted(e for e in vc.eventTS
+                                     if VectorClock.isConcurrent(ts, vc.eventTS[e])),
+                              sorted(index.concurrent(x)))
+            self.assertEquals(sorted(e for e in vc.eventTS
+                                     if VectorClock.isCasuallyRelated(vc.eventTS[e], ts)),
+                              sorted(index.before(x)))
+            self.assertEquals(sorted(e for e in vc.eventTS
+                                     if VectorClock.isCasuallyRelated(ts, vc.eventTS[e])),
+                              sorted(index.after(x)))
+
+    def testBulk(self):
+        vc = self.vc
+        index = vc.getIndex()
+        (names, counts) = index.concurrencyCounts()
+        for (e, count) in zip(names, counts):
+            self.assertEquals(len(index.concurrent(e)), count)
+        pairs = list(index.concurrentPairs())
+        self.assertEquals(counts.sum(), 2 * len(pairs))
+        self.assertEquals(len(pairs), len(set(frozenset(pair) for pair in pairs)))
+        # Recording an event extends the index in place
+        vc.addStep(0, "last")
+        self.assertTrue(index is vc.getIndex())
+        self.assertTrue("last" in index.after(names[0]) or
+                        "last" in index.concurrent(names[0]))
+
+    def testInterleaved(self):
+        # Queries between events see every event so far, from one index
+        rnd = np.random.RandomState(6)
+        vc = EventTrackVectorClock(3)
+        vc.addStep(0, "first")
+        index = vc.getIndex()
+        pending = []
+        for i in xrange(120):
+            (a, b) = rnd.randint(0, 3, 2)
+            if i % 3 == 0:
+                vc.halfSend(a, "h%d" % i)
+                pending.append("h%d" % i)
+            elif i % 3 == 1 and pending:
+                vc.halfRecv(b, pending.pop(0))
+            else:
+                vc.addStep(a, "s%d" % i)
+            x = rnd.choice(sorted(vc.eventTS))
+            ts = vc.eventTS[x]
+            self.assertEquals(sorted(e for e in vc.eventTS
+                                     if VectorClock.isConcurrent(ts, vc.eventTS[e])),
+                              sorted(index.concurrent(x)))
+        self.assertTrue(index is vc.getIndex())
+        self.assertEquals(len(vc.eventTS), len(index))
+        # Recording a name again rebuilds the index
+        vc.addStep(1, "first")
+        rebuilt = vc.getIndex()
+        self.assertFalse(index is rebuilt)
+        self.assertEquals(len(vc.eventTS), len(rebuilt))
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,26 +1,40 @@
+import bisect
 import random
 from pygraph.classes.graph import graph
+import multiprocessing
+import numpy as np
 import unittest
 
 class Gossip:
+    '''
+    Single rumor gossip over a pygraph graph.  Infected and uninfected nodes
+    are tracked incrementally; counts holds the number of infected nodes
+    after each push/pull round.  Nodes added to or deleted from the graph
+    are picked up on the next call when they change the node count; call
+    resync() after changes which leave it as it was.
+    '''
 
     INFECTED = 'infected'
 
     def __init__(self, graph):
         self._graph = graph
         self._infected = set()
+        self._uninfected = set(graph.nodes())
+        self.counts = []
 
     def is_all_infected(self):
-        return len(self._infected) == len(self._graph)
+        self._sync()
+        return not self._uninfected
 
     def get_uninfected(self):
-        return [n for n in self._graph.nodes() if n not in self._infected]
+        self._sync()
+        return list(self._uninfected)
 
     def get_infected(self):
         return self._infected
 
     def push(self, b):
-        g = self._graph
+        self._sync()
         # To be infected
         new_infected = set()
         # For each infected node, pick b random neighbors to be infected
@@ -30,9 +44,10 @@ class Gossip:
         # Infect all nodes at once
         for infected in new_infected:
             self.infect(infected)
+        self.counts.append(len(self._infected))
 
     def pull(self, b):
-        g = self._graph
+        self._sync()
         # To be infected
         new_infected = []
         # For each uninfected node, pick b random neighbors.  If any
@@ -46,17 +61,48 @@ class Gossip:
         # Infect all nodes at once
         for infected in new_infected:
             self.infect(infected)
-        
+        self.counts.append(len(self._infected))
+
+    def push_pull(self, b):
+        # Infected nodes push and uninfected nodes pull in the same round,
+        # both looking at the infection state at the start of the round
+        self._sync()
+        new_infected = set()
+        for infected in self._infected:
+            new_infected.update(self._random_neighbors(infected, b))
+        for uninfected in self._uninfected:
+            for neighbor in self._random_neighbors(uninfected, b):
+                if neighbor in self._infected:
+                    new_infected.add(uninfected)
+                    break
+        for infected in new_infected:
+            self.infect(infected)
+        self.counts.append(len(self._infected))
 
     def infect(self, node):
         if node not in self._infected:
             self._graph.node_attributes(node).append(Gossip.INFECTED)
-            self._infected.add(node)            
+            self._infected.add(node)
+            self._uninfected.discard(node)
 
     def cure(self, node):
         if node in self._infected:
             self._graph.node_attributes(node).remove(Gossip.INFECTED)
             self._infected.remove(node)
+            self._uninfected.add(node)
+
+    def resync(self):
+        '''
+        Rebuild the infected and uninfected sets from the graph
+        '''
+        nodes = set(self._graph.nodes())
+        self._infected &= nodes
+        self._uninfected = nodes - self._infected
+
+    def _sync(self):
+        # Node count check, O(1)
+        if len(self._graph) != len(self._infected) + len(self._uninfected):
+            self.resync()
 
     def _random_neighbors(self, node, b):
         neighbors = self._graph.neighbors(node)
@@ -65,6 +111,368 @@ class Gossip:
         else:
             return random.sample(neighbors, b)
 
+class ArrayGossip(object):
+    '''
+    Gossip over nodes 0..n-1 kept in arrays: adjacency in CSR form (neighbors
+    of node i are indices[indptr[i]:indptr[i+1]]) and infection as a boolean
+    bitmap.  Each push/pull round samples b neighbors for every node taking
+    part in one vectorized step.  With indptr None the graph is the complete
+    graph on n nodes and is never materialized.
+    Only nodes which can still change take part in a round: pushes come from
+    infected nodes with an uninfected neighbor, pulls from uninfected nodes
+    with an infected neighbor.  Both frontiers are maintained incrementally
+    and counts holds the number of infected nodes after each round.
+    '''
+
+    def __init__(self, n, indptr=None, indices=None, rng=None):
+        self.n = n
+        self.indptr = indptr
+        self.indices = indices
+        self.rng = rng if rng is not None else np.random.RandomState()
+        self.infected = np.zeros(n, dtype=bool)
+        self.counts = []
+        self._count = 0
+        # Both lists may hold stale entries until the next _compact
+        self._uninfected = np.arange(n)
+        self._frontier = np.zeros(0, dtype=np.int64)
+        if indptr is not None:
+            self._deg = np.diff(indptr)
+            # Uninfected neighbors of each node, kept up to date through the
+            # reverse adjacency (who lists a node as neighbor)
+            self._open = self._deg.copy()
+            order = np.argsort(indices, kind='mergesort')
+            self._rindptr = np.zeros(n + 1, dtype=np.int64)
+            self._rindptr[1:] = np.cumsum(np.bincount(indices, minlength=n))
+            self._rindices = np.repeat(np.arange(n), self._deg)[order]
+
+    @classmethod
+    def from_graph(cls, g, rng=None):
+        '''
+        Build from a pygraph graph.  Node i of the engine is the i-th node
+        of sorted(g.nodes())
+        '''
+        nodes = sorted(g.nodes())
+        index = dict((node, i) for (i, node) in enumerate(nodes))
+        neighbors = [[index[nb] for nb in g.neighbors(node)] for node in nodes]
+        indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(nbs) for nbs in neighbors])
+        indices = np.array([nb for nbs in neighbors for nb in nbs], dtype=np.int64)
+        return cls(len(nodes), indptr, indices, rng)
+
+    def is_all_infected(self):
+        return self._count == self.n
+
+    def infected_count(self):
+        return self._count
+
+    def get_uninfected(self):
+        self._compact()
+        return self._uninfected.copy()
+
+    def get_infected(self):
+        return np.flatnonzero(self.infected)
+
+    def push(self, b):
+        # For each infected node, pick b random neighbors to be infected
+        self._compact()
+        (src, dst) = self.random_neighbors(self._pushing(), b)
+        self._infect(dst)
+        self.counts.append(self._count)
+
+    def pull(self, b):
+        # For each uninfected node, pick b random neighbors.  If any of them
+        # is infected the node becomes infected as well
+        self._compact()
+        (src, dst) = self.random_neighbors(self._pulling(), b)
+        self._infect(src[self.infected[dst]])
+        self.counts.append(self._count)
+
+    def push_pull(self, b):
+        # Both directions sample against the state at the start of the round
+        self._compact()
+        (src, dst) = self.random_neighbors(self._pulling(), b)
+        pulled = src[self.infected[dst]]
+        (src, pushed) = self.random_neighbors(self._pushing(), b)
+        self._infect(np.concatenate([pulled, pushed]))
+        self.counts.append(self._count)
+
+    def infect(self, node):
+        self._infect(np.array([node]))
+
+    def cure(self, node):
+        if not self.infected[node]:
+            return
+        self._compact()
+        self.infected[node] = False
+        self._count -= 1
+        self._uninfected = np.append(self._uninfected, node)
+        # Drop it now so a later infection does not list it twice
+        self._frontier = self._frontier[self._frontier != node]
+        if self.indptr is not None:
+            # Infected nodes listing node had nothing left to push to if
+            # their count was 0, and were dropped from the frontier
+            listing = np.unique(self._rindices[self._rindptr[node]:self._rindptr[node + 1]])
+            closed = listing[self.infected[listing] & (self._open[listing] == 0)]
+            self._frontier = np.concatenate([self._frontier, closed])
+            np.add.at(self._open, self._rindices[self._rindptr[node]:self._rindptr[node + 1]], 1)
+
+    def _infect(self, nodes):
+        nodes = np.unique(nodes[~self.infected[nodes]])
+        self.infected[nodes] = True
+        self._count += len(nodes)
+        self._frontier = np.concatenate([self._frontier, nodes])
+        if self.indptr is not None and len(nodes) > 0:
+            start = self._rindptr[nodes]
+            deg = self._rindptr[nodes + 1] - start
+            first = np.repeat(np.cumsum(deg) - deg, deg)
+            edge = np.repeat(start, deg) + np.arange(deg.sum()) - first
+            (listing, n) = np.unique(self._rindices[edge], return_counts=True)
+            self._open[listing] -= n
+
+    def _pushing(self):
+        # Infected nodes with at least one uninfected neighbor
+        if self.indptr is None:
+            return self._frontier if self._count < self.n else self._frontier[:0]
+        return self._frontier
+
+    def _pulling(self):
+        # Uninfected nodes with at least one infected neighbor
+        if self.indptr is None:
+            return self._uninfected if self._count > 0 else self._uninfected[:0]
+        return self._uninfected[self._open[self._uninfected] < self._deg[self._uninfected]]
+
+    def _compact(self):
+        # Drop entries which went stale since the last round; costs time
+        # proportional to the frontiers, not to n
+        self._uninfected = self._uninfected[~self.infected[self._uninfected]]
+        frontier = self._frontier[self.infected[self._frontier]]
+        if self.indptr is None:
+            # Kept while everyone is infected, for nodes cured later
+            self._frontier = frontier
+        else:
+            self._frontier = frontier[self._open[frontier] > 0]
+
+    def random_neighbors(self, nodes, b):
+        '''
+        Sample min(b, degree) distinct neighbors of every node in an array
+        of nodes.  Return parallel (src, dst) arrays, one entry per sampled
+        edge
+        '''
+        if self.indptr is None:
+            return self._random_others(nodes, b)
+        start = self.indptr[nodes]
+        deg = self.indptr[nodes + 1] - start
+        # Low degree nodes shuffle their whole edge list, high degree nodes
+        # draw b distinct edge positions
+        low = deg <= 2 * b
+        (src, pos) = self._shuffled_prefix(deg[low], b)
+        high = np.flatnonzero(~low)
+        draw = self._distinct_randint(deg[high], b)
+        src = np.concatenate([np.flatnonzero(low)[src], np.repeat(high, b)])
+        pos = np.concatenate([pos, draw.ravel()])
+        return (nodes[src], self.indices[start[src] + pos])
+
+    def _random_others(self, nodes, b):
+        # Complete graph: b distinct nodes other than the node itself
+        k = min(b, self.n - 1)
+        if 2 * k > self.n - 1:
+            (src, pos) = self._shuffled_prefix(np.repeat(self.n - 1, len(nodes)), k)
+        else:
+            src = np.repeat(np.arange(len(nodes)), k)
+            pos = self._distinct_randint(np.repeat(self.n - 1, len(nodes)), k).ravel()
+        # Skip over the node itself
+        return (nodes[src], pos + (pos >= nodes[src]))
+
+    def _shuffled_prefix(self, deg, k):
+        # For row i, the first min(k, deg[i]) of a random permutation of
+        # range(deg[i]).  Sorting by row + U[0, 1) shuffles each row
+        # independently.  Return parallel (row, position) arrays
+        row = np.repeat(np.arange(len(deg)), deg)
+        first = np.repeat(np.cumsum(deg) - deg, deg)
+        order = np.argsort(row + self.rng.random_sample(len(row)))
+        take = order[np.arange(len(row)) - first < k]
+        return (row[take], take - first[take])
+
+    def _distinct_randint(self, high, k):
+        # (len(high), k) array, row i holding k distinct ints in [0, high[i]).
+        # Rows with a repeat are redrawn; high >= 2k keeps that rare
+        out = np.empty((len(high), k), dtype=np.int64)
+        redraw = np.arange(len(high))
+        while redraw.size > 0:
+            draw = (self.rng.random_sample((redraw.size, k)) * high[redraw][:, None]).astype(np.int64)
+            out[redraw] = draw
+            ordered = np.sort(draw, axis=1)
+            redraw = redraw[(ordered[:, 1:] == ordered[:, :-1]).any(axis=1)]
+        return out
+
+class AntiEntropyGossip(object):
+    '''
+    Anti-entropy over replicated key/value maps.  Every write is appended
+    to the log of the node which made it (its origin), and a node's state
+    is a version vector: state[node, o] is how many of origin o's writes it
+    has applied.  In each round every node exchanges with b random
+    neighbors.  The two peers first swap version vectors (the digest), then
+    only the log entries one side is missing move, in both directions.
+    bytes and digest_bytes hold the data and digest bytes exchanged in each
+    round
+    '''
+
+    # Bytes per version vector entry
+    DIGEST_ENTRY = 8
+
+    def __init__(self, n, indptr=None, indices=None, rng=None):
+        self.n = n
+        # Only used to sample neighbors
+        self._peers = ArrayGossip(n, indptr, indices, rng)
+        self.state = np.zeros((n, n), dtype=np.int64)
+        # Size of every entry of each origin's log, in write order
+        self._sizes = [[] for i in xrange(n)]
+        # key -> {origin: ([seq], [(stamp, value)])}, each origin's writes of
+        # the key in log order.  Writes every node has applied, except the
+        # last of them, are dropped by get
+        self._versions = {}
+        # Writes of each origin applied everywhere, refreshed by exchange
+        self._everywhere = np.zeros(n, dtype=np.int64)
+        self._stamp = 0
+        self._prefix = None
+        self.bytes = []
+        self.digest_bytes = []
+
+    def write(self, node, key, value, size=1):
+        self.write_many(node, [key], [value], [size])
+
+    def write_many(self, node, keys, values, sizes=None):
+        '''
+        Apply writes at node.  sizes gives the bytes each entry costs to
+        send (default 1)
+        '''
+        log = self._sizes[node]
+        if sizes is None:
+            sizes = [1] * len(keys)
+        for (key, value, size) in zip(keys, values, sizes):
+            self._stamp += 1
+            (seqs, writes) = self._versions.setdefault(key, {}).setdefault(node, ([], []))
+            seqs.append(len(log))
+            writes.append((self._stamp, value))
+            log.append(size)
+        self.state[node, node] = len(log)
+        self._prefix = None
+
+    def get(self, node, key):
+        '''
+        Latest write of key applied at node, None if it has none
+        '''
+        best = None
+        for (origin, (seqs, writes)) in self._versions.get(key, {}).iteritems():
+            old = bisect.bisect_left(seqs, self._everywhere[origin]) - 1
+            if old > 0:
+                del seqs[:old]
+                del writes[:old]
+            # Last write of origin which node has applied
+            i = bisect.bisect_left(seqs, self.state[node, origin]) - 1
+            if i >= 0 and (best is None or writes[i][0] > best[0]):
+                best = writes[i]
+        return None if best is None else best[1]
+
+    def is_converged(self):
+        return bool((self.state == self.state.max(axis=0)).all())
+
+    def exchange(self, b):
+        '''
+        One anti-entropy round, every exchange seeing the state at the
+        start of the round
+        '''
+        (src, dst) = self._peers.random_neighbors(np.arange(self.n), b)
+        # Each exchange moves data both ways: receivers[i] gets from senders[i]
+        receivers = np.concatenate([src, dst])
+        senders = np.concatenate([dst, src])
+        self.bytes.append(int(self._missing_bytes(senders, receivers).sum()))
+        self.digest_bytes.append(len(receivers) * self.n * AntiEntropyGossip.DIGEST_ENTRY)
+        if len(receivers) == 0:
+            return
+        order = np.argsort(receivers, kind='mergesort')
+        receivers = receivers[order]
+        starts = np.concatenate([[0], np.flatnonzero(np.diff(receivers)) + 1])
+        merged = np.maximum.reduceat(self.state[senders[order]], starts, axis=0)
+        nodes = receivers[starts]
+        self.state[nodes] = np.maximum(self.state[nodes], merged)
+        self._everywhere = self.state.min(axis=0)
+
+    def _missing_bytes(self, senders, receivers):
+        # Bytes of the log entries each sender has and its receiver lacks,
+        # from per-origin cumulative sizes laid out in one flat array
+        if self._prefix is None:
+            lengths = np.array([len(sizes) + 1 for sizes in self._sizes], dtype=np.int64)
+            self._offsets = np.cumsum(lengths) - lengths
+            self._prefix = np.concatenate(
+                [np.concatenate([[0], np.cumsum(sizes, dtype=np.int64)]) for sizes in self._sizes])
+        have = self.state[senders]
+        lack = self.state[receivers]
+        new = np.maximum(have, lack)
+        return (self._prefix[self._offsets + new] - self._prefix[self._offsets + lack]).sum(axis=1)
+
+# Topology shared by the trials run in one worker process
+_topology = None
+
+def _init_trials(topology):
+    global _topology
+    _topology = topology
+
+def _run_trial(args):
+    (mode, b, max_rounds, seed, trial) = args
+    (n, indptr, indices) = _topology
+    # Seeding from (seed, trial) gives every trial its own stream whichever
+    # worker runs it
+    rng = np.random.RandomState([seed, trial])
+    g = ArrayGossip(n, indptr, indices, rng)
+    g.infect(rng.randint(n))
+    step = getattr(g, mode.replace('-', '_'))
+    while not g.is_all_infected() and len(g.counts) < max_rounds:
+        step(b)
+    rounds = len(g.counts) if g.is_all_infected() else -1
+    return (rounds, [1] + g.counts)
+
+def run_trials(topology, mode, b, trials, max_rounds=1000, seed=0, processes=None):
+    '''
+    Run independent gossip trials of mode ('push', 'pull' or 'push-pull')
+    with fan-out b, each starting from one random infected node.  topology
+    is a node count for the complete graph, an (indptr, indices) pair or a
+    pygraph graph.  Trials are spread over a pool of processes (None for
+    one per CPU, 1 to run in this process).
+    Return (rounds, curves): rounds[t] is the number of rounds trial t took
+    to infect every node or -1 if it did not within max_rounds, and
+    curves[t, r] the number of infected nodes after r rounds, padded with
+    the final count
+    '''
+    if mode not in ('push', 'pull', 'push-pull'):
+        raise ValueError("unknown gossip mode %r" % mode)
+    if isinstance(topology, graph):
+        g = ArrayGossip.from_graph(topology)
+        topology = (g.n, g.indptr, g.indices)
+    elif isinstance(topology, tuple):
+        (indptr, indices) = topology
+        topology = (len(indptr) - 1, indptr, indices)
+    else:
+        topology = (topology, None, None)
+    tasks = [(mode, b, max_rounds, seed, trial) for trial in xrange(trials)]
+    if processes == 1:
+        _init_trials(topology)
+        results = map(_run_trial, tasks)
+    else:
+        pool = multiprocessing.Pool(processes, _init_trials, (topology,))
+        try:
+            results = pool.map(_run_trial, tasks, chunksize=max(1, trials // 64))
+        finally:
+            pool.close()
+            pool.join()
+    rounds = np.array([r for (r, curve) in results], dtype=np.int64)
+    width = max(len(curve) for (r, curve) in results)
+    curves = np.empty((trials, width), dtype=np.int64)
+    for (t, (r, curve)) in enumerate(results):
+        curves[t, :len(curve)] = curve
+        curves[t, len(curve):] = curve[-1]
+    return (rounds, curves)
+
 class GossipTest(unittest.TestCase):
 
     def setUp(self):
@@ -139,6 +547,247 @@ class GossipTest(unittest.TestCase):
         # Pull again will now infect all nodes
         g.pull(n)
         self.assertTrue(g.is_all_infected())
+        self.assertEquals([0, 2, 5], g.counts)
+
+    def test_graph_changes(self):
+        g = self.small_gossip
+        gr = self.small_graph
+        for node in gr.nodes():
+            g.infect(node)
+        self.assertTrue(g.is_all_infected())
+        # A node added later is tracked and can be infected
+        gr.add_node(5)
+        gr.add_edge((0, 5))
+        self.assertEquals([5], g.get_uninfected())
+        g.push(5)
+        self.assertTrue(g.is_all_infected())
+        # Deleting one node and adding another keeps the count: resync
+        gr.del_node(4)
+        gr.add_node(6)
+        g.resync()
+        self.assertEquals([6], g.get_uninfected())
+        self.assertFalse(4 in g.get_infected())
+
+class ArrayGossipTest(unittest.TestCase):
+
+    def setUp(self):
+        g = graph()
+        g.add_nodes(xrange(5))
+        g.add_edge((0, 1))
+        g.add_edge((0, 2))
+        g.add_edge((0, 3))
+        g.add_edge((0, 4))
+        self.small_graph = g
+        self.small_gossip = ArrayGossip.from_graph(g, np.random.RandomState(1))
+        self.gossip = ArrayGossip(5, rng=np.random.RandomState(2))
+
+    def test_infect_cure(self):
+        g = self.gossip
+        self.assertFalse(g.is_all_infected())
+        self.assertEquals(5, len(g.get_uninfected()))
+        for i in range(5):
+            g.infect(i)
+        self.assertTrue(g.is_all_infected())
+        g.cure(0)
+        self.assertEquals([0], g.get_uninfected().tolist())
+
+    def test_push_after_cure(self):
+        # Once everybody is infected the frontier empties, a cure refills it
+        g = self.gossip
+        for i in range(5):
+            g.infect(i)
+        g.push(4)
+        g.cure(0)
+        g.push(4)
+        self.assertTrue(g.is_all_infected())
+        g = self.small_gossip
+        for i in range(5):
+            g.infect(i)
+        g.push(1)
+        self.assertEquals(0, len(g._frontier))
+        g.cure(0)
+        g.push(4)
+        self.assertTrue(g.is_all_infected())
+
+    def test_push(self):
+        g = self.gossip
+        g.push(5)
+        self.assertEquals(0, len(g.get_infected()))
+        g.infect(0)
+        g.push(5)
+        self.assertTrue(g.is_all_infected())
+        g = self.small_gossip
+        g.infect(0)
+        g.push(1)
+        self.assertEquals(2, len(g.get_infected()))
+
+    def test_pull(self):
+        g = self.small_gossip
+        g.pull(5)
+        self.assertFalse(g.is_all_infected())
+        g.infect(2)
+        g.pull(5)
+        self.assertEquals([0, 2], g.get_infected().tolist())
+        g.pull(5)
+        self.assertTrue(g.is_all_infected())
+
+    def test_push_pull(self):
+        g = ArrayGossip(100, rng=np.random.RandomState(2))
+        g.push_pull(1)
+        self.assertEquals([0], g.counts)
+        g.infect(3)
+        g.push_pull(1)
+        # The pushed node plus whoever pulled from node 3
+        self.assertTrue(g.counts[-1] >= 2)
+        while not g.is_all_infected():
+            g.push_pull(1)
+        self.assertTrue(len(g.counts) < 20)
+
+    def test_incremental_frontiers(self):
+        rnd = np.random.RandomState(7)
+        n = 300
+        pairs = rnd.randint(0, n, size=(900, 2))
+        pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+        # Directed edges, so neighbor lists are not symmetric
+        (src, dst) = (pairs[:, 0], pairs[:, 1])
+        order = np.argsort(src, kind='mergesort')
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(src, minlength=n))
+        g = ArrayGossip(n, indptr, dst[order], rnd)
+        g.infect(0)
+        for r in xrange(6):
+            g.pull(1) if r % 2 else g.push(1)
+            g.cure(int(rnd.randint(n)))
+            self.assertEquals(g.counts[-1] >= g.infected_count(), True)
+            self.assertEquals(int(g.infected.sum()), g.infected_count())
+            self.assertEquals(np.flatnonzero(~g.infected).tolist(), sorted(g.get_uninfected().tolist()))
+            expected = [np.count_nonzero(~g.infected[g.indices[g.indptr[v]:g.indptr[v + 1]]])
+                        for v in xrange(n)]
+            self.assertEquals(expected, g._open.tolist())
+            frontier = set(g._frontier.tolist())
+            for v in np.flatnonzero(g.infected):
+                if expected[v] > 0:
+                    self.assertIn(v, frontier)
+        self.assertEquals(6, len(g.counts))
+
+    def test_uniform_sample(self):
+        g = self.small_gossip
+        counts = np.zeros(5)
+        for i in xrange(2000):
+            (src, dst) = g.random_neighbors(np.array([0]), 2)
+            self.assertEquals(2, len(set(dst.tolist())))
+            counts[dst] += 1
+        self.assertTrue((abs(counts[1:] / 4000.0 - 0.25) < 0.03).all())
+        (src, dst) = ArrayGossip(1000, rng=np.random.RandomState(3)).random_neighbors(np.arange(1000), 3)
+        self.assertEquals(3000, len(dst))
+        self.assertFalse((src == dst).any())
+        self.assertEquals(3000, len(set(zip(src.tolist(), dst.tolist()))))
+
+    def test_matches_gossip(self):
+        # Rounds to infect a complete graph by push agree with Gossip
+        n = 100
+        def rounds(gossip):
+            gossip.infect(0)
+            r = 0
+            while not gossip.is_all_infected():
+                gossip.push(1)
+                r += 1
+            return r
+        random.seed(4)
+        graph_rounds = []
+        for i in xrange(30):
+            h = graph()
+            h.add_nodes(xrange(n))
+            h.complete()
+            graph_rounds.append(rounds(Gossip(h)))
+        rng = np.random.RandomState(4)
+        array_rounds = [rounds(ArrayGossip(n, rng=rng)) for i in xrange(300)]
+        self.assertTrue(abs(np.mean(graph_rounds) - np.mean(array_rounds)) < 1.0)
+
+class RunTrialsTest(unittest.TestCase):
+
+    def test_complete_graph(self):
+        for mode in ['push', 'pull', 'push-pull']:
+            (rounds, curves) = run_trials(200, mode, 1, 20, processes=1)
+            self.assertTrue((rounds > 0).all())
+            self.assertEquals(curves.shape[1], rounds.max() + 1)
+            self.assertTrue((curves[:, 0] == 1).all())
+            self.assertTrue((curves[:, -1] == 200).all())
+            self.assertTrue((np.diff(curves, axis=1) >= 0).all())
+            self.assertEquals(rounds.tolist(), (curves < 200).sum(axis=1).tolist())
+        self.assertRaises(ValueError, run_trials, 200, 'gather', 1, 1)
+
+    def test_pool_matches_serial(self):
+        (rounds, curves) = run_trials(300, 'push-pull', 2, 12, seed=5, processes=1)
+        (pool_rounds, pool_curves) = run_trials(300, 'push-pull', 2, 12, seed=5, processes=3)
+        self.assertEquals(rounds.tolist(), pool_rounds.tolist())
+        self.assertEquals(curves.tolist(), pool_curves.tolist())
+        self.assertTrue(len(set(map(tuple, curves.tolist()))) > 1)
+
+    def test_topologies(self):
+        # A ring only gossips to adjacent nodes, and cannot finish quickly
+        h = graph()
+        h.add_nodes(xrange(50))
+        for i in xrange(50):
+            h.add_edge((i, (i + 1) % 50))
+        (rounds, curves) = run_trials(h, 'push', 2, 5, max_rounds=10, processes=1)
+        self.assertEquals([-1] * 5, rounds.tolist())
+        self.assertEquals(11, curves.shape[1])
+        self.assertTrue((curves[:, -1] <= 21).all())
+        g = ArrayGossip.from_graph(h)
+        (rounds, curves) = run_trials((g.indptr, g.indices), 'push', 2, 5, processes=1)
+        self.assertTrue((rounds >= 25).all())
+
+class AntiEntropyGossipTest(unittest.TestCase):
+
+    def test_converge(self):
+        g = AntiEntropyGossip(30, rng=np.random.RandomState(1))
+        g.write_many(0, ['a', 'b'], [1, 2], [10, 20])
+        g.write(5, 'a', 3, 5)
+        self.assertEquals(1, g.get(0, 'a'))
+        self.assertEquals(3, g.get(5, 'a'))
+        self.assertEquals(None, g.get(1, 'a'))
+        self.assertFalse(g.is_converged())
+        while not g.is_converged():
+            g.exchange(1)
+        for node in xrange(30):
+            self.assertEquals(3, g.get(node, 'a'))
+            self.assertEquals(2, g.get(node, 'b'))
+        self.assertEquals([3] * 30, g.state.sum(axis=1).tolist())
+        # Every node but the origin received each entry at least once
+        self.assertTrue(sum(g.bytes) >= 29 * 35)
+        self.assertEquals(len(g.bytes), len(g.digest_bytes))
+        # Nothing left to send
+        g.exchange(1)
+        self.assertEquals(0, g.bytes[-1])
+
+    def test_only_missing_entries(self):
+        g = AntiEntropyGossip(2)
+        g.write_many(0, range(100), range(100))
+        g.exchange(1)
+        g.write_many(0, range(100, 110), range(10), [3] * 10)
+        g.write(1, 7, 'x', 2)
+        g.exchange(1)
+        # Both nodes pick each other: node 1 is sent the 10 new entries
+        # twice and node 0 the single one twice
+        self.assertEquals([200, 64], g.bytes)
+        self.assertEquals([4 * 2 * 8] * 2, g.digest_bytes)
+        self.assertEquals('x', g.get(0, 7))
+
+    def test_versions_trimmed(self):
+        g = AntiEntropyGossip(4, rng=np.random.RandomState(2))
+        for i in xrange(50):
+            g.write(i % 2, 'k', i)
+        self.assertEquals(48, g.get(0, 'k'))
+        self.assertEquals(49, g.get(1, 'k'))
+        self.assertEquals(None, g.get(2, 'k'))
+        while not g.is_converged():
+            g.exchange(1)
+        self.assertEquals([49] * 4, [g.get(node, 'k') for node in xrange(4)])
+        # Only the last write of each origin applied everywhere is kept
+        self.assertEquals([[24], [24]], [g._versions['k'][o][0] for o in (0, 1)])
+        g.write(0, 'k', 'new')
+        self.assertEquals(['new', 49], [g.get(0, 'k'), g.get(2, 'k')])
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,282 @@
+import unittest
+from array import array
+from StringIO import StringIO
+import numpy as np
+from lamport import LamportTimestamp
+from vectorclock import VectorClock, DifferentialVectorClock
+from itc import IntervalTreeClock
+from hlc import HybridLogicalClock
+from markstore import MarkStore
+
+class HBRecorder(object):
+    '''
+    Opt-in recorder of the happened-before DAG of a clock.  Attached to a
+    clock (clock.recorder = recorder, or recorder.attach(clock)) it is told
+    of every event, which gets the next id.  Events are kept as columns:
+    process, previous event of the same process and matching send of a
+    receive (-1 if none), and kind.  Ids are assigned in the order events
+    happen, so increasing id is a topological order of the DAG.  The
+    transitive reduction is computed lazily while iterating, keeping one
+    vector per process and one per send not yet received by everyone.
+    The send event of a mark is kept until cleared, like the clocks' own
+    marks, or forgotten after receivers half receives of it (those given
+    to send, else the recorder's), as in MarkStore.  A receive of a mark
+    the recorder does not hold, such as one sent before it was attached,
+    is recorded without a matching send (src -1), since the clock has
+    already taken it in by the time the recorder is told
+    '''
+
+    STEP = 0
+    SEND = 1
+    RECV = 2
+
+    def __init__(self, receivers=None):
+        self._sends = MarkStore(receivers)
+        self.clear()
+
+    def attach(self, clock):
+        clock.recorder = self
+        return self
+
+    def clear(self):
+        self.proc = array('l')
+        self.prevLocal = array('l')
+        self.msgSrc = array('l')
+        self.kind = array('b')
+        # Process -> column value, for processes which are not 0..n-1
+        self.procIndex = {}
+        self._last = []
+        self._sends.clear()
+
+    def __len__(self):
+        return len(self.kind)
+
+    def step(self, proc):
+        return self._add(proc, HBRecorder.STEP, -1)
+
+    def send(self, proc, mark=None, receivers=None):
+        event = self._add(proc, HBRecorder.SEND, -1)
+        if mark is not None:
+            self._sends.put(mark, event, receivers)
+        return event
+
+    def recv(self, proc, mark=None, src=-1):
+        if mark is not None:
+            try:
+                src = self._sends.consume(mark)
+            except KeyError:
+                src = -1
+        return self._add(proc, HBRecorder.RECV, src)
+
+    def message(self, fromProc, toProc):
+        return self.recv(toProc, src=self.send(fromProc))
+
+    def predecessors(self, reduced=True):
+        '''
+        Generate (event, predecessors) in topological order.  With reduced,
+        predecessors implied by the other one are left out, giving the
+        transitive reduction of the DAG
+        '''
+        count = len(self)
+        proc = np.frombuffer(self.proc, dtype=self.proc.typecode, count=count)
+        prevLocal = self.prevLocal
+        msgSrc = np.frombuffer(self.msgSrc, dtype=self.msgSrc.typecode, count=count)
+        if not reduced:
+            for e in xrange(count):
+                preds = [q for q in (prevLocal[e], msgSrc[e]) if q >= 0]
+                yield (e, preds[:1] if preds[1:] == preds[:1] else preds)
+            return
+        numProc = len(self._last)
+        # vectors[p][q]: events of q known to the latest event of p
+        vectors = np.zeros((numProc, numProc), dtype=np.int64)
+        receivers = np.bincount(msgSrc[msgSrc >= 0], minlength=count)
+        sendVectors = {}
+        for e in xrange(count):
+            p = proc[e]
+            pl = prevLocal[e]
+            s = msgSrc[e]
+            v = vectors[p]
+            if s < 0:
+                preds = [pl] if pl >= 0 else []
+            else:
+                vs = sendVectors[s]
+                if pl >= 0 and v[proc[s]] >= vs[proc[s]]:
+                    # The send happened before the previous local event
+                    preds = [pl]
+                elif pl >= 0 and vs[p] >= v[p]:
+                    # The previous local event happened before the send
+                    preds = [s]
+                else:
+                    preds = [q for q in (pl, s) if q >= 0]
+                np.maximum(v, vs, out=v)
+                receivers[s] -= 1
+                if receivers[s] == 0:
+                    del sendVectors[s]
+            v[p] += 1
+            if receivers[e] > 0:
+                sendVectors[e] = v.copy()
+            yield (e, preds)
+
+    def topological(self):
+        '''
+        Event ids in a topological order of the DAG
+        '''
+        return iter(xrange(len(self)))
+
+    def longestPath(self, weights=None):
+        '''
+        (length, events) of the longest (critical) path through the DAG,
+        weights[e] being the cost of event e (1 by default)
+        '''
+        count = len(self)
+        if count == 0:
+            return (0, [])
+        dist = np.zeros(count)
+        parent = np.full(count, -1, dtype=np.int64)
+        for (e, preds) in self.predecessors():
+            best = -1
+            for q in preds:
+                if best < 0 or dist[q] > dist[best]:
+                    best = q
+            dist[e] = (weights[e] if weights is not None else 1) + (dist[best] if best >= 0 else 0)
+            parent[e] = best
+        e = int(np.argmax(dist))
+        path = []
+        while e >= 0:
+            path.append(e)
+            e = parent[e]
+        return (dist[path[0]], path[::-1])
+
+    def export(self, out, reduced=True):
+        '''
+        Stream the DAG to the file out, one line per event in topological
+        order: id, process, kind and the ids of its predecessors
+        '''
+        kinds = "tsr"
+        for (e, preds) in self.predecessors(reduced):
+            out.write("%d %d %s%s\n" % (e, self.proc[e], kinds[self.kind[e]],
+                                        "".join(" %d" % p for p in preds)))
+
+    def _add(self, proc, kind, src):
+        index = self.procIndex.get(proc)
+        if index is None:
+            index = self.procIndex[proc] = len(self._last)
+            self._last.append(-1)
+        event = len(self.kind)
+        self.proc.append(index)
+        self.prevLocal.append(self._last[index])
+        self.msgSrc.append(src)
+        self.kind.append(kind)
+        self._last[index] = event
+        return event
+
+class HBRecorderTest(unittest.TestCase):
+
+    def record(self, clock, ops):
+        recorder = HBRecorder().attach(clock)
+        for (op, args) in ops:
+            getattr(clock, op)(*args)
+        return recorder
+
+    def randomOps(self, numProc, count, seed):
+        rnd = np.random.RandomState(seed)
+        ops = []
+        pending = []
+        for i in xrange(count):
+            (a, b) = rnd.randint(0, numProc, 2)
+            op = rnd.randint(4)
+            if op == 0:
+                ops.append(('addStep', (a,)))
+            elif op == 1 and a != b:
+                ops.append(('sendMesg', (a, b)))
+            elif op == 2:
+                ops.append(('halfSend', (a, "m%d" % i)))
+                pending.append("m%d" % i)
+            elif pending:
+                ops.append(('halfRecv', (b, pending.pop(rnd.randint(len(pending))))))
+        return ops
+
+    def testColumns(self):
+        recorder = self.record(VectorClock(2), [('addStep', (0,)), ('sendMesg', (0, 1)),
+                                                ('halfSend', (1, "m1")), ('halfRecv', (0, "m1"))])
+        self.assertEquals([0, 0, 1, 1, 0], list(recorder.proc))
+        self.assertEquals([-1, 0, -1, 2, 1], list(recorder.prevLocal))
+        self.assertEquals([-1, -1, 1, -1, 3], list(recorder.msgSrc))
+        self.assertEquals([0, 1, 2, 1, 2], list(recorder.kind))
+        out = StringIO()
+        recorder.export(out)
+        self.assertEquals("0 0 t\n1 0 s 0\n2 1 r 1\n3 1 s 2\n4 0 r 3\n", out.getvalue())
+        self.assertEquals((5, [0, 1, 2, 3, 4]), recorder.longestPath())
+        self.assertEquals(1, recorder._sends.outstanding())
+
+    def testMulticast(self):
+        from mcastordering import FIFOMCastOrdering
+        clock = VectorClock(3)
+        recorder = HBRecorder().attach(clock)
+        fifo = FIFOMCastOrdering(3, lambda f, t, m: None, clock)
+        fifo.sendMcast(0, "m1")
+        fifo.recvMcast(1, "m1")
+        fifo.recvMcast(2, "m1")
+        self.assertEquals([-1, 0, 0], list(recorder.msgSrc))
+        # The multicast is half sent for its 2 receivers, then forgotten
+        self.assertEquals(0, recorder._sends.outstanding())
+        self.assertEquals(0, clock.marks.outstanding())
+        self.assertEquals(3, recorder.recv(1, "m2"))
+        self.assertEquals(-1, recorder.msgSrc[3])
+
+    def testAttachAfterSend(self):
+        # The clock takes in a mark sent before the recorder was attached;
+        # the recorder still logs the receive, without its send
+        clock = VectorClock(2)
+        clock.halfSend(0, "m1")
+        recorder = HBRecorder().attach(clock)
+        clock.halfRecv(1, "m1")
+        clock.sendMesg(1, 0)
+        self.assertEquals([0, 0, 1], list(recorder.proc))
+        self.assertEquals([-1, -1, 1], list(recorder.msgSrc))
+        self.assertEquals([HBRecorder.RECV, HBRecorder.SEND, HBRecorder.RECV],
+                          list(recorder.kind))
+
+    def testMulticastReceivers(self):
+        clock = VectorClock(3)
+        recorder = HBRecorder(receivers=2).attach(clock)
+        clock.halfSend(0, "m1")
+        clock.halfRecv(1, "m1")
+        self.assertEquals(1, recorder._sends.outstanding())
+        clock.halfRecv(2, "m1")
+        self.assertEquals([-1, 0, 0], list(recorder.msgSrc))
+        self.assertEquals(0, recorder._sends.outstanding())
+
+    def testTransitiveReduction(self):
+        recorder = self.record(VectorClock(4), self.randomOps(4, 300, 1))
+        edges = dict(recorder.predecessors(reduced=False))
+        # Brute force: ancestors of each event, then drop implied edges
+        ancestors = []
+        for e in recorder.topological():
+            found = set()
+            for p in edges[e]:
+                found.add(p)
+                found |= ancestors[p]
+            ancestors.append(found)
+        reducedEdges = 0
+        for (e, preds) in recorder.predecessors():
+            expected = [p for p in edges[e]
+                        if not any(p in ancestors[q] for q in edges[e] if q != p)]
+            self.assertEquals(sorted(expected), sorted(preds))
+            reducedEdges += len(preds)
+        self.assertTrue(reducedEdges < sum(len(p) for p in edges.values()))
+
+    def testAllClocks(self):
+        ops = self.randomOps(3, 200, 2)
+        exports = []
+        for clock in [LamportTimestamp(3), VectorClock(3), DifferentialVectorClock(3),
+                      IntervalTreeClock(3), HybridLogicalClock(3, lambda proc: 0)]:
+            out = StringIO()
+            self.record(clock, ops).export(out)
+            exports.append(out.getvalue())
+        self.assertEquals(1, len(set(exports)))
+        # Without a recorder nothing is recorded
+        VectorClock(3).addStep(0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+import time
+import unittest
+from markstore import MarkStore, putMark
+
+class HybridLogicalClock(object):
+    '''
+    Hybrid logical clock (Kulkarni et al.) with the interface of
+    LamportTimestamp.  A timestamp is a 64 bit int packing l, the largest
+    physical time seen, above a 16 bit counter c ordering events within
+    the same l, so timestamps compare as plain ints and stay within the
+    clock skew of physical time.  physicalTime(proc) reads the physical
+    clock of proc (milliseconds since the epoch by default); pass a
+    deterministic one in tests
+    '''
+
+    COUNTER_BITS = 16
+    COUNTER_MASK = (1 << COUNTER_BITS) - 1
+
+    def __init__(self, numProc, physicalTime=None, marks=None):
+        self.numProc = numProc
+        if physicalTime is None:
+            physicalTime = lambda proc: int(time.time() * 1000)
+        self.physicalTime = physicalTime
+        self.marks = marks if marks is not None else MarkStore()
+        # HBRecorder told of every event, if any
+        self.recorder = None
+        self.clear()
+
+    def addStep(self, proc):
+        self._local(proc)
+        self.events += 1
+        if self.recorder is not None:
+            self.recorder.step(proc)
+
+    def sendMesg(self, fromProc, toProc):
+        self._recv(toProc, self._local(fromProc))
+        self.events += 2
+        if self.recorder is not None:
+            self.recorder.message(fromProc, toProc)
+
+    def halfSend(self, fromProc, mark, receivers=None):
+        putMark(self.marks, mark, self._local(fromProc), receivers)
+        self.events += 1
+        if self.recorder is not None:
+            self.recorder.send(fromProc, mark, receivers)
+
+    def halfRecv(self, toProc, mark):
+        self._recv(toProc, self.marks.consume(mark))
+        self.events += 1
+        if self.recorder is not None:
+            self.recorder.recv(toProc, mark)
+
+    def clear(self):
+        self.ts = [0] * self.numProc
+        self.events = 0
+        self.marks.clear()
+
+    def reportTS(self, proc=None):
+        if proc == None:
+            return self.ts
+        else:
+            return "ts[%d]=%d.%d" % ((proc,) + HybridLogicalClock.unpack(self.ts[proc]))
+
+    def getTS(self, proc):
+        return self.ts[proc]
+
+    @staticmethod
+    def pack(l, c):
+        return (l << HybridLogicalClock.COUNTER_BITS) | c
+
+    @staticmethod
+    def unpack(ts):
+        return (ts >> HybridLogicalClock.COUNTER_BITS, ts & HybridLogicalClock.COUNTER_MASK)
+
+    def _local(self, proc):
+        # Local or send event
+        (l, c) = HybridLogicalClock.unpack(self.ts[proc])
+        pt = self.physicalTime(proc)
+        if pt > l:
+            (l, c) = (pt, 0)
+        else:
+            c += 1
+        return self._store(proc, l, c)
+
+    def _recv(self, proc, msgTS):
+        (l, c) = HybridLogicalClock.unpack(self.ts[proc])
+        (lm, cm) = HybridLogicalClock.unpack(msgTS)
+        pt = self.physicalTime(proc)
+        newL = max(l, lm, pt)
+        if newL == l and newL == lm:
+            c = max(c, cm) + 1
+        elif newL == l:
+            c += 1
+        elif newL == lm:
+            c = cm + 1
+        else:
+            c = 0
+        return self._store(proc, newL, c)
+
+    def _store(self, proc, l, c):
+        if c > HybridLogicalClock.COUNTER_MASK:
+            raise OverflowError("HLC counter overflow at process %d" % proc)
+        ts = HybridLogicalClock.pack(l, c)
+        self.ts[proc] = ts
+        return ts
+
+class HybridLogicalClockTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = [0] * 3
+        self.hlc = HybridLogicalClock(3, lambda proc: self.now[proc])
+
+    def testStep(self):
+        hlc = self.hlc
+        self.now[0] = 100
+        hlc.addStep(0)
+        hlc.addStep(0)
+        self.assertEquals((100, 1), HybridLogicalClock.unpack(hlc.getTS(0)))
+        self.now[0] = 101
+        hlc.addStep(0)
+        self.assertEquals((101, 0), HybridLogicalClock.unpack(hlc.getTS(0)))
+        self.assertEquals("ts[0]=101.0", hlc.reportTS(0))
+        self.assertEquals(3, hlc.events)
+
+    def testMessages(self):
+        hlc = self.hlc
+        # Process 1's clock runs behind
+        self.now[:] = [500, 480, 500]
+        hlc.sendMesg(0, 1)
+        self.assertEquals((500, 1), HybridLogicalClock.unpack(hlc.getTS(1)))
+        hlc.halfSend(1, "m1")
+        hlc.halfRecv(2, "m1")
+        self.assertEquals((500, 2), HybridLogicalClock.unpack(hlc.getTS(1)))
+        self.assertEquals((500, 3), HybridLogicalClock.unpack(hlc.getTS(2)))
+        self.now[2] = 600
+        hlc.addStep(2)
+        self.assertEquals((600, 0), HybridLogicalClock.unpack(hlc.getTS(2)))
+        hlc.clear()
+        self.assertEquals([0, 0, 0], hlc.reportTS())
+
+    def testCausalAndClose(self):
+        # Like Lamport timestamps, ts(e) < ts(f) when e happened before f,
+        # and l never runs ahead of the largest physical time seen
+        hlc = self.hlc
+        seen = 0
+        for i in xrange(3000):
+            self.now = [i // 3, i // 3 - 5, i // 3 + (i % 7)]
+            seen = max(seen, max(self.now))
+            (a, b) = (i % 3, (i * 5 + 1) % 3)
+            before = hlc.getTS(a)
+            if a == b:
+                hlc.addStep(a)
+            else:
+                hlc.sendMesg(a, b)
+                self.assertTrue(hlc.getTS(a) < hlc.getTS(b))
+            self.assertTrue(before < hlc.getTS(a))
+            for proc in xrange(3):
+                (l, c) = HybridLogicalClock.unpack(hlc.getTS(proc))
+                self.assertTrue(l <= seen)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -20,5 +20,5 @@ chord = Chord(hash_func, 9, [1, 12, 123, 234, 345, 456, 501])
 print "Successor of node 501 is", chord.successor(501)
 
 chord = Chord(hash_func, 9, [1, 12, 123, 234, 345, 456, 501])
-print "finger table of 234", chord._finger_tbl[234]
+print "finger table of 234", chord.finger_table(234)
 print "successor of 234", chord.successor(234)
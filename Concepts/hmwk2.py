@@ -38,8 +38,7 @@ def vecClockQuestions():
           vc.eventTS["m10.To"]
     # Question 22
     evtTS = vc.eventTS["m4.From"]
-    concurrent = filter(lambda e: VectorClock.isConcurrent(evtTS, vc.eventTS[e]),
-                        vc.eventTS)
+    concurrent = vc.getIndex().concurrent("m4.From")
     print "Q22 - Number of concurrent events to m4.From", concurrent, len(concurrent)
     print evtTS, map(lambda e: vc.eventTS[e], concurrent)
 
@@ -0,0 +1,356 @@
+import random
+import unittest
+from vectorclock import VectorClock
+from markstore import MarkStore, putMark
+
+# Interval tree clocks (Almeida, Baquero, Fonte).  An id is 0, 1 or a pair
+# (left, right) of ids splitting the unit interval; an event tree is an int
+# or a triple (n, left, right) of a base count and two subtrees.  Trees are
+# immutable tuples kept in normal form.
+
+# Cost of growing an event tree leaf into a node, which grow avoids
+GROW_COST = 1 << 20
+
+def split(i):
+    '''
+    Fork id i into two ids whose sum is i
+    '''
+    if i == 0:
+        return (0, 0)
+    if i == 1:
+        return ((1, 0), (0, 1))
+    (l, r) = i
+    if l == 0:
+        (r1, r2) = split(r)
+        return ((0, r1), (0, r2))
+    if r == 0:
+        (l1, l2) = split(l)
+        return ((l1, 0), (l2, 0))
+    return ((l, 0), (0, r))
+
+def sum_id(i1, i2):
+    if i1 == 0:
+        return i2
+    if i2 == 0:
+        return i1
+    return _norm_id((sum_id(i1[0], i2[0]), sum_id(i1[1], i2[1])))
+
+def _norm_id(i):
+    if i == (0, 0):
+        return 0
+    if i == (1, 1):
+        return 1
+    return i
+
+def _norm(e):
+    (n, l, r) = e
+    if isinstance(l, int) and isinstance(r, int) and l == r:
+        return n + l
+    m = min(_min(l), _min(r))
+    return (n + m, _sink(l, m), _sink(r, m))
+
+def _lift(e, m):
+    if isinstance(e, int):
+        return e + m
+    return (e[0] + m, e[1], e[2])
+
+def _sink(e, m):
+    return _lift(e, -m)
+
+def _min(e):
+    # Normal form keeps a zero minimum below the base count
+    return e if isinstance(e, int) else e[0]
+
+def _max(e):
+    if isinstance(e, int):
+        return e
+    return e[0] + max(_max(e[1]), _max(e[2]))
+
+def leq(e1, e2):
+    '''
+    True if event tree e1 <= e2, i.e. e1 happened before or equals e2
+    '''
+    if isinstance(e1, int):
+        return e1 <= _min(e2) if isinstance(e2, int) else e1 <= e2[0]
+    (n1, l1, r1) = e1
+    if isinstance(e2, int):
+        return n1 <= e2 and leq(_lift(l1, n1), e2) and leq(_lift(r1, n1), e2)
+    (n2, l2, r2) = e2
+    return n1 <= n2 and leq(_lift(l1, n1), _lift(l2, n2)) and \
+           leq(_lift(r1, n1), _lift(r2, n2))
+
+def join(e1, e2):
+    '''
+    Least upper bound of two event trees
+    '''
+    if isinstance(e1, int) and isinstance(e2, int):
+        return max(e1, e2)
+    if isinstance(e1, int):
+        e1 = (e1, 0, 0)
+    if isinstance(e2, int):
+        e2 = (e2, 0, 0)
+    if e1[0] > e2[0]:
+        (e1, e2) = (e2, e1)
+    (n1, l1, r1) = e1
+    (n2, l2, r2) = e2
+    d = n2 - n1
+    return _norm((n1, join(l1, _lift(l2, d)), join(r1, _lift(r2, d))))
+
+def fill(i, e):
+    '''
+    Raise e as far as possible over the interval owned by i without
+    inflating it beyond what other ids have seen
+    '''
+    if i == 0 or isinstance(e, int):
+        return e
+    if i == 1:
+        return _max(e)
+    (il, ir) = i
+    (n, el, er) = e
+    if il == 1:
+        er = fill(ir, er)
+        return _norm((n, max(_max(el), _min(er)), er))
+    if ir == 1:
+        el = fill(il, el)
+        return _norm((n, el, max(_max(er), _min(el))))
+    return _norm((n, fill(il, el), fill(ir, er)))
+
+def _grow(i, e):
+    # (inflated e, cost), preferring the cheapest place to add one
+    if i == 1 and isinstance(e, int):
+        return (e + 1, 0)
+    if isinstance(e, int):
+        (grown, cost) = _grow(i, (e, 0, 0))
+        return (grown, cost + GROW_COST)
+    (il, ir) = i
+    (n, el, er) = e
+    if il == 0:
+        (er, cost) = _grow(ir, er)
+        return ((n, el, er), cost + 1)
+    if ir == 0:
+        (el, cost) = _grow(il, el)
+        return ((n, el, er), cost + 1)
+    (gl, cl) = _grow(il, el)
+    (gr, cr) = _grow(ir, er)
+    if cl < cr:
+        return ((n, gl, er), cl + 1)
+    return ((n, el, gr), cr + 1)
+
+def event(i, e):
+    '''
+    Record a local event of id i on event tree e
+    '''
+    filled = fill(i, e)
+    if filled != e:
+        return filled
+    return _grow(i, e)[0]
+
+class IntervalTreeClock(object):
+    '''
+    Clock with the interface of VectorClock over a changing set of
+    processes.  Every process holds an id, a share of the unit interval,
+    and an event tree.  join forks the id of a running process for a new
+    one, leave hands a leaving process's id and history to another, so no
+    vector is ever resized and timestamps only grow with the processes
+    currently active
+    '''
+
+    def __init__(self, numProc=1, marks=None):
+        self._procs = range(numProc)
+        self.marks = marks if marks is not None else MarkStore()
+        # HBRecorder told of every event, if any
+        self.recorder = None
+        self.clear()
+
+    def clear(self):
+        self.ids = {}
+        self.ts = {}
+        self.marks.clear()
+        self.events = 0
+        procs = self._procs
+        self._procs = procs[:1]
+        self.ids[procs[0]] = 1
+        self.ts[procs[0]] = 0
+        for proc in procs[1:]:
+            self.join(proc, procs[0])
+
+    def join(self, newProc, fromProc=None):
+        '''
+        Start newProc with a fork of fromProc (default any process), so
+        newProc starts out knowing fromProc's history
+        '''
+        if newProc in self.ids:
+            raise ValueError("process %r already running" % (newProc,))
+        if fromProc is None:
+            fromProc = next(iter(self.ids))
+        (self.ids[fromProc], self.ids[newProc]) = split(self.ids[fromProc])
+        self.ts[newProc] = self.ts[fromProc]
+        self._procs.append(newProc)
+
+    def leave(self, proc, intoProc):
+        '''
+        Retire proc, merging its id and history into intoProc
+        '''
+        self.ids[intoProc] = sum_id(self.ids[intoProc], self.ids.pop(proc))
+        self.ts[intoProc] = join(self.ts[intoProc], self.ts.pop(proc))
+        self._procs.remove(proc)
+
+    def addStep(self, proc):
+        self._inc(proc)
+        self.events += 1
+        if self.recorder is not None:
+            self.recorder.step(proc)
+
+    def sendMesg(self, fromProc, toProc):
+        self._inc(fromProc)
+        self._merge(self.ts[fromProc], toProc)
+        self.events += 2
+        if self.recorder is not None:
+            self.recorder.message(fromProc, toProc)
+
+    def halfSend(self, fromProc, mark, receivers=None):
+        self._inc(fromProc)
+        # Trees are immutable, no copy needed
+        putMark(self.marks, mark, self.ts[fromProc], receivers)
+        self.events += 1
+        if self.recorder is not None:
+            self.recorder.send(fromProc, mark, receivers)
+
+    def halfRecv(self, toProc, mark):
+        self._merge(self.marks.consume(mark), toProc)
+        self.events += 1
+        if self.recorder is not None:
+            self.recorder.recv(toProc, mark)
+
+    def reportTS(self, proc=None):
+        if proc == None:
+            return self.ts
+        else:
+            return "ts[%s]=%s" % (proc, self.ts[proc])
+
+    def getTS(self, proc):
+        return self.ts[proc]
+
+    def getProcs(self):
+        return list(self._procs)
+
+    def _inc(self, proc):
+        self.ts[proc] = event(self.ids[proc], self.ts[proc])
+
+    def _merge(self, fromTS, toProc):
+        self.ts[toProc] = event(self.ids[toProc], join(self.ts[toProc], fromTS))
+
+    @staticmethod
+    def lessEq(ts1, ts2):
+        return leq(ts1, ts2)
+
+    @staticmethod
+    def isCasuallyRelated(ts1, ts2):
+        return leq(ts1, ts2) and not leq(ts2, ts1)
+
+    @staticmethod
+    def isConcurrent(ts1, ts2):
+        return not leq(ts1, ts2) and not leq(ts2, ts1)
+
+class IntervalTreeClockTest(unittest.TestCase):
+
+    def testForkJoinIds(self):
+        (a, b) = split(1)
+        self.assertEquals(((1, 0), (0, 1)), (a, b))
+        (b1, b2) = split(b)
+        self.assertEquals((0, (1, 0)), b1)
+        self.assertEquals(1, sum_id(a, sum_id(b1, b2)))
+
+    def testEvents(self):
+        (a, b) = split(1)
+        ea = event(a, 0)
+        eb = event(b, 0)
+        self.assertEquals((0, 1, 0), ea)
+        self.assertTrue(leq(0, ea))
+        self.assertFalse(leq(ea, eb))
+        self.assertFalse(leq(eb, ea))
+        joined = join(ea, eb)
+        self.assertEquals(1, joined)
+        self.assertTrue(leq(ea, joined) and leq(eb, joined))
+        # With the whole interval back, fill collapses the tree
+        self.assertEquals(1, event(1, ea))
+
+    def testMatchesVectorClock(self):
+        rnd = random.Random(3)
+        vc = VectorClock(5)
+        itc = IntervalTreeClock(5)
+        vstamps = []
+        istamps = []
+        pending = []
+        for i in xrange(400):
+            op = rnd.randrange(3)
+            (a, b) = (rnd.randrange(5), rnd.randrange(5))
+            if op == 0:
+                vc.addStep(a)
+                itc.addStep(a)
+            elif op == 1 and a != b:
+                vc.sendMesg(a, b)
+                itc.sendMesg(a, b)
+            else:
+                vc.halfSend(a, i)
+                itc.halfSend(a, i)
+                pending.append(i)
+                if rnd.random() < 0.7:
+                    mark = pending.pop(rnd.randrange(len(pending)))
+                    vc.halfRecv(b, mark)
+                    itc.halfRecv(b, mark)
+            vstamps.append(vc.getTS(a))
+            istamps.append(itc.getTS(a))
+        for x in xrange(0, 400, 7):
+            for y in xrange(0, 400, 5):
+                self.assertEquals(VectorClock.lessEq(vstamps[x], vstamps[y]),
+                                  IntervalTreeClock.lessEq(istamps[x], istamps[y]))
+                self.assertEquals(VectorClock.isConcurrent(vstamps[x], vstamps[y]),
+                                  IntervalTreeClock.isConcurrent(istamps[x], istamps[y]))
+
+    def testMembership(self):
+        itc = IntervalTreeClock(2)
+        itc.addStep(0)
+        itc.addStep(1)
+        itc.join("new", 0)
+        itc.addStep("new")
+        # The new process starts from its parent's history
+        self.assertTrue(IntervalTreeClock.isCasuallyRelated(itc.getTS(0), itc.getTS("new")))
+        self.assertTrue(IntervalTreeClock.isConcurrent(itc.getTS(1), itc.getTS("new")))
+        self.assertRaises(ValueError, itc.join, "new")
+        itc.halfSend("new", "m1")
+        itc.leave("new", 1)
+        self.assertEquals([0, 1], itc.getProcs())
+        itc.halfRecv(0, "m1")
+        self.assertTrue(IntervalTreeClock.lessEq(itc.marks["m1"], itc.getTS(1)))
+        # Once everybody leaves into one process the clock is a counter
+        itc.leave(0, 1)
+        self.assertEquals(1, itc.ids[1])
+        itc.addStep(1)
+        self.assertTrue(isinstance(itc.getTS(1), int))
+
+    def testChurn(self):
+        # Processes keep coming and going, timestamps stay small
+        rnd = random.Random(4)
+        itc = IntervalTreeClock(4)
+        names = 4
+        for i in xrange(2000):
+            procs = itc.getProcs()
+            op = rnd.randrange(4)
+            if op == 0 and len(procs) < 8:
+                itc.join(names, rnd.choice(procs))
+                names += 1
+            elif op == 1 and len(procs) > 2:
+                (a, b) = rnd.sample(procs, 2)
+                itc.leave(a, b)
+            elif op == 2:
+                (a, b) = rnd.sample(procs, 2)
+                itc.sendMesg(a, b)
+            else:
+                itc.addStep(rnd.choice(procs))
+        ids = itc.ids.values()
+        self.assertEquals(1, reduce(sum_id, ids))
+        self.assertTrue(len(str(itc.reportTS())) < 2000)
+
+if __name__ == '__main__':
+    unittest.main()
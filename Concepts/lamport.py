@@ -1,13 +1,19 @@
+from markstore import MarkStore, putMark
+
 class LamportTimestamp(object):
 
-    def __init__(self, numProc):
+    def __init__(self, numProc, marks=None):
         self.ts = [0] * numProc
         self.events = 0        
-        self.marks = {}
+        self.marks = marks if marks is not None else MarkStore()
+        # HBRecorder told of every event, if any
+        self.recorder = None
 
     def addStep(self, proc):
         self.ts[proc] += 1
         self.events += 1
+        if self.recorder is not None:
+            self.recorder.step(proc)
 
     def sendMesg(self, fromProc, toProc):
         fromTS = self.ts[fromProc] + 1
@@ -15,22 +21,28 @@ class LamportTimestamp(object):
         toTS = max(self.ts[toProc], fromTS) + 1
         self.ts[toProc] = toTS
         self.events += 2
+        if self.recorder is not None:
+            self.recorder.message(fromProc, toProc)
 
-    def halfSend(self, fromProc, mark):
+    def halfSend(self, fromProc, mark, receivers=None):
         fromTS = self.ts[fromProc] + 1
         self.ts[fromProc] = fromTS
-        self.marks[mark] = fromTS
+        putMark(self.marks, mark, fromTS, receivers)
         self.events += 1
+        if self.recorder is not None:
+            self.recorder.send(fromProc, mark, receivers)
 
     def halfRecv(self, toProc, mark):
-        toTS = max(self.ts[toProc], self.marks[mark]) + 1
+        toTS = max(self.ts[toProc], self.marks.consume(mark)) + 1
         self.ts[toProc] = toTS
         self.events += 1
+        if self.recorder is not None:
+            self.recorder.recv(toProc, mark)
 
     def clear(self):
         self.ts = [0] * len(self.ts)
         self.events = 0
-        self.marks = {}
+        self.marks.clear()
 
     def reportTS(self, proc=None):
         if proc == None:
@@ -38,5 +50,8 @@ class LamportTimestamp(object):
         else:
             return "ts[%d]=%d" % (proc, self.ts[proc])
 
+    def getTS(self, proc):
+        return self.ts[proc]
+
 
     
@@ -0,0 +1,219 @@
+import os
+import pickle
+import shelve
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+
+def putMark(marks, mark, value, receivers=None):
+    '''
+    marks[mark] = value for a MarkStore or any other mapping.  receivers,
+    if not None, is the number of receivers the mark is kept for in a
+    MarkStore; other mappings keep it until cleared
+    '''
+    if receivers is not None and isinstance(marks, MarkStore):
+        marks.put(mark, value, receivers)
+    else:
+        marks[mark] = value
+
+class MarkStore(object):
+    '''
+    Message marks of the clocks, mapping a mark to what its half receive
+    needs.  A mark put with n expected receivers is freed once consume has
+    been called for it n times; with receivers None it is kept until
+    cleared, like a dict.  With a cap, marks beyond the cap most recently
+    put are kept in memory and older ones spill to a shelve file at
+    spillPath (a temporary file by default).  Only the values spill: the
+    marks stay in memory as keys of an index into the file, so marks are
+    matched by hash and equality as in a dict, and only marks known to have
+    spilled touch the file.  Closing with spilled marks outstanding raises
+    ValueError; clear discards them
+    '''
+
+    def __init__(self, receivers=None, cap=None, spillPath=None):
+        self.receivers = receivers
+        self.cap = cap
+        self.spillPath = spillPath
+        self._tempDir = None
+        self._spill = None
+        self._values = OrderedDict()
+        # Shelve key of each spilled mark
+        self._spillKeys = {}
+        self._nextKey = 0
+        # Receivers still expected, for marks which have a limit
+        self._remaining = {}
+
+    def put(self, mark, value, receivers=None):
+        if receivers is None:
+            receivers = self.receivers
+        self.discard(mark)
+        self._values[mark] = value
+        if receivers is not None:
+            self._remaining[mark] = receivers
+        if self.cap is not None and len(self._values) > self.cap:
+            self._spillOldest()
+
+    def get(self, mark):
+        '''
+        Value of mark, without consuming it
+        '''
+        if mark in self._values:
+            return self._values[mark]
+        if mark in self._spillKeys:
+            return self._spill[self._spillKeys[mark]][0]
+        raise KeyError(mark)
+
+    def consume(self, mark):
+        '''
+        Value of mark for one of its receivers, freeing the mark after the
+        last expected one
+        '''
+        if mark not in self._values:
+            self._unspill(mark)
+        value = self._values[mark]
+        remaining = self._remaining.get(mark)
+        if remaining is not None:
+            if remaining <= 1:
+                del self._values[mark]
+                del self._remaining[mark]
+            else:
+                self._remaining[mark] = remaining - 1
+        if self.cap is not None and len(self._values) > self.cap:
+            self._spillOldest()
+        return value
+
+    def discard(self, mark):
+        if mark in self._values:
+            del self._values[mark]
+            self._remaining.pop(mark, None)
+        elif mark in self._spillKeys:
+            del self._spill[self._spillKeys.pop(mark)]
+
+    def outstanding(self):
+        '''
+        Number of marks held, in memory or spilled
+        '''
+        return len(self._values) + self.spilled()
+
+    def spilled(self):
+        return len(self._spillKeys)
+
+    def clear(self):
+        self._values.clear()
+        self._remaining.clear()
+        self._spillKeys.clear()
+        self.close()
+
+    def close(self):
+        '''
+        Remove the spill file.  Marks held in memory are kept
+        '''
+        if self._spillKeys:
+            raise ValueError("%d spilled marks outstanding" % len(self._spillKeys))
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+        if self._tempDir is not None:
+            shutil.rmtree(self._tempDir, ignore_errors=True)
+            self._tempDir = None
+
+    __setitem__ = put
+    __getitem__ = get
+    __delitem__ = discard
+
+    def __len__(self):
+        return self.outstanding()
+
+    def __contains__(self, mark):
+        return mark in self._values or mark in self._spillKeys
+
+    def _spillOldest(self):
+        if self._spill is None:
+            path = self.spillPath
+            if path is None:
+                self._tempDir = tempfile.mkdtemp(prefix='marks')
+                path = os.path.join(self._tempDir, 'marks')
+            self._spill = shelve.open(path, 'n', pickle.HIGHEST_PROTOCOL)
+        while len(self._values) > self.cap:
+            (mark, value) = self._values.popitem(last=False)
+            key = str(self._nextKey)
+            self._nextKey += 1
+            self._spillKeys[mark] = key
+            self._spill[key] = (value, self._remaining.pop(mark, None))
+
+    def _unspill(self, mark):
+        if mark not in self._spillKeys:
+            raise KeyError(mark)
+        key = self._spillKeys.pop(mark)
+        (value, remaining) = self._spill[key]
+        del self._spill[key]
+        self._values[mark] = value
+        if remaining is not None:
+            self._remaining[mark] = remaining
+
+class MarkStoreTest(unittest.TestCase):
+
+    def testKeepByDefault(self):
+        marks = MarkStore()
+        marks["m1"] = [1, 0]
+        self.assertEquals([1, 0], marks.consume("m1"))
+        self.assertEquals([1, 0], marks.consume("m1"))
+        self.assertEquals(1, len(marks))
+        marks.clear()
+        self.assertFalse("m1" in marks)
+        self.assertRaises(KeyError, marks.consume, "m1")
+
+    def testReceivers(self):
+        marks = MarkStore(receivers=1)
+        marks["m1"] = 5
+        marks.put("m2", 6, receivers=2)
+        self.assertEquals(5, marks["m1"])
+        self.assertEquals(5, marks.consume("m1"))
+        self.assertFalse("m1" in marks)
+        self.assertEquals(6, marks.consume("m2"))
+        self.assertEquals(1, marks.outstanding())
+        self.assertEquals(6, marks.consume("m2"))
+        self.assertEquals(0, marks.outstanding())
+
+    def testSpill(self):
+        marks = MarkStore(receivers=1, cap=10)
+        for i in xrange(100):
+            marks[("m", i)] = [i] * 3
+        self.assertEquals(100, marks.outstanding())
+        self.assertEquals(90, marks.spilled())
+        for i in xrange(0, 100, 2):
+            self.assertEquals([i] * 3, marks.consume(("m", i)))
+        self.assertEquals(50, marks.outstanding())
+        self.assertTrue(("m", 1) in marks)
+        self.assertFalse(("m", 2) in marks)
+        del marks[("m", 1)]
+        self.assertEquals(49, len(marks))
+        path = marks._tempDir
+        self.assertRaises(ValueError, marks.close)
+        self.assertTrue(os.path.exists(path))
+        marks.clear()
+        self.assertFalse(os.path.exists(path))
+
+    def testSpillEqualMarks(self):
+        # Equal marks find each other once spilled, whatever their type
+        marks = MarkStore(receivers=1, cap=1)
+        marks[1] = "a"
+        marks[u"m"] = "b"
+        marks[(1L, "x")] = "c"
+        marks["last"] = "d"
+        self.assertEquals(3, marks.spilled())
+        self.assertTrue(True in marks)
+        self.assertEquals("a", marks.consume(1L))
+        self.assertEquals("b", marks.get("m"))
+        marks["m"] = "e"
+        self.assertEquals("c", marks.consume((True, u"x")))
+        self.assertEquals(2, marks.outstanding())
+        self.assertEquals("e", marks.consume("m"))
+        self.assertEquals("d", marks.consume("last"))
+        path = marks._tempDir
+        marks.close()
+        self.assertFalse(os.path.exists(path))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -18,6 +18,13 @@ class MCastOrdering(object):
 
 
 class BaseMCastOrdering(MCastOrdering):
+    '''
+    clock, if not None, is any of the clock classes (LamportTimestamp,
+    VectorClock, HybridLogicalClock, ...): each multicast is a half send
+    on it, each delivery a half receive, and getStamp(msg) gives the
+    timestamp the multicast was sent with.  A multicast's mark is half sent
+    for its numProcs - 1 receivers, so a MarkStore frees it after the last
+    '''
 
     def __init__(self, numProcs, deliverCB, clock):
         self.numProcs = numProcs
@@ -26,12 +33,21 @@ class BaseMCastOrdering(MCastOrdering):
         self.ts = []
         self.msg = {}
         self.buffer = {}
+        self.stamps = {}
+
+    def getStamp(self, msg):
+        return self.stamps[msg]
 
     def _sendMcast(self, proc, msg, ts):
         self.msg[msg] = [proc, ts]
+        if self.clock is not None:
+            self.clock.halfSend(proc, msg, receivers=self.numProcs - 1)
+            self.stamps[msg] = self.clock.getTS(proc)
 
     def _deliver(self, toProc, msg):
         (fromProc, ts) = self.msg[msg]
+        if self.clock is not None:
+            self.clock.halfRecv(toProc, msg)
         self.deliverCB(fromProc, toProc, msg)
 
     def _buffer(self, fromProc, toProc, msg, priority):
@@ -44,9 +60,9 @@ class BaseMCastOrdering(MCastOrdering):
         queue.put((priority, msg))
 
     def _deliverAllSequential(self, fromProc, toProc, nextPriority):
-        return self._deliverAllSequentialKey((fromProc, toPRoc), nextPriority)
+        return self._deliverAllSequentialKey((fromProc, toProc), toProc, nextPriority)
 
-    def _deliverAllSequentialKey(self, key, nextPriority):
+    def _deliverAllSequentialKey(self, key, toProc, nextPriority):
         # Deliver all messages in buffer with consecutive priorities starting at
         # nextPriority.  For example, if nextPriority=5, and queue has (5,6,7,10,11), deliver 5,6,7
         if key not in self.buffer:
@@ -60,7 +76,7 @@ class BaseMCastOrdering(MCastOrdering):
                 lastPriorityDelivered = msgPriority
                 nextPriority += 1
             else:
-                queue.put(msgPriority, msg)
+                queue.put((msgPriority, msg))
                 break
         return lastPriorityDelivered
             
@@ -68,8 +84,8 @@ class BaseMCastOrdering(MCastOrdering):
 
 class FIFOMCastOrdering(BaseMCastOrdering):
 
-    def __init__(self, numProcs, deliverCB):
-        BaseMCastOrdering.__init__(self, numProcs, deliverCB, None)
+    def __init__(self, numProcs, deliverCB, clock=None):
+        BaseMCastOrdering.__init__(self, numProcs, deliverCB, clock)
         # Each Pi maintains a vector of seq numbers Pi[1 .. N]
         # Pi[j] is latest seq num Pi has received from Pj
         self.seqNums = [range(numProcs) for i in xrange(numProcs)]
@@ -93,8 +109,8 @@ class FIFOMCastOrdering(BaseMCastOrdering):
 
 class TotalMCastOrdering(BaseMCastOrdering):
 
-    def __init__(self, numProcs, deliverCB):
-        BaseMCastOrdering.__init__(self, numProcs, deliverCB, None)
+    def __init__(self, numProcs, deliverCB, clock=None):
+        BaseMCastOrdering.__init__(self, numProcs, deliverCB, clock)
         self.sequencer = 0
         self.glblSeqNum = 0
         self.procSeqNum = range(numProcs)
@@ -108,7 +124,7 @@ class TotalMCastOrdering(BaseMCastOrdering):
             if fromProc == self.sequencer:
                 (actMsg, glblSeqNum) = msg
                 if self.procSeqNum[toProc] + 1 == glblSeqNum:
-                    self._deliverAllSequentialKey(toProc, self.procSeqNum[toProc])
+                    self._deliverAllSequentialKey(toProc, toProc, self.procSeqNum[toProc])
                     self.procSeqNum[toProc] += 1
                 
                     
@@ -154,6 +170,53 @@ class MCastOrderingTest(unittest.TestCase):
         self.checkMsg(2, 0, "m3")
         self.checkMsg(2, 1, "m3")
 
+    def testFIFOWithClock(self):
+        from hlc import HybridLogicalClock
+        now = [1000, 990, 1010, 1000]
+        hlc = HybridLogicalClock(4, lambda proc: now[proc])
+        fifo = FIFOMCastOrdering(4, lambda f,t,m: self.msgList.append((f,t,m)), hlc)
+        fifo.sendMcast(0, "m1")
+        fifo.sendMcast(0, "m2")
+        fifo.recvMcast(1, "m2")
+        fifo.recvMcast(1, "m1")
+        self.checkMsg(0, 1, "m1")
+        self.checkMsg(0, 1, "m2")
+        self.assertTrue(fifo.getStamp("m1") < fifo.getStamp("m2"))
+        # P1 delivered both, so its multicast is stamped after them
+        fifo.sendMcast(1, "m3")
+        self.assertTrue(fifo.getStamp("m2") < fifo.getStamp("m3"))
+        self.assertEquals((1000, 3), HybridLogicalClock.unpack(fifo.getStamp("m3")))
+
+    def testFreeingMarkStore(self):
+        from lamport import LamportTimestamp
+        from markstore import MarkStore
+        # Every other process receives the multicast, then its mark is freed
+        marks = MarkStore(receivers=1)
+        clock = LamportTimestamp(3, marks)
+        fifo = FIFOMCastOrdering(3, lambda f,t,m: self.msgList.append((f,t,m)), clock)
+        fifo.sendMcast(0, "m1")
+        fifo.recvMcast(1, "m1")
+        self.assertTrue("m1" in marks)
+        fifo.recvMcast(2, "m1")
+        self.checkMsg(0, 1, "m1")
+        self.checkMsg(0, 2, "m1")
+        self.assertEquals(0, marks.outstanding())
+        self.assertEquals([1, 2, 2], clock.reportTS())
+
+    def testKeepingMarkStore(self):
+        from lamport import LamportTimestamp
+        # A store which keeps marks by default still frees multicast ones
+        clock = LamportTimestamp(3)
+        fifo = FIFOMCastOrdering(3, lambda f,t,m: self.msgList.append((f,t,m)), clock)
+        clock.halfSend(2, "p2p")
+        fifo.sendMcast(0, "m1")
+        fifo.recvMcast(1, "m1")
+        fifo.recvMcast(2, "m1")
+        self.checkMsg(0, 1, "m1")
+        self.checkMsg(0, 2, "m1")
+        self.assertFalse("m1" in clock.marks)
+        self.assertTrue("p2p" in clock.marks)
+
 if __name__ == '__main__':
     unittest.main()
     
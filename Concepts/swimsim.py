@@ -0,0 +1,390 @@
+import heapq
+import math
+import random
+import time
+import unittest
+import numpy as np
+from pygraph.classes.graph import graph
+from fractions import gcd
+from SWIM import SWIM
+
+class SwimSimulator(object):
+    '''
+    Event driven simulation of the SWIM membership protocol.  Every member
+    runs protocol periods of length period: it pings the next member of
+    its own pseudo-random permutation i -> (a * i + b) % n of the members,
+    redrawn after every pass and skipping itself and the members it
+    believes faulty, so each live member is probed by it at least once
+    every 2(n - 1) periods.  The walk is O(1) state per member.  It falls back to
+    ping-req through k random helpers if no ack arrives within
+    ack_timeout, and suspects the target if the period ends without an
+    ack.  A suspected member is confirmed faulty once suspicion_timeout
+    passes without a refutation; a live member hearing it is suspected
+    refutes by bumping its incarnation.  Membership updates ride on pings
+    and acks, each retransmitted lambda_ * log(n) times.
+    Every message is lost with probability loss and otherwise delivered
+    after a delay drawn from U(delay).  reachable(a, b), when given, tells
+    whether the link from a to b is up.
+    '''
+
+    ALIVE = 0
+    SUSPECT = 1
+    FAULTY = 2
+
+    def __init__(self, n, period=1.0, ack_timeout=0.2, k=3, suspicion_timeout=None,
+                 loss=0.0, delay=(0.001, 0.01), lambda_=3, max_piggyback=6,
+                 reachable=None, seed=None):
+        self.n = n
+        self.period = period
+        self.ack_timeout = ack_timeout
+        self.k = k
+        if suspicion_timeout is None:
+            suspicion_timeout = 5 * math.log10(n + 1) * period
+        self.suspicion_timeout = suspicion_timeout
+        self.loss = loss
+        self.delay = delay
+        self.retransmits = int(math.ceil(lambda_ * math.log(n + 1)))
+        self.max_piggyback = max_piggyback
+        self.reachable = reachable
+        self.rnd = random.Random(seed)
+        self.now = 0.0
+        self.incarnation = [0] * n
+        self.crash_time = {}
+        # views[m] maps members to (status, incarnation) where m's view
+        # differs from (ALIVE, 0); buffers[m] holds m's piggyback updates
+        self.views = [None] * n
+        self.buffers = [None] * n
+        self.sent = [0] * n
+        # walks[m] is (a, b, i): m's permutation and position in it
+        self.walks = [None] * n
+        # Probe id -> [prober, target, acked]; current[m] is m's probe id
+        self.probes = {}
+        self.current = [None] * n
+        self._probe_ids = 0
+        self.suspected = {}
+        self.confirmed = {}
+        # Times at which members learnt a crashed member was faulty
+        self.learnt = {}
+        self.false_positives = set()
+        self._events = []
+        self._seq = 0
+        for m in xrange(n):
+            self._schedule(self.rnd.uniform(0, period), 'tick', m)
+
+    @classmethod
+    def from_swim(cls, swim, **kw):
+        '''
+        Simulate over the links of a SWIM graph whose nodes are 0..n-1.
+        Nodes marked dead are crashed from the start
+        '''
+        g = swim.graph
+        sim = cls(len(g), reachable=lambda a, b: g.has_edge((a, b)), **kw)
+        for node in g.nodes():
+            if "dead" in g.node_attributes(node):
+                sim.crash(node, 0.0)
+        return sim
+
+    def crash(self, member, at=None):
+        self.crash_time[member] = self.now if at is None else at
+
+    def is_crashed(self, member, at=None):
+        return self.crash_time.get(member, float('inf')) <= (self.now if at is None else at)
+
+    def status(self, observer, member):
+        view = self.views[observer]
+        return (view or {}).get(member, (SwimSimulator.ALIVE, 0))[0]
+
+    def run(self, until):
+        '''
+        Process events up to time until
+        '''
+        events = self._events
+        while events and events[0][0] <= until:
+            (self.now, seq, kind, args) = heapq.heappop(events)
+            getattr(self, '_on_' + kind)(*args)
+        self.now = until
+
+    def report(self):
+        '''
+        Detection latency of each crashed member (first confirmation
+        anywhere, and once every live member knows; NaN if not yet),
+        false positives and messages sent per member per period
+        '''
+        crashed = sorted(self.crash_time)
+        live = self.n - len([m for m in crashed if self.is_crashed(m)])
+        detection = []
+        dissemination = []
+        for m in crashed:
+            start = self.crash_time[m]
+            detection.append(self.confirmed.get(m, float('nan')) - start)
+            learnt = self.learnt.get(m, [])
+            dissemination.append(learnt[live - 1] - start if len(learnt) >= live else float('nan'))
+        periods = max(self.now / self.period, 1.0)
+        return {
+            'crashed': crashed,
+            'detection_latency': np.array(detection),
+            'dissemination_latency': np.array(dissemination),
+            'false_positives': len(self.false_positives),
+            'false_positive_rate': len(self.false_positives) / float(max(self.n - len(crashed), 1)),
+            'messages': sum(self.sent),
+            'messages_per_member': sum(self.sent) / float(self.n) / periods,
+        }
+
+    def _schedule(self, at, kind, *args):
+        self._seq += 1
+        heapq.heappush(self._events, (at, self._seq, kind, args))
+
+    def _send(self, src, dst, kind, probe, via=None):
+        self.sent[src] += 1
+        updates = self._piggyback(src)
+        if self.rnd.random() < self.loss:
+            return
+        if self.reachable is not None and not self.reachable(src, dst):
+            return
+        self._schedule(self.now + self.rnd.uniform(*self.delay), 'deliver',
+                       dst, kind, src, probe, via, updates)
+
+    def _piggyback(self, src):
+        buf = self.buffers[src]
+        if not buf:
+            return ()
+        # Freshest updates (most transmissions left) go first
+        chosen = heapq.nlargest(self.max_piggyback, buf, key=lambda m: buf[m][2])
+        updates = []
+        for m in chosen:
+            entry = buf[m]
+            updates.append((m, entry[0], entry[1]))
+            entry[2] -= 1
+            if entry[2] <= 0:
+                del buf[m]
+        return updates
+
+    def _next_target(self, member):
+        # Next member of member's walk which is neither itself nor believed
+        # faulty, None if a whole pass finds none
+        n = self.n
+        view = self.views[member] or {}
+        (a, b, i) = self.walks[member] or self._new_walk()
+        for step in xrange(2 * n):
+            if i == n:
+                (a, b, i) = self._new_walk()
+            m = (a * i + b) % n
+            i += 1
+            if m != member and view.get(m, (0, 0))[0] != SwimSimulator.FAULTY:
+                self.walks[member] = (a, b, i)
+                return m
+        self.walks[member] = (a, b, i)
+        return None
+
+    def _new_walk(self):
+        # (a * i + b) % n visits every member once for i in 0..n-1 when a
+        # is coprime to n
+        while True:
+            a = self.rnd.randrange(1, self.n) if self.n > 1 else 1
+            if gcd(a, self.n) == 1:
+                return (a, self.rnd.randrange(self.n), 0)
+
+    def _random_members(self, member, count, exclude):
+        # Up to count distinct members not excluded or believed faulty
+        view = self.views[member] or {}
+        result = []
+        for i in xrange(4 * count + 8):
+            if len(result) == count:
+                break
+            m = self.rnd.randrange(self.n)
+            if m == member or m in exclude or m in result or \
+               view.get(m, (0, 0))[0] == SwimSimulator.FAULTY:
+                continue
+            result.append(m)
+        return result
+
+    def _on_tick(self, member):
+        if self.is_crashed(member):
+            return
+        self._schedule(self.now + self.period, 'tick', member)
+        # Close the previous protocol period
+        probe = self.probes.pop(self.current[member], None)
+        if probe is not None and not probe[2]:
+            target = probe[1]
+            (status, inc) = (self.views[member] or {}).get(target, (SwimSimulator.ALIVE, 0))
+            if status == SwimSimulator.ALIVE:
+                self._apply(member, target, SwimSimulator.SUSPECT, inc)
+        self.current[member] = None
+        target = self._next_target(member)
+        if target is None:
+            return
+        self._probe_ids += 1
+        self.probes[self._probe_ids] = [member, target, False]
+        self.current[member] = self._probe_ids
+        self._send(member, target, 'ping', self._probe_ids)
+        self._schedule(self.now + self.ack_timeout, 'timeout', self._probe_ids)
+
+    def _on_timeout(self, probe_id):
+        probe = self.probes.get(probe_id)
+        if probe is None or probe[2] or self.is_crashed(probe[0]):
+            return
+        (member, target) = (probe[0], probe[1])
+        for helper in self._random_members(member, self.k, (target,)):
+            self._send(member, helper, 'ping-req', probe_id, target)
+
+    def _on_deliver(self, dst, kind, src, probe_id, via, updates):
+        if self.is_crashed(dst):
+            return
+        for (m, status, inc) in updates:
+            self._apply(dst, m, status, inc)
+        if kind == 'ping':
+            self._send(dst, src, 'ack', probe_id)
+        elif kind == 'ping-req':
+            # via is the target; the target acks back to this helper
+            self._send(dst, via, 'indirect-ping', probe_id, src)
+        elif kind == 'indirect-ping':
+            # via is the prober the helper acts for
+            self._send(dst, src, 'indirect-ack', probe_id, via)
+        elif kind == 'indirect-ack':
+            self._send(dst, via, 'ack', probe_id)
+        elif kind == 'ack':
+            probe = self.probes.get(probe_id)
+            if probe is not None and probe[0] == dst:
+                probe[2] = True
+
+    def _on_confirm(self, member, target, inc):
+        if self.is_crashed(member):
+            return
+        if (self.views[member] or {}).get(target) == (SwimSimulator.SUSPECT, inc):
+            self._apply(member, target, SwimSimulator.FAULTY, inc)
+
+    def _apply(self, member, target, status, inc):
+        '''
+        Merge the update (target, status, inc) into member's view, and
+        queue it for dissemination if it is news
+        '''
+        if target == member:
+            # Refute suspicion of ourselves
+            if status == SwimSimulator.SUSPECT and inc >= self.incarnation[member]:
+                self.incarnation[member] = inc + 1
+                self._buffer(member, member, SwimSimulator.ALIVE, inc + 1)
+            return
+        if self.views[member] is None:
+            self.views[member] = {}
+        view = self.views[member]
+        (current, known) = view.get(target, (SwimSimulator.ALIVE, 0))
+        if current == SwimSimulator.FAULTY:
+            return
+        if status == SwimSimulator.ALIVE:
+            news = inc > known
+        elif status == SwimSimulator.SUSPECT:
+            news = inc > known or (inc == known and current == SwimSimulator.ALIVE)
+        else:
+            news = True
+        if not news:
+            return
+        view[target] = (status, inc)
+        self._buffer(member, target, status, inc)
+        if status == SwimSimulator.SUSPECT:
+            self.suspected.setdefault(target, self.now)
+            self._schedule(self.now + self.suspicion_timeout, 'confirm', member, target, inc)
+        elif status == SwimSimulator.FAULTY:
+            self.confirmed.setdefault(target, self.now)
+            if self.is_crashed(target):
+                self.learnt.setdefault(target, []).append(self.now)
+            else:
+                self.false_positives.add(target)
+
+    def _buffer(self, member, target, status, inc):
+        if self.buffers[member] is None:
+            self.buffers[member] = {}
+        self.buffers[member][target] = [status, inc, self.retransmits]
+
+class SwimSimulatorTest(unittest.TestCase):
+
+    def test_detect_crashes(self):
+        sim = SwimSimulator(60, suspicion_timeout=3.0, seed=1)
+        sim.run(2.0)
+        for m in [3, 17, 42]:
+            sim.crash(m)
+        sim.run(40.0)
+        report = sim.report()
+        self.assertEquals([3, 17, 42], report['crashed'])
+        latency = report['detection_latency']
+        self.assertTrue((latency > 3.0).all())
+        self.assertTrue((latency < 25.0).all())
+        self.assertTrue((report['dissemination_latency'] >= latency).all())
+        self.assertEquals(0, report['false_positives'])
+        # A ping and an ack per member and period, and little else
+        self.assertTrue(1.5 < report['messages_per_member'] < 3.0)
+        for observer in xrange(60):
+            if not sim.is_crashed(observer):
+                self.assertEquals(SwimSimulator.FAULTY, sim.status(observer, 42))
+
+    def test_round_robin_probes(self):
+        # Each pass of n - 1 periods pings every other member once, and a
+        # member confirmed faulty is dropped from the list
+        sim = SwimSimulator(8, seed=5)
+        pinged = []
+        send = sim._send
+        def record(src, dst, kind, probe, via=None):
+            if src == 0 and kind == 'ping':
+                pinged.append(dst)
+            send(src, dst, kind, probe, via)
+        sim._send = record
+        sim.run(14.0)
+        self.assertEquals(14, len(pinged))
+        self.assertEquals(range(1, 8), sorted(pinged[:7]))
+        self.assertEquals(range(1, 8), sorted(pinged[7:]))
+        sim._apply(0, 5, SwimSimulator.FAULTY, 0)
+        del pinged[:]
+        sim.run(26.0)
+        self.assertFalse(5 in pinged)
+        self.assertEquals(set(range(1, 8)) - set([5]), set(pinged))
+
+    def test_large_membership(self):
+        # O(1) probe state per member keeps 10^4 members cheap
+        start = time.time()
+        sim = SwimSimulator(10000, seed=6)
+        sim.crash(123, 0.5)
+        sim.run(5.0)
+        self.assertTrue(time.time() - start < 60.0)
+        self.assertEquals(9999, sum(1 for walk in sim.walks if walk is not None))
+        self.assertTrue(123 in sim.suspected)
+        self.assertEquals(0, sim.report()['false_positives'])
+
+    def test_indirect_probes(self):
+        # Direct pings from 0 to 1 are lost, but 0 never suspects 1
+        sim = SwimSimulator(10, reachable=lambda a, b: (a, b) != (0, 1), seed=2)
+        sim.run(30.0)
+        self.assertEquals(SwimSimulator.ALIVE, sim.status(0, 1))
+        self.assertEquals(0, sim.report()['false_positives'])
+        sim = SwimSimulator(10, k=0, suspicion_timeout=60.0,
+                            reachable=lambda a, b: (a, b) != (0, 1), seed=2)
+        sim.run(30.0)
+        self.assertTrue(1 in sim.suspected)
+
+    def test_refutation(self):
+        # Lossy links cause suspicions, which live members refute
+        sim = SwimSimulator(40, k=3, loss=0.1, suspicion_timeout=10.0, seed=3)
+        sim.run(40.0)
+        self.assertTrue(len(sim.suspected) > 0)
+        self.assertTrue(max(sim.incarnation) > 0)
+        self.assertEquals(0, sim.report()['false_positives'])
+        # More helpers mask more of the loss
+        rates = []
+        for k in [1, 3]:
+            sim = SwimSimulator(40, k=k, loss=0.2, suspicion_timeout=10.0, seed=3)
+            sim.run(40.0)
+            rates.append(sim.report()['false_positive_rate'])
+        self.assertTrue(rates[0] > rates[1])
+
+    def test_from_swim(self):
+        g = graph()
+        g.add_nodes(xrange(10))
+        g.complete()
+        swim = SWIM(g)
+        swim.node_alive(4, False)
+        sim = SwimSimulator.from_swim(swim, suspicion_timeout=2.0, seed=4)
+        sim.run(20.0)
+        report = sim.report()
+        self.assertEquals([4], report['crashed'])
+        self.assertTrue(report['detection_latency'][0] < 10.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,7 @@
 import sys
 from lamport import LamportTimestamp
 from vectorclock import VectorClock
+from hlc import HybridLogicalClock
 
 class Driver(object):
 
@@ -50,11 +51,13 @@ class Driver(object):
 
 if __name__ == '__main__':
     numProc = int(raw_input("Number of procs: "))
-    systemName = raw_input("(l)amport, (v)ector clock: ")
+    systemName = raw_input("(l)amport, (v)ector clock, (h)ybrid logical clock: ")
     if systemName[0] == "l":
         ts = LamportTimestamp(numProc)
     elif systemName[0] == 'v':
         ts = VectorClock(numProc)
+    elif systemName[0] == 'h':
+        ts = HybridLogicalClock(numProc)
     else:
         print "Unknown timestamp system!"
         raise KeyError()
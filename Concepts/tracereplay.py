@@ -0,0 +1,219 @@
+import argparse
+import json
+import sys
+import time
+import unittest
+from StringIO import StringIO
+from lamport import LamportTimestamp
+from markstore import MarkStore
+from vectorclock import VectorClock, DifferentialVectorClock
+from hlc import HybridLogicalClock
+
+# Replay event traces through a clock as a pipeline of generators:
+#
+#     lines -> parse -> replay(clock) -> Throughput -> formatRecords
+#
+# Text traces use the commands of timestampdriver.Driver, one per line:
+# c (clear), s proc (step), m fromProc toProc (message), h proc mark (half
+# send) and r proc mark (half receive); blank lines and lines starting with
+# # are skipped.  JSONL traces hold one object per line such as
+# {"op": "send", "from": 0, "to": 1} or {"op": "half-recv", "proc": 2,
+# "mark": "m1"}, op being one of clear, step, send, half-send and half-recv.
+
+CLOCKS = {
+    'lamport': LamportTimestamp,
+    'vector': VectorClock,
+    'diffvector': DifferentialVectorClock,
+    'hlc': lambda numProc, marks: HybridLogicalClock(numProc, marks=marks),
+}
+
+JSON_OPS = {'clear': 'c', 'step': 's', 'send': 'm', 'half-send': 'h', 'half-recv': 'r'}
+
+def parse(lines):
+    '''
+    Generate (cmd, args) from text or JSONL trace lines, cmd being a
+    Driver command letter
+    '''
+    for line in lines:
+        line = line.strip()
+        if not line or line[0] == '#':
+            continue
+        if line[0] == '{':
+            event = json.loads(line)
+            cmd = JSON_OPS[event['op']]
+            if cmd == 'm':
+                yield (cmd, (int(event['from']), int(event['to'])))
+            elif cmd == 'c':
+                yield (cmd, ())
+            elif cmd == 's':
+                yield (cmd, (int(event['proc']),))
+            else:
+                # Marks are byte strings as in the text format
+                mark = event['mark']
+                if isinstance(mark, unicode):
+                    mark = mark.encode('utf-8')
+                yield (cmd, (int(event['proc']), str(mark)))
+            continue
+        args = line.split()
+        cmd = args[0][0]
+        if cmd == 'm':
+            yield (cmd, (int(args[1]), int(args[2])))
+        elif cmd == 'c':
+            yield (cmd, ())
+        elif cmd == 's':
+            yield (cmd, (int(args[1]),))
+        elif cmd in 'hr':
+            yield (cmd, (int(args[1]), args[2]))
+        else:
+            raise ValueError("unknown trace command %r" % line)
+
+def replay(clock, commands):
+    '''
+    Apply commands to clock, generating (cmd, args, timestamps) with the
+    timestamp of every process the command touched, taken right after it
+    '''
+    steps = {
+        's': clock.addStep,
+        'h': clock.halfSend,
+        'r': clock.halfRecv,
+    }
+    for (cmd, args) in commands:
+        if cmd == 'c':
+            clock.clear()
+            yield (cmd, args, ())
+        elif cmd == 'm':
+            clock.sendMesg(*args)
+            yield (cmd, args, (clock.getTS(args[0]), clock.getTS(args[1])))
+        else:
+            steps[cmd](*args)
+            yield (cmd, args, (clock.getTS(args[0]),))
+
+class Throughput(object):
+    '''
+    Pass items through, counting them.  Every `every` items, and once at
+    the end, a rate line is written to out
+    '''
+
+    def __init__(self, every=1000000, out=sys.stderr):
+        self.every = every
+        self.out = out
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, items):
+        start = time.time()
+        for item in items:
+            yield item
+            self.count += 1
+            if self.every and self.count % self.every == 0:
+                self.seconds = time.time() - start
+                self._report()
+        self.seconds = time.time() - start
+        self._report()
+
+    def rate(self):
+        return self.count / self.seconds if self.seconds > 0 else float('inf')
+
+    def _report(self):
+        if self.out is not None:
+            self.out.write("%d events in %.2fs, %.0f events/s\n" %
+                           (self.count, self.seconds, self.rate()))
+
+def formatRecords(records):
+    '''
+    Output lines: the command followed by proc=timestamp for each process
+    it touched
+    '''
+    for (cmd, args, stamps) in records:
+        procs = args[:2] if cmd == 'm' else args[:1]
+        yield "%s %s\n" % (cmd, " ".join("%d=%s" % (proc, ts) for (proc, ts) in zip(procs, stamps)))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Timestamp event traces")
+    parser.add_argument('traces', nargs='*', help="trace files, stdin if none")
+    parser.add_argument('-c', '--clock', choices=sorted(CLOCKS), default='vector')
+    parser.add_argument('-n', '--procs', type=int, required=True)
+    parser.add_argument('-q', '--quiet', action='store_true', help="only report throughput")
+    parser.add_argument('--every', type=int, default=1000000,
+                        help="report throughput every so many events")
+    parser.add_argument('--mark-receivers', type=int,
+                        help="free a mark after this many half receives")
+    parser.add_argument('--mark-cap', type=int, help="spill marks beyond this many to disk")
+    args = parser.parse_args(argv)
+
+    def lines():
+        if not args.traces:
+            for line in sys.stdin:
+                yield line
+        for path in args.traces:
+            with open(path) as f:
+                for line in f:
+                    yield line
+
+    marks = MarkStore(args.mark_receivers, args.mark_cap)
+    clock = CLOCKS[args.clock](args.procs, marks)
+    records = Throughput(args.every)(replay(clock, parse(lines())))
+    if args.quiet:
+        for record in records:
+            pass
+    else:
+        sys.stdout.writelines(formatRecords(records))
+    sys.stderr.write("%d marks outstanding, %d spilled\n" % (marks.outstanding(), marks.spilled()))
+    marks.clear()
+
+class TraceReplayTest(unittest.TestCase):
+
+    TRACE = '''
+# exam_vector style trace
+m 4 3
+h 1 m1
+{"op": "half-send", "proc": 3, "mark": "m8"}
+r 3 m1
+{"op": "half-recv", "proc": 2, "mark": "m8"}
+s 2
+'''
+
+    def testMatchesDirectCalls(self):
+        vc = VectorClock(5)
+        records = list(replay(VectorClock(5), parse(StringIO(self.TRACE))))
+        vc.sendMesg(4, 3)
+        vc.halfSend(1, "m1")
+        vc.halfSend(3, "m8")
+        vc.halfRecv(3, "m1")
+        vc.halfRecv(2, "m8")
+        vc.addStep(2)
+        self.assertEquals(6, len(records))
+        self.assertEquals(('m', (4, 3), ([0, 0, 0, 0, 1], [0, 0, 0, 1, 1])), records[0])
+        self.assertEquals(vc.getTS(3), records[3][2][0])
+        self.assertEquals(vc.getTS(2), records[5][2][0])
+
+    def testLamport(self):
+        records = list(replay(LamportTimestamp(5), parse(StringIO(self.TRACE))))
+        self.assertEquals(('m', (4, 3), (1, 2)), records[0])
+        self.assertEquals(4, records[4][2][0])
+
+    def testFormatAndThroughput(self):
+        out = StringIO()
+        meter = Throughput(every=2, out=out)
+        lines = list(formatRecords(meter(replay(LamportTimestamp(5), parse(StringIO(self.TRACE))))))
+        self.assertEquals("m 4=1 3=2\n", lines[0])
+        self.assertEquals("h 1=1\n", lines[1])
+        self.assertEquals(6, meter.count)
+        self.assertEquals(4, len(out.getvalue().splitlines()))
+
+    def testUnicodeMark(self):
+        trace = ['{"op": "half-send", "proc": 1, "mark": "\\u00e9t\\u00e9"}',
+                 'r 2 \xc3\xa9t\xc3\xa9']
+        self.assertEquals([('h', (1, '\xc3\xa9t\xc3\xa9')), ('r', (2, '\xc3\xa9t\xc3\xa9'))],
+                          list(parse(trace)))
+        records = list(replay(LamportTimestamp(3), parse(trace)))
+        self.assertEquals(2, records[1][2][0])
+
+    def testBadCommand(self):
+        self.assertRaises(ValueError, list, parse(["x 1"]))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'test':
+        unittest.main(argv=sys.argv[:1] + sys.argv[2:])
+    else:
+        main()
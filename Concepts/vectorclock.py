@@ -1,4 +1,7 @@
 import unittest
+import struct
+import numpy as np
+from markstore import MarkStore, putMark
 
 class VectorClock(object):
     '''
@@ -8,68 +11,303 @@ class VectorClock(object):
         instanteously so there is no interleaving event.
     3) halfSend is the sending side of a message
     4) halfRecv is the receiving side of a message
+    Timestamps are rows of an int64 matrix, merged in place.  The static
+    *Many and *Matrix methods compare timestamps in bulk.  Marks live in a
+    MarkStore, which can free them once received
     '''
 
-    def __init__(self, numProc):
+    def __init__(self, numProc, marks=None):
         self._numProc = numProc
+        self.marks = marks if marks is not None else MarkStore()
+        # HBRecorder told of every event, if any
+        self.recorder = None
         self.clear()
 
     def addStep(self, proc):
         self._inc(proc)
+        if self.recorder is not None:
+            self.recorder.step(proc)
 
     def sendMesg(self, fromProc, toProc):
         self._inc(fromProc)
-        fromTS = self.ts[fromProc]
-        self.ts[toProc] = self._merge(fromTS, toProc)
+        self._merge(self.ts[fromProc], toProc)
+        if self.recorder is not None:
+            self.recorder.message(fromProc, toProc)
 
-    def halfSend(self, fromProc, mark):
+    def halfSend(self, fromProc, mark, receivers=None):
         self._inc(fromProc)
-        self.marks[mark] = list(self.ts[fromProc])
+        putMark(self.marks, mark, self.ts[fromProc].copy(), receivers)
+        if self.recorder is not None:
+            self.recorder.send(fromProc, mark, receivers)
 
     def halfRecv(self, toProc, mark):
-        fromTS = self.marks[mark]
-        self.ts[toProc] = self._merge(fromTS, toProc)
+        self._merge(self.marks.consume(mark), toProc)
+        if self.recorder is not None:
+            self.recorder.recv(toProc, mark)
 
     def clear(self):
-        self.ts = [[0] * self._numProc for i in xrange(self._numProc)]
-        self.marks = {}
+        self.ts = np.zeros((self._numProc, self._numProc), dtype=np.int64)
+        self.marks.clear()
 
     def reportTS(self, proc=None):
         if proc == None:
-            return self.ts
+            return self.ts.tolist()
         else:
-            return "ts[%d]=%s" % (proc, self.ts[proc])
+            return "ts[%d]=%s" % (proc, self.ts[proc].tolist())
 
     def _inc(self, proc):
-        self.ts[proc][proc] += 1
+        self.ts[proc, proc] += 1
 
     def _merge(self, fromTS, toProc):
         toTS = self.ts[toProc]
         # V_i[i] = V_i[i] + 1
         vp = toTS[toProc] + 1
         # V_i[j] = max(V_mesg[j], V_i[j]) for j != i
-        toTS = [max(fromTS[i], toTS[i]) for i in xrange(len(fromTS))]
+        np.maximum(toTS, fromTS, out=toTS)
         toTS[toProc] = vp
-        return toTS
 
     def getTS(self, proc):
-        return self.ts[proc]
+        return self.ts[proc].tolist()
 
     def getNumProcs(self):
         return self._numProc
 
     @staticmethod
     def lessEq(ts1, ts2):
-        return all(ts1[i] <= ts2[i] for i in xrange(len(ts1)))
+        return bool(np.all(np.asarray(ts1) <= np.asarray(ts2)))
 
     @staticmethod
     def isCasuallyRelated(ts1, ts2):
-        return VectorClock.lessEq(ts1, ts2) and any(ts1[i] < ts2[i] for i in xrange(len(ts1)))
+        (ts1, ts2) = (np.asarray(ts1), np.asarray(ts2))
+        return bool(np.all(ts1 <= ts2) and np.any(ts1 < ts2))
 
     @staticmethod
     def isConcurrent(ts1, ts2):
         return not VectorClock.lessEq(ts1, ts2) and not VectorClock.lessEq(ts2, ts1)
+
+    @staticmethod
+    def lessEqMany(ts, tsList):
+        '''
+        Bool array telling for each row of tsList whether ts <= row
+        '''
+        return np.all(np.asarray(ts) <= np.asarray(tsList), axis=1)
+
+    @staticmethod
+    def greaterEqMany(ts, tsList):
+        return np.all(np.asarray(ts) >= np.asarray(tsList), axis=1)
+
+    @staticmethod
+    def happenedBeforeMany(ts, tsList):
+        '''
+        Bool array telling for each row of tsList whether ts -> row
+        '''
+        (ts, tsList) = (np.asarray(ts), np.asarray(tsList))
+        return np.all(ts <= tsList, axis=1) & np.any(ts < tsList, axis=1)
+
+    @staticmethod
+    def concurrentMany(ts, tsList):
+        '''
+        Bool array telling for each row of tsList whether it is concurrent
+        with ts
+        '''
+        return ~VectorClock.lessEqMany(ts, tsList) & ~VectorClock.greaterEqMany(ts, tsList)
+
+    @staticmethod
+    def lessEqMatrix(tsList):
+        '''
+        M x M bool matrix, [i, j] telling whether tsList[i] <= tsList[j].
+        Built one component at a time to keep memory at O(M^2)
+        '''
+        tsList = np.asarray(tsList)
+        le = np.ones((len(tsList), len(tsList)), dtype=bool)
+        for k in xrange(tsList.shape[1]):
+            column = tsList[:, k]
+            le &= column[:, None] <= column[None, :]
+        return le
+
+    @staticmethod
+    def happenedBeforeMatrix(tsList):
+        '''
+        [i, j] tells whether tsList[i] -> tsList[j]
+        '''
+        le = VectorClock.lessEqMatrix(tsList)
+        return le & ~le.T
+
+    @staticmethod
+    def concurrentMatrix(tsList):
+        le = VectorClock.lessEqMatrix(tsList)
+        return ~le & ~le.T
     
+class DifferentialVectorClock(VectorClock):
+    '''
+    Vector clock whose messages carry only the entries which changed, in
+    the spirit of Singhal-Kshemkalyani.  Each process appends (entry,
+    value) to its change log whenever an entry of its vector grows.  A mark
+    is just (fromProc, log position), and halfRecv merges the slice of the
+    sender's log added since the last message the receiver merged from
+    that sender.  Since entries only grow, merging that slice gives the
+    same vector as merging the full timestamp.
+    Logs are trimmed as they grow: the prefix before the oldest position
+    still held by a mark in the MarkStore is replaced by the latest value
+    of each entry in it, at most numProc entries.  A receiver whose slice
+    starts in the trimmed part gets that summary, which it may partly
+    know already.
+    '''
+
+    # Width codes of the binary encoding
+    WIDTHS = [(1, '<u1'), (2, '<u2'), (4, '<u4'), (8, '<u8')]
+    HEADER = struct.Struct('<BBBII')
+
+    def clear(self):
+        VectorClock.clear(self)
+        numProc = self._numProc
+        self._logEntry = [np.zeros(16, dtype=np.int32) for i in xrange(numProc)]
+        self._logValue = [np.zeros(16, dtype=np.int64) for i in xrange(numProc)]
+        # Positions are absolute: position pos >= _logBase[proc] is at
+        # index pos - _logBase[proc] + _logSummary[proc] of the log arrays,
+        # the first _logSummary[proc] of which summarize the trimmed prefix
+        self._logSize = [0] * numProc
+        self._logBase = [0] * numProc
+        self._logSummary = [0] * numProc
+        self._compactAt = [max(64, 2 * numProc)] * numProc
+        # (position, mark) of each process's half sends, pruned on compaction
+        self._sent = [[] for i in xrange(numProc)]
+        # _merged[to][from] is the end of the slice of from's log last
+        # merged by to
+        self._merged = np.zeros((numProc, numProc), dtype=np.int64)
+        self.entriesSent = 0
+
+    def sendMesg(self, fromProc, toProc):
+        self._inc(fromProc)
+        self._recvFrom(fromProc, self._logSize[fromProc], toProc)
+        if self.recorder is not None:
+            self.recorder.message(fromProc, toProc)
+
+    def halfSend(self, fromProc, mark, receivers=None):
+        self._inc(fromProc)
+        putMark(self.marks, mark, (fromProc, self._logSize[fromProc]), receivers)
+        self._sent[fromProc].append((self._logSize[fromProc], mark))
+        if self.recorder is not None:
+            self.recorder.send(fromProc, mark, receivers)
+
+    def halfRecv(self, toProc, mark):
+        (fromProc, pos) = self.marks.consume(mark)
+        self._recvFrom(fromProc, pos, toProc)
+        if self.recorder is not None:
+            self.recorder.recv(toProc, mark)
+
+    def mesgTS(self, mark, toProc):
+        '''
+        (entries, values) the message mark carries to toProc
+        '''
+        (fromProc, pos) = self.marks[mark]
+        return self._slice(fromProc, min(self._merged[toProc, fromProc], pos), pos)
+
+    def _inc(self, proc):
+        VectorClock._inc(self, proc)
+        self._log(proc, np.array([proc]), self.ts[proc, proc:proc + 1])
+
+    def _recvFrom(self, fromProc, pos, toProc):
+        start = self._merged[toProc, fromProc]
+        if pos > start:
+            self._merged[toProc, fromProc] = pos
+        (entries, values) = self._slice(fromProc, start, pos)
+        self.entriesSent += len(entries)
+        toTS = self.ts[toProc]
+        old = toTS[entries]
+        # Own entry is not taken from the message
+        vp = toTS[toProc] + 1
+        np.maximum.at(toTS, entries, values)
+        toTS[toProc] = vp
+        grown = entries[toTS[entries] > old]
+        grown = grown[grown != toProc]
+        self._log(toProc, np.append(grown, toProc), toTS[np.append(grown, toProc)])
+
+    def _slice(self, proc, start, end):
+        # Latest value of each entry logged by proc in [start, end)
+        (start, end) = (self._index(proc, start), self._index(proc, end))
+        entries = self._logEntry[proc][start:end][::-1]
+        (entries, last) = np.unique(entries, return_index=True)
+        return (entries, self._logValue[proc][start:end][::-1][last])
+
+    def _index(self, proc, pos):
+        # Index of absolute position pos in the log arrays
+        if pos < self._logBase[proc]:
+            return 0
+        return pos - self._logBase[proc] + self._logSummary[proc]
+
+    def _log(self, proc, entries, values):
+        size = self._index(proc, self._logSize[proc])
+        end = size + len(entries)
+        if end > len(self._logEntry[proc]):
+            capacity = max(2 * len(self._logEntry[proc]), end)
+            self._logEntry[proc] = np.resize(self._logEntry[proc], capacity)
+            self._logValue[proc] = np.resize(self._logValue[proc], capacity)
+        self._logEntry[proc][size:end] = entries
+        self._logValue[proc][size:end] = values
+        self._logSize[proc] += len(entries)
+        if end >= self._compactAt[proc]:
+            self._compact(proc)
+
+    def _compact(self, proc):
+        # Summarize the log before the oldest position a mark still needs
+        sent = [(pos, mark) for (pos, mark) in self._sent[proc] if mark in self.marks]
+        self._sent[proc] = sent
+        keep = min([self._logSize[proc]] + [pos for (pos, mark) in sent])
+        if keep > self._logBase[proc]:
+            (entries, values) = self._slice(proc, 0, keep)
+            (cut, size) = (self._index(proc, keep), self._index(proc, self._logSize[proc]))
+            self._logEntry[proc] = np.concatenate([entries, self._logEntry[proc][cut:size]])
+            self._logValue[proc] = np.concatenate([values, self._logValue[proc][cut:size]])
+            self._logBase[proc] = keep
+            self._logSummary[proc] = len(entries)
+        # Amortize: wait for the log to double before trying again
+        self._compactAt[proc] = max(64, 2 * self._numProc,
+                                    2 * self._index(proc, self._logSize[proc]))
+
+    @staticmethod
+    def encode(ts):
+        '''
+        Pack a vector into bytes, storing either every entry or only the
+        non-zero ones with their indexes, whichever is smaller, each array
+        in the narrowest unsigned width that holds it
+        '''
+        ts = np.asarray(ts, dtype=np.int64)
+        entries = np.flatnonzero(ts)
+        valueWidth = DifferentialVectorClock._width(ts.max() if len(ts) else 0)
+        indexWidth = DifferentialVectorClock._width(len(ts))
+        (vbytes, vtype) = DifferentialVectorClock.WIDTHS[valueWidth]
+        (ibytes, itype) = DifferentialVectorClock.WIDTHS[indexWidth]
+        sparse = len(entries) * (ibytes + vbytes) < len(ts) * vbytes
+        header = DifferentialVectorClock.HEADER.pack(
+            sparse, indexWidth, valueWidth, len(ts), len(entries) if sparse else len(ts))
+        if sparse:
+            return header + entries.astype(itype).tostring() + ts[entries].astype(vtype).tostring()
+        return header + ts.astype(vtype).tostring()
+
+    @staticmethod
+    def decode(data):
+        '''
+        Vector, as a list, from the bytes of encode
+        '''
+        header = DifferentialVectorClock.HEADER
+        (sparse, indexWidth, valueWidth, length, count) = header.unpack_from(data)
+        (vbytes, vtype) = DifferentialVectorClock.WIDTHS[valueWidth]
+        (ibytes, itype) = DifferentialVectorClock.WIDTHS[indexWidth]
+        offset = header.size
+        if not sparse:
+            return np.frombuffer(data, vtype, count, offset).astype(np.int64).tolist()
+        ts = np.zeros(length, dtype=np.int64)
+        entries = np.frombuffer(data, itype, count, offset)
+        ts[entries] = np.frombuffer(data, vtype, count, offset + count * ibytes)
+        return ts.tolist()
+
+    @staticmethod
+    def _width(value):
+        for (code, (nbytes, dtype)) in enumerate(DifferentialVectorClock.WIDTHS):
+            if value < 2 ** (8 * nbytes):
+                return code
+
 class VectorClockTest(unittest.TestCase):
 
     def setUp(self):
@@ -119,7 +357,136 @@ class VectorClockTest(unittest.TestCase):
         self.assertFalse(VectorClock.isConcurrent([3,4,5], [3,4,5]))
         self.assertFalse(VectorClock.isConcurrent([3,4,5], [3,4,6]))
         self.assertTrue(VectorClock.isConcurrent([3,4,5], [3,5,4]))
-        
+
+    def testGetTS(self):
+        vc = self.vclock
+        vc.sendMesg(2, 0)
+        self.assertEquals([1,0,1], vc.getTS(0))
+        self.assertEquals([[1,0,1], [0,0,0], [0,0,1]], vc.reportTS())
+        self.assertEquals("ts[0]=[1, 0, 1]", vc.reportTS(0))
+        vc.clear()
+        self.assertEquals([0,0,0], vc.getTS(0))
+
+    def testMarkIsCopy(self):
+        vc = self.vclock
+        vc.halfSend(0, "m1")
+        vc.addStep(0)
+        vc.halfRecv(1, "m1")
+        self.assertEquals([1,1,0], vc.getTS(1))
+
+    def testMarksFreed(self):
+        vc = VectorClock(3, MarkStore(receivers=1))
+        vc.halfSend(0, "m1")
+        vc.halfSend(0, "m2")
+        vc.halfRecv(1, "m1")
+        self.assertEquals(1, vc.marks.outstanding())
+        self.assertRaises(KeyError, vc.halfRecv, 2, "m1")
+        vc.clear()
+        self.assertEquals(0, vc.marks.outstanding())
+
+    def testMany(self):
+        tsList = [[3,4,5], [3,4,6], [3,5,4], [2,4,5], [4,5,6]]
+        self.assertEquals([True, True, False, False, True],
+                          VectorClock.lessEqMany([3,4,5], tsList).tolist())
+        self.assertEquals([False, True, False, False, True],
+                          VectorClock.happenedBeforeMany([3,4,5], tsList).tolist())
+        self.assertEquals([False, False, True, False, False],
+                          VectorClock.concurrentMany([3,4,5], tsList).tolist())
+
+    def testMatrix(self):
+        rnd = np.random.RandomState(1)
+        tsList = rnd.randint(0, 4, size=(40, 3))
+        hb = VectorClock.happenedBeforeMatrix(tsList)
+        conc = VectorClock.concurrentMatrix(tsList)
+        for i in xrange(40):
+            for j in xrange(40):
+                self.assertEquals(VectorClock.isCasuallyRelated(tsList[i], tsList[j]), hb[i, j])
+                self.assertEquals(VectorClock.isConcurrent(tsList[i], tsList[j]), conc[i, j])
+
+class DifferentialVectorClockTest(unittest.TestCase):
+
+    def testMatchesVectorClock(self):
+        # Also with marks freed on receipt, which lets the logs be trimmed
+        for marks in (None, MarkStore(receivers=1)):
+            self.checkMatchesVectorClock(DifferentialVectorClock(12, marks))
+
+    def checkMatchesVectorClock(self, dvc):
+        rnd = np.random.RandomState(2)
+        vc = VectorClock(12)
+        pending = []
+        for i in xrange(3000):
+            op = rnd.randint(4)
+            (a, b) = rnd.randint(0, 12, 2)
+            if op == 0:
+                for clock in (vc, dvc):
+                    clock.addStep(a)
+            elif op == 1 and a != b:
+                for clock in (vc, dvc):
+                    clock.sendMesg(a, b)
+            elif op == 2:
+                for clock in (vc, dvc):
+                    clock.halfSend(a, "m%d" % i)
+                pending.append("m%d" % i)
+            elif pending:
+                # Deliver in any order
+                mark = pending.pop(rnd.randint(len(pending)))
+                for clock in (vc, dvc):
+                    clock.halfRecv(b, mark)
+            self.assertEquals(vc.getTS(a), dvc.getTS(a))
+            self.assertEquals(vc.getTS(b), dvc.getTS(b))
+        self.assertEquals(vc.reportTS(), dvc.reportTS())
+
+    def testLogsTrimmed(self):
+        numProc = 50
+        dvc = DifferentialVectorClock(numProc, MarkStore(receivers=1))
+        for i in xrange(20000):
+            p = i % numProc
+            dvc.halfSend(p, i)
+            dvc.halfRecv((p + 1) % numProc, i)
+        self.assertEquals(0, dvc.marks.outstanding())
+        # Each log holds at most a summary plus what came since the last trim
+        self.assertTrue(sum(dvc._index(p, dvc._logSize[p]) for p in xrange(numProc)) <
+                        numProc * 4 * numProc)
+        vc = VectorClock(numProc)
+        for i in xrange(20000):
+            vc.halfSend(i % numProc, i)
+            vc.halfRecv((i + 1) % numProc, i)
+        self.assertEquals(vc.reportTS(), dvc.reportTS())
+
+    def testEntriesSent(self):
+        # Processes talking to their ring neighbors only send a few entries
+        vc = VectorClock(1000)
+        dvc = DifferentialVectorClock(1000)
+        for r in xrange(5):
+            for clock in (vc, dvc):
+                for p in xrange(1000):
+                    clock.halfSend(p, (r, p))
+                for p in xrange(1000):
+                    clock.halfRecv((p + 1) % 1000, (r, p))
+        self.assertEquals(vc.reportTS(), dvc.reportTS())
+        self.assertEquals(6, np.count_nonzero(dvc.getTS(7)))
+        self.assertTrue(dvc.entriesSent < 5000 * 6)
+
+    def testMesgTS(self):
+        dvc = DifferentialVectorClock(4)
+        dvc.sendMesg(2, 0)
+        dvc.halfSend(0, "m1")
+        (entries, values) = dvc.mesgTS("m1", 1)
+        self.assertEquals([(0, 2), (2, 1)], zip(entries.tolist(), values.tolist()))
+        dvc.halfRecv(1, "m1")
+        dvc.halfSend(0, "m2")
+        self.assertEquals([0], dvc.mesgTS("m2", 1)[0].tolist())
+        self.assertEquals([0, 2], dvc.mesgTS("m2", 3)[0].tolist())
+
+    def testEncode(self):
+        for ts in [[0, 0, 0], [3, 4, 5], [0] * 999 + [70000], range(300), [2 ** 40, 1]]:
+            data = DifferentialVectorClock.encode(ts)
+            self.assertEquals(ts, DifferentialVectorClock.decode(data))
+        # One two byte index and one four byte value
+        self.assertEquals(DifferentialVectorClock.HEADER.size + 2 + 4,
+                          len(DifferentialVectorClock.encode([0] * 999 + [70000])))
+        self.assertEquals(DifferentialVectorClock.HEADER.size + 300 * 2,
+                          len(DifferentialVectorClock.encode(range(300))))
 
 if __name__ == '__main__':
     unittest.main()